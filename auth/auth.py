@@ -70,11 +70,43 @@ class AuthHelper():
     
     def verify_password(self, username, password):
         return self.__verify_password(username, password)
+
+    def authenticate(self, headers):
+        """
+        Authenticates a request from its headers, without Flask. Used by the ASGI app.
+
+        Args:
+            headers (Mapping): The request headers.
+
+        Returns:
+            tuple: The user info and its roles, or (False, None) if the request is not authenticated.
+        """
+        scheme, _, credentials = headers.get('Authorization', '').partition(' ')
+        if self.__mode == 'basic':
+            if scheme.lower() != 'basic':
+                return False, None
+            try:
+                username, _, password = base64.b64decode(credentials).decode('utf-8').partition(':')
+            except Exception:
+                return False, None
+            userinfo = self.__verify_password(username, password)
+            if not userinfo:
+                return False, None
+            return userinfo, self.__get_user_roles_basic(userinfo)
+        else:
+            if scheme.lower() != 'bearer':
+                return False, None
+            userinfo = self.__verify_token(credentials, headers)
+            if not userinfo:
+                return False, None
+            return userinfo, self.__get_user_roles_oauth(userinfo, headers)
     
-    def __verify_token(self, token):
+    def __verify_token(self, token, headers=None):
         """ Check token when using OAuth"""
         if not token:
             return False
+        if headers is None:
+            headers = request.headers
         
         decoded_token = self.__token_is_valid(self.__client_id, token)
         # Validate the access token
@@ -84,9 +116,9 @@ class AuthHelper():
             if 'preferred_username' in decoded_token:
                 return { 'username': decoded_token['preferred_username'] , 'application' : None } # Return the client username, if it's a personal token
             elif 'azp' in decoded_token:
-                if 'Liev-Client-Username' in request.headers:
+                if 'Liev-Client-Username' in headers:
                     #return f"{decoded_token['azp']}\{request.headers['Liev-Client-Username']}"
-                    return { 'username': request.headers['Liev-Client-Username'], 'application' : decoded_token['azp'] }
+                    return { 'username': headers['Liev-Client-Username'], 'application' : decoded_token['azp'] }
                 return { 'username': 'unknown' , 'application' : decoded_token['azp'] }  # Return Authorized Party ID, if it's a client application
             else:
                return False
@@ -95,8 +127,10 @@ class AuthHelper():
         user = next((user for user in self.__users if user["username"] == userinfo["username"]), None)
         return user['roles']
     
-    def __get_user_roles_oauth(self, userinfo):
-        token = request.headers.get('Authorization', '').split('Bearer ')[-1]
+    def __get_user_roles_oauth(self, userinfo, headers=None):
+        if headers is None:
+            headers = request.headers
+        token = headers.get('Authorization', '').split('Bearer ')[-1]
         decoded_token = self.__token_is_valid(self.__client_id, token)
 
         if 'preferred_username' in decoded_token:
@@ -0,0 +1,170 @@
+# Throughput comparison between the Flask app (waitress) and the ASGI app (uvicorn)
+# Both dispatchers route /response to a fake model server that answers after a fixed latency,
+# standing for a long generation. The same concurrent load is sent to each one.
+#
+# $ python -m benchmarks.asgi_vs_flask --requests 2000 --concurrency 1000 --latency 2
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import uvicorn
+import yaml
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Flask vs ASGI dispatcher throughput comparison')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of /response requests sent to each dispatcher')
+    parser.add_argument('--concurrency', type=int, default=1000, help='Number of requests in flight at the same time')
+    parser.add_argument('--latency', type=float, default=2, help='Seconds the fake model server takes to answer')
+    parser.add_argument('--waitress-threads', type=int, default=600, help='Waitress threads, as in waitress_orchestrator.py')
+    parser.add_argument('--serve-fake-llm', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_fake_llm(port, latency):
+    async def generate(request):
+        await request.body()
+        await asyncio.sleep(latency)
+        return Response('"generated text"', media_type='text/plain')
+
+    app = Starlette(routes=[Route('/response', generate, methods=['GET', 'POST']), Route('/healthz', lambda request: Response('OK'))])
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='error', access_log=False, backlog=4096)
+
+
+def write_workdir(llm_port):
+    workdir = tempfile.mkdtemp(prefix='liev-bench-')
+    endpoints = {
+        'llms': [{'name': 'fake', 'model': 'fake-model', 'url': f'http://127.0.0.1:{llm_port}/response',
+                  'username': 'username', 'password': 'changeme', 'response_mime': 'text/plain', 'is_external': False,
+                  'pool_maxsize': 4096, 'pool_connections': 4096}],
+        'types': [{'type': 'text', 'llms': [{'name': 'fake', 'priority': 1}]}],
+    }
+    with open(os.path.join(workdir, 'endpoints.yaml'), 'w') as f:
+        yaml.safe_dump(endpoints, f)
+    shutil.copy(os.path.join(REPO_DIR, 'users.yaml'), workdir)
+    return workdir
+
+
+async def wait_healthy(port):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            try:
+                async with session.get(f'http://127.0.0.1:{port}/healthz') as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    return False
+
+
+def start_process(command, workdir, port):
+    # The fake model server, and each dispatcher, run in their own process
+    env = {**os.environ, 'PYTHONPATH': REPO_DIR, 'LOG_LEVEL': 'WARNING', 'LLM_MANAGER_IMPL': 'endpoints_yaml',
+           'ENDPOINTS_YAML_RELOAD_INTERVAL': '0', 'TOXICITY_FILTER': 'false', 'AUTH_MODE': 'basic'}
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not asyncio.run(wait_healthy(port)):
+        process.kill()
+        raise Exception(f"Process did not start: {' '.join(command)}")
+    return process
+
+
+async def load(port, total, concurrency):
+    with open(os.path.join(REPO_DIR, 'users.yaml')) as f:
+        user = yaml.safe_load(f)[0]
+    token = base64.b64encode(f"{user['username']}:{user['password']}".encode()).decode()
+    headers = {'Authorization': f'Basic {token}'}
+    payload = json.dumps({'type': 'text', 'instruction': 'Hello'})
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers, connector=aiohttp.TCPConnector(limit=concurrency),
+                                     timeout=aiohttp.ClientTimeout(total=None)) as session:
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(f'http://127.0.0.1:{port}/response', data=payload) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(total)])
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'req/s': total / elapsed,
+        'p50 s': latencies[len(latencies) // 2],
+        'p99 s': latencies[int(len(latencies) * 0.99) - 1],
+        'errors': errors,
+    }
+
+
+def main():
+    args = parse_args()
+    if args.serve_fake_llm:
+        return serve_fake_llm(args.serve_fake_llm, args.latency)
+
+    llm_port = free_port()
+    workdir = write_workdir(llm_port)
+    fake_llm = start_process([sys.executable, '-m', 'benchmarks.asgi_vs_flask', '--serve-fake-llm', str(llm_port),
+                              '--latency', str(args.latency)], REPO_DIR, llm_port)
+
+    flask_port = free_port()
+    asgi_port = free_port()
+    dispatchers = {
+        f'flask (waitress, {args.waitress_threads} threads)': (
+            [sys.executable, '-c', f"from waitress import serve; import dispatcher; "
+                                   f"serve(dispatcher.app, host='127.0.0.1', port={flask_port}, threads={args.waitress_threads}, connection_limit={args.concurrency + 100})"],
+            flask_port),
+        'asgi (uvicorn, 1 worker)': (
+            [sys.executable, '-m', 'uvicorn', 'dispatcher_asgi:app', '--host', '127.0.0.1', '--port', str(asgi_port),
+             '--log-level', 'warning', '--no-access-log', '--backlog', '4096'],
+            asgi_port),
+    }
+
+    print(f'{args.requests} requests, {args.concurrency} concurrent, {args.latency}s model latency')
+    print(f"{'dispatcher':<36}{'req/s':>10}{'p50 s':>10}{'p99 s':>10}{'errors':>8}")
+    try:
+        for name, (command, port) in dispatchers.items():
+            process = start_process(command, workdir, port)
+            try:
+                result = asyncio.run(load(port, args.requests, args.concurrency))
+            finally:
+                process.terminate()
+                process.wait()
+            print(f"{name:<36}{result['req/s']:>10.1f}{result['p50 s']:>10.2f}{result['p99 s']:>10.2f}{result['errors']:>8}")
+    finally:
+        fake_llm.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Read cost benchmark for DynamoDBEndpointManager
+# Runs the manager against a local moto server and reports the DynamoDB calls and latency per request
+#
+# $ pip install -r requirements-dev.txt
+# $ python -m benchmarks.dynamodb_read_cost --endpoints 200 --types 4
+
+import argparse
+import collections
+import logging
+import os
+import sys
+import time
+
+import boto3
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    sys.exit('This benchmark needs moto, a development dependency: pip install -r requirements-dev.txt')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DynamoDBEndpointManager read cost benchmark')
+    parser.add_argument('--endpoints', type=int, default=200, help='Number of LLM endpoints to create')
+    parser.add_argument('--types', type=int, default=4, help='Number of prompt types each endpoint is registered in')
+    parser.add_argument('--rounds', type=int, default=20, help='Number of times each read is repeated')
+    parser.add_argument('--segments', type=int, default=1, help='Value for AWS_SCAN_SEGMENTS')
+    parser.add_argument('--port', type=int, default=5055, help='Port of the local moto server')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The moto server logs every request through werkzeug
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_REGION': 'us-east-1',
+        'AWS_ENDPOINT_TABLE_NAME': 'bench-endpoints',
+        'AWS_TYPE_TABLE_NAME': 'bench-types',
+        'AWS_DYNAMODB_ENDPOINT_URL': f'http://127.0.0.1:{args.port}',
+        'AWS_SCAN_SEGMENTS': str(args.segments),
+    })
+
+    # Count every DynamoDB operation sent by the clients created from the default session
+    calls = collections.Counter()
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call.dynamodb.*',
+                                          lambda model, **kwargs: calls.update([model.name]))
+
+    from liev_llm_manager.aws_dynamodb import DynamoDBEndpointManager
+    try:
+        manager = DynamoDBEndpointManager()
+        types = [f'type{t}' for t in range(args.types)]
+        for i in range(args.endpoints):
+            name = f'llm{i}'
+            manager.create_llm(name, 'model', f'http://localhost/{name}', 'user', 'pass', 'application/json')
+            for type in types:
+                manager.create_llm_type(name, type, i + 1)
+
+        reads = {
+            'get_all_llms': lambda: manager.get_all_llms(),
+            'get_all_llms_and_types': lambda: manager.get_all_llms_and_types(),
+            'get_llms_by_type': lambda: manager.get_llms_by_type(types[0]),
+            'get_llm_by_priority': lambda: manager.get_llm_by_priority(types[0], 1),
+            'get_failover_chain': lambda: manager.get_failover_chain(types[0]),
+        }
+
+        print(f'{args.endpoints} endpoints, {args.types} types, {args.segments} scan segment(s), {args.rounds} rounds')
+        print(f"{'read':<24}{'items':>8}{'calls/req':>12}{'ms/req':>10}  operations")
+        for read_name, read in reads.items():
+            calls.clear()
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                result = read()
+            elapsed = time.perf_counter() - start
+            items = len(result) if isinstance(result, list) else 1
+            operations = ', '.join(f'{op}={count / args.rounds:g}' for op, count in sorted(calls.items()))
+            print(f'{read_name:<24}{items:>8}{sum(calls.values()) / args.rounds:>12g}{elapsed * 1000 / args.rounds:>10.1f}  {operations}')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# CPU cost of assembling the combined answer of a multi-LLM ("all") request
+# Compares parsing every upstream answer and dumping the list (the former path) with splicing the raw bytes
+# (fast_json), with each JSON backend
+#
+# $ python -m benchmarks.multi_combine --llms 4 --size 200000
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'python')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Multi-LLM combined answer benchmark')
+    parser.add_argument('--llms', type=int, default=4, help='Number of LLM answers combined')
+    parser.add_argument('--size', type=int, default=200000, help='Characters of each generated text')
+    parser.add_argument('--rounds', type=int, default=50, help='Number of times the answer is combined')
+    return parser.parse_args()
+
+
+def parse_and_dump(answers):
+    combined = [json.loads(f'{{"name":"{name}", "response": {body.decode()}}}') for name, body in answers]
+    return json.dumps(combined).encode()
+
+
+def splice(fast_json, answers):
+    return fast_json.splice_array([fast_json.splice_object([('name', fast_json.dumps(name)), ('response', fast_json.raw_value(body))]) for name, body in answers])
+
+
+def measure(label, function, rounds, output_bytes):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    elapsed = (time.perf_counter() - started) / rounds
+    print(f'{label:<22} {elapsed * 1000:8.2f} ms  {output_bytes / elapsed / 1e6:8.1f} MB/s')
+
+
+def main():
+    args = parse_args()
+    text = ('Lorem ipsum "dolor" sit amet, consectetur ádipiscing elit.\n' * (args.size // 58 + 1))[:args.size]
+    answers = [(f'llm{i}(model)', json.dumps({'text': text, 'tokens': args.size // 4}).encode()) for i in range(args.llms)]
+    output_bytes = sum(len(body) for _, body in answers)
+    print(f'{args.llms} answers of {output_bytes // args.llms} bytes')
+
+    import controllers.fast_json as fast_json
+    measure('parse and dump', lambda: parse_and_dump(answers), args.rounds, output_bytes)
+    if fast_json.orjson is not None:
+        measure('splice (orjson)', lambda: splice(fast_json, answers), args.rounds, output_bytes)
+    orjson, fast_json.orjson = fast_json.orjson, None
+    measure('splice (json)', lambda: splice(fast_json, answers), args.rounds, output_bytes)
+    fast_json.orjson = orjson
+
+    # The spliced answer is the same document
+    assert json.loads(splice(fast_json, answers)) == json.loads(parse_and_dump(answers))
+
+
+if __name__ == '__main__':
+    main()
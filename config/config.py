@@ -1,5 +1,33 @@
 import os
+import logging
+import threading
+import time
 import etcd3
+from etcd3.events import DeleteEvent
+
+# Process-wide etcd clients, by (host, port), and config stores, by client id
+_etcd_clients = {}
+_etcd_stores = {}
+_etcd_lock = threading.Lock()
+
+def get_etcd_client(host=None, port=None):
+    """
+    Returns the etcd client shared by the whole process for the given host and port.
+    The client multiplexes every call over one gRPC channel, so it is safe to share between threads.
+
+    Parameters:
+    host (str, optional): The etcd host. Defaults to the ETCD_HOST env var or localhost.
+    port (str, optional): The etcd port. Defaults to the ETCD_PORT env var or 2379.
+
+    Returns:
+    etcd3.Etcd3Client: The shared client.
+    """
+    host = host or os.getenv('ETCD_HOST', 'localhost')
+    port = port or os.getenv('ETCD_PORT', '2379')
+    with _etcd_lock:
+        if (host, port) not in _etcd_clients:
+            _etcd_clients[(host, port)] = etcd3.client(host, port)
+        return _etcd_clients[(host, port)]
 
 class Config:
     """
@@ -48,14 +76,109 @@ class LocalConfig:
         """
         return os.getenv(key, default)
 
+class EtcdConfigStore:
+    """
+    In-memory copy of the /{client_id}/ keys of the etcd server.
+
+    The prefix is loaded with a single range request and kept current by a watch, so reads never go
+    to etcd. If the watch breaks, the last values keep being served while the store resynchronizes in background.
+    """
+
+    def __init__(self, client, client_id, resync_interval=5):
+        """
+        Loads the prefix and starts the watch.
+
+        Parameters:
+        client (etcd3.Etcd3Client): The shared etcd client.
+        client_id (str): The identifier used as key prefix.
+        resync_interval (int, optional): Seconds between resync attempts after a watch failure. Defaults to 5.
+        """
+        self._client = client
+        self._prefix = f"/{client_id}/"
+        self._resync_interval = resync_interval
+        self._logger = logging.getLogger("EtcdConfigStore")
+        self._lock = threading.Lock()
+        self._values = {}
+        self._watch_id = None
+        self._load()
+
+    def _load(self):
+        response = self._client.get_prefix_response(self._prefix)
+        values = {kv.key.decode('utf-8')[len(self._prefix):]: kv.value.decode('utf-8') for kv in response.kvs}
+        with self._lock:
+            self._values = values
+            self._watch_id = self._client.add_watch_prefix_callback(self._prefix, self._on_watch_response,
+                                                                    start_revision=response.header.revision + 1)
+
+    def _on_watch_response(self, watch_response):
+        if isinstance(watch_response, Exception):
+            self._logger.error(f"Config watch on {self._prefix} failed: {watch_response}. Serving the last values until resync")
+            threading.Thread(target=self._resync, daemon=True).start()
+            return
+        with self._lock:
+            values = dict(self._values)
+            for event in watch_response.events:
+                key = event.key.decode('utf-8')[len(self._prefix):]
+                if isinstance(event, DeleteEvent):
+                    values.pop(key, None)
+                    continue
+                try:
+                    values[key] = event.value.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    # The previous value of the key is kept
+                    self._logger.error(f"Config watch on {self._prefix} skipped {key}: {e}")
+            self._values = values
+
+    def _resync(self):
+        try:
+            self._client.cancel_watch(self._watch_id)
+        except Exception:
+            pass
+        while True:
+            try:
+                self._load()
+                return
+            except Exception as e:
+                self._logger.error(f"Config resync on {self._prefix} failed: {e}. Retrying in {self._resync_interval}s")
+                time.sleep(self._resync_interval)
+
+    def get(self, key: str):
+        return self._values.get(key)
+
+    def put(self, key: str, value: str):
+        self._client.put(f"{self._prefix}{key}", value)
+        # Visible at once to this process. The watch event will write the same value again
+        with self._lock:
+            self._values = {**self._values, key: value}
+
+    def drop(self, key: str):
+        self._client.delete(f"{self._prefix}{key}")
+        with self._lock:
+            self._values = {k: v for k, v in self._values.items() if k != key}
+
+def get_etcd_config_store(client_id):
+    """
+    Returns the config store shared by the whole process for the given client id, loading it on first use.
+    """
+    with _etcd_lock:
+        store = _etcd_stores.get(client_id)
+    if store is not None:
+        return store
+    client = get_etcd_client()
+    with _etcd_lock:
+        if client_id not in _etcd_stores:
+            _etcd_stores[client_id] = EtcdConfigStore(client, client_id)
+        return _etcd_stores[client_id]
+
 class EtcdConfig:
     """
     EtcdConfig class to fetch configuration settings from an etcd server.
+    Every instance with the same client id shares one EtcdConfigStore, so only the first one touches etcd.
     """
 
     def __init__(self, client_id):
         """
-        Initializes the EtcdConfig class by connecting to the etcd server using the host and port specified in environment variables.
+        Initializes the EtcdConfig class with the process-wide store of the client id.
         
         Parameters:
         id (str): Identifier used for initialization.
@@ -63,7 +186,7 @@ class EtcdConfig:
 
         if client_id is None:
             raise Exception('EtcdConfig must have a client id') 
-        self._client = etcd3.client(os.getenv('ETCD_HOST', 'localhost'), os.getenv('ETCD_PORT', '2379'))
+        self._store = get_etcd_config_store(client_id)
         self._client_id = client_id
 
     def get(self, key: str, default: str = None):
@@ -82,10 +205,10 @@ class EtcdConfig:
         if value is not None:
             return value
         
-        # If not found in environment variables, check in etcd
-        etcd_value = self._client.get(f"/{self._client_id}/{key}")[0]
+        # If not found in environment variables, check in the local copy of etcd
+        etcd_value = self._store.get(key)
         if etcd_value is not None:
-            return etcd_value.decode('utf-8')
+            return etcd_value
         
         # If not found in etcd, return the default value
         return default
@@ -98,7 +221,7 @@ class EtcdConfig:
         key (str): The key to set in the etcd server.
         value (str): The value to set for the specified key.
         """
-        self._client.put(f"/{self._client_id}/{key}", value)
+        self._store.put(key, value)
 
     def drop(self, key: str):
         """
@@ -107,4 +230,4 @@ class EtcdConfig:
         Parameters:
         key (str): The key to remove from the etcd server.
         """
-        self._client.delete(f"/{self._client_id}/{key}")
+        self._store.drop(key)
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from config.config import Config
+
+
+class CircuitBreaker:
+    """
+    Circuit breakers of the upstream LLMs, one per endpoint name.
+
+    closed: calls go through. After CIRCUIT_FAILURE_THRESHOLD consecutive failures, the circuit opens.
+    open: calls are refused without a network call, for CIRCUIT_COOLDOWN seconds. Then the circuit is half-open.
+    half_open: one trial call goes through. Its success closes the circuit, its failure opens it again.
+    A trial that never reports back, such as a cancelled hedge, is replaced after the cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__enabled = self.__config.get('CIRCUIT_BREAKER', 'true').lower() in ("yes", "true", "t", "1")
+        self.__failure_threshold = int(self.__config.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+        self.__cooldown = float(self.__config.get('CIRCUIT_COOLDOWN', '30'))
+        self.__lock = threading.Lock()
+        # LLM name -> {'state', 'failures', 'opened', 'trial'}
+        self.__circuits = {}
+
+    def allow(self, llm):
+        """
+        Whether a call to the LLM may go through. In half-open state, only the trial call is allowed.
+        """
+        if not self.__enabled:
+            return True
+        now = time.monotonic()
+        with self.__lock:
+            circuit = self.__circuits.get(llm['name'])
+            if circuit is None or circuit['state'] == self.CLOSED:
+                return True
+            if circuit['state'] == self.OPEN:
+                if now - circuit['opened'] < self.__cooldown:
+                    return False
+                circuit['state'] = self.HALF_OPEN
+                circuit['trial'] = None
+            if circuit['trial'] is not None and now - circuit['trial'] < self.__cooldown:
+                return False
+            circuit['trial'] = now
+            return True
+
+    def release_trial(self, llm):
+        """
+        Gives back the half-open trial taken by allow for a call that was never made, such as one shed by the
+        concurrency limiter, so the next call may take it.
+        """
+        if not self.__enabled:
+            return
+        with self.__lock:
+            circuit = self.__circuits.get(llm['name'])
+            if circuit is not None and circuit['state'] == self.HALF_OPEN:
+                circuit['trial'] = None
+
+    def is_open(self, llm):
+        """
+        Whether the circuit refuses the calls to the LLM, still cooling down. Unlike allow, it does not take the
+        half-open trial: use it to filter or re-check the LLMs.
+        """
+        if not self.__enabled:
+            return False
+        with self.__lock:
+            circuit = self.__circuits.get(llm['name'])
+            return circuit is not None and circuit['state'] == self.OPEN and time.monotonic() - circuit['opened'] < self.__cooldown
+
+    def record(self, llm, status_code):
+        """Records the outcome of a call that got an answer. Server errors and 429 count as failures"""
+        if status_code >= 500 or status_code == 429:
+            self.record_failure(llm)
+        else:
+            self.record_success(llm)
+
+    def record_success(self, llm):
+        if not self.__enabled:
+            return
+        with self.__lock:
+            circuit = self.__circuits.pop(llm['name'], None)
+        if circuit is not None and circuit['state'] != self.CLOSED:
+            self.__logger.info(f"Circuit of {llm['name']} closed")
+
+    def record_failure(self, llm):
+        if not self.__enabled:
+            return
+        with self.__lock:
+            circuit = self.__circuits.setdefault(llm['name'], {'state': self.CLOSED, 'failures': 0, 'opened': None, 'trial': None})
+            circuit['failures'] += 1
+            if circuit['state'] == self.OPEN:
+                return
+            if circuit['state'] == self.HALF_OPEN or circuit['failures'] >= self.__failure_threshold:
+                circuit['state'] = self.OPEN
+                circuit['opened'] = time.monotonic()
+                circuit['trial'] = None
+            else:
+                return
+        self.__logger.warning(f"Circuit of {llm['name']} opened after {circuit['failures']} consecutive failures, for {self.__cooldown}s")
+
+    def state(self, llm):
+        with self.__lock:
+            circuit = self.__circuits.get(llm['name'])
+            return circuit['state'] if circuit is not None else self.CLOSED
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from config.config import Config
+from exception.exceptions import ConcurrencyLimitException
+
+
+class ConcurrencyLimiter:
+    """
+    Adaptive limit of the calls in flight to each upstream LLM, so a slow model server cannot hold every
+    dispatcher thread or connection.
+
+    The limit of an LLM follows AIMD: it grows by 1/limit on each answer within CONCURRENCY_LATENCY_TOLERANCE
+    times its usual response time, and it is multiplied by CONCURRENCY_BACKOFF on failures and slower answers,
+    at most once per response time. It stays between CONCURRENCY_MIN_LIMIT and CONCURRENCY_MAX_LIMIT, or the
+    max_concurrency field of the LLM record.
+
+    A call beyond the limit waits in a queue of CONCURRENCY_QUEUE_SIZE calls, for CONCURRENCY_QUEUE_TIMEOUT_MS
+    at most. Then it is refused with ConcurrencyLimitException.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__enabled = self.__config.get('CONCURRENCY_LIMIT', 'true').lower() in ("yes", "true", "t", "1")
+        self.__initial_limit = float(self.__config.get('CONCURRENCY_INITIAL_LIMIT', '50'))
+        self.__min_limit = float(self.__config.get('CONCURRENCY_MIN_LIMIT', '5'))
+        self.__max_limit = float(self.__config.get('CONCURRENCY_MAX_LIMIT', '1000'))
+        self.__backoff = float(self.__config.get('CONCURRENCY_BACKOFF', '0.9'))
+        self.__tolerance = float(self.__config.get('CONCURRENCY_LATENCY_TOLERANCE', '2'))
+        self.__queue_size = int(self.__config.get('CONCURRENCY_QUEUE_SIZE', '10'))
+        self.__queue_timeout = float(self.__config.get('CONCURRENCY_QUEUE_TIMEOUT_MS', '100')) / 1000
+        # What a refused request does: 'failover' to the next priority LLM, or 'reject' with a 503
+        self.failover = self.__config.get('CONCURRENCY_OVERFLOW', 'failover') == 'failover'
+        self.retry_after = self.__config.get('CONCURRENCY_RETRY_AFTER', '1')
+        self.__lock = threading.Lock()
+        self.__condition = threading.Condition(self.__lock)
+        # LLM name -> {'limit', 'in_flight', 'waiting', 'baseline', 'decreased', 'async_waiters'}
+        self.__limits = {}
+
+    def acquire(self, llm):
+        """
+        Takes a slot for a call to the LLM, waiting in the queue if needed.
+
+        Raises:
+            ConcurrencyLimitException: If the LLM is at its limit and the queue is full or the wait timed out.
+        """
+        if not self.__enabled:
+            return
+        with self.__condition:
+            state = self.__state(llm)
+            if self.__try_acquire(llm, state):
+                return
+            if state['waiting'] >= self.__queue_size:
+                raise ConcurrencyLimitException(f"{llm['name']} is at its concurrency limit of {int(state['limit'])}")
+            state['waiting'] += 1
+            try:
+                expires = time.monotonic() + self.__queue_timeout
+                while not self.__try_acquire(llm, state):
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        raise ConcurrencyLimitException(f"{llm['name']} is at its concurrency limit of {int(state['limit'])}")
+                    self.__condition.wait(remaining)
+            finally:
+                state['waiting'] -= 1
+
+    async def acquire_async(self, llm):
+        """Same as acquire, without blocking the event loop"""
+        if not self.__enabled:
+            return
+        loop = asyncio.get_running_loop()
+        expires = loop.time() + self.__queue_timeout
+        waiting = False
+        try:
+            while True:
+                with self.__lock:
+                    state = self.__state(llm)
+                    if self.__try_acquire(llm, state):
+                        return
+                    if not waiting and state['waiting'] >= self.__queue_size:
+                        raise ConcurrencyLimitException(f"{llm['name']} is at its concurrency limit of {int(state['limit'])}")
+                    # Checked before queueing a waiter, so none is left behind for release to wake
+                    remaining = expires - loop.time()
+                    if remaining <= 0:
+                        raise ConcurrencyLimitException(f"{llm['name']} is at its concurrency limit of {int(state['limit'])}")
+                    if not waiting:
+                        state['waiting'] += 1
+                        waiting = True
+                    waiter = loop.create_future()
+                    state['async_waiters'].append(waiter)
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if waiting:
+                with self.__lock:
+                    state['waiting'] -= 1
+
+    def release(self, llm, seconds=None, failed=False):
+        """
+        Frees the slot of a call to the LLM and adapts its limit.
+
+        Args:
+            llm (dict): The LLM record.
+            seconds (float): The response time of a successful call. None when unknown, e.g. streams.
+            failed (bool): Whether the call failed (connection error, timeout or 5xx answer).
+        """
+        if not self.__enabled:
+            return
+        now = time.monotonic()
+        with self.__condition:
+            state = self.__state(llm)
+            state['in_flight'] -= 1
+            baseline = state['baseline']
+            if failed or (seconds is not None and baseline is not None and seconds > baseline * self.__tolerance):
+                # Multiplicative decrease, at most once per response time, so one burst of slow answers counts once
+                if now - state['decreased'] >= (baseline or 1):
+                    state['limit'] = max(min(self.__min_limit, self.__max_limit_of(llm)), state['limit'] * self.__backoff)
+                    state['decreased'] = now
+            elif seconds is not None:
+                state['limit'] = min(self.__max_limit_of(llm), state['limit'] + 1 / state['limit'])
+            if seconds is not None:
+                # The usual response time, a slow moving average
+                state['baseline'] = seconds if baseline is None else 0.05 * seconds + 0.95 * baseline
+
+            self.__condition.notify()
+            self.__notify_async(state)
+
+    def __notify_async(self, state):
+        # Wakes the first async waiter still waiting. Called with the lock held
+        while state['async_waiters']:
+            waiter = state['async_waiters'].popleft()
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(self.__wake, state, waiter)
+                break
+
+    def __try_acquire(self, llm, state):
+        if state['in_flight'] < max(int(state['limit']), 1):
+            state['in_flight'] += 1
+            return True
+        return False
+
+    def __state(self, llm):
+        state = self.__limits.get(llm['name'])
+        if state is None:
+            state = {'limit': min(self.__initial_limit, self.__max_limit_of(llm)), 'in_flight': 0, 'waiting': 0,
+                     'baseline': None, 'decreased': 0, 'async_waiters': deque()}
+            self.__limits[llm['name']] = state
+        return state
+
+    def __max_limit_of(self, llm):
+        return min(self.__max_limit, float(llm.get('max_concurrency') or self.__max_limit))
+
+    def __wake(self, state, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+        # The waiter timed out or was cancelled before the wake-up: it goes to the next one
+        with self.__lock:
+            self.__notify_async(state)
@@ -0,0 +1,180 @@
+import asyncio
+import time
+from contextlib import contextmanager
+import aiohttp
+import requests
+from config.config import Config
+from exception.exceptions import DeadlineExceededException
+
+# aiohttp tells the connect timeouts from the read ones since 3.10
+_ASYNC_CONNECT_TIMEOUT = getattr(aiohttp, 'ConnectionTimeoutError', ())
+_ASYNC_READ_TIMEOUT = getattr(aiohttp, 'SocketTimeoutError', ())
+
+
+class Timeouts(tuple):
+    """
+    The (connect, read) timeouts of a call in seconds, as passed to requests and AsyncSessionPool. connect_capped
+    and read_capped tell whether the request deadline shortened them below the LLM's own. budget is the share of
+    the deadline the call may use, None without a deadline. expires is when the request deadline runs out, as a
+    time.monotonic() value: the timeouts bound each network operation, the pools stop reading the answer there.
+    """
+
+    def __new__(cls, connect, read, connect_capped=False, read_capped=False, budget=None, expires=None):
+        timeouts = super().__new__(cls, (connect, read))
+        timeouts.connect_capped = connect_capped
+        timeouts.read_capped = read_capped
+        timeouts.budget = budget
+        timeouts.expires = expires
+        return timeouts
+
+    def remaining(self):
+        """Seconds left before the request deadline, or None without a deadline"""
+        if self.expires is None:
+            return None
+        return max(self.expires - time.monotonic(), 0)
+
+    def split(self, elapsed, parts):
+        """
+        The timeouts of the next of several calls made in turn within this budget, such as the replicas of an LLM.
+
+        Args:
+            elapsed (float): The seconds used by the calls already made.
+            parts (int): The calls left, this one included. The budget left is split evenly across them.
+
+        Raises:
+            DeadlineExceededException: If no budget is left.
+        """
+        if self.budget is None:
+            return self
+        budget = self.budget - elapsed
+        if budget <= 0:
+            raise DeadlineExceededException()
+        budget /= max(parts, 1)
+        return Timeouts(min(self[0], budget), min(self[1], budget), self.connect_capped or budget < self[0], self.read_capped or budget < self[1], budget, self.expires)
+
+
+def caused_by_deadline(exception, timeout=None):
+    """
+    Whether a call failed because of the request deadline rather than the LLM: the deadline expired, or the timeout
+    that fired was shortened by it.
+
+    Args:
+        exception (Exception): The error of the call.
+        timeout (Timeouts): The timeouts of the call.
+
+    Returns:
+        bool: True if the deadline caused the failure.
+    """
+    if isinstance(exception, DeadlineExceededException):
+        return True
+    if not isinstance(timeout, Timeouts):
+        return False
+    if isinstance(exception, (requests.exceptions.Timeout, asyncio.TimeoutError)) and timeout.remaining() == 0:
+        return True
+    if isinstance(exception, (requests.exceptions.ConnectTimeout, _ASYNC_CONNECT_TIMEOUT)):
+        return timeout.connect_capped
+    if isinstance(exception, (requests.exceptions.ReadTimeout, _ASYNC_READ_TIMEOUT)):
+        return timeout.read_capped
+    if isinstance(exception, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+        return timeout.connect_capped or timeout.read_capped
+    return False
+
+
+class Deadline:
+    """
+    End-to-end budget of one dispatcher request, shared by the toxicity check, the prompt detection and each
+    failover attempt.
+
+    The budget comes from the Liev-Deadline-Ms request header, or from the REQUEST_DEADLINE_MS config value.
+    Without either, there is no deadline and only the per-LLM timeouts apply. Every stage records the time it
+    used, reported back in the Liev-Stage-Ms response header.
+    """
+
+    header_name = 'Liev-Deadline-Ms'
+
+    def __init__(self, budget_ms=None):
+        self.__config = Config('dispatcher')
+        self.__started = time.monotonic()
+        self.__expires = self.__started + budget_ms / 1000 if budget_ms else None
+        self.__stages = []
+        # Per-LLM defaults, when the endpoint record has no connect_timeout/read_timeout. Seconds
+        self.__connect_timeout = float(self.__config.get('LLM_CONNECT_TIMEOUT', '10'))
+        self.__read_timeout = float(self.__config.get('LLM_READ_TIMEOUT', '600'))
+        # Share of the remaining budget the toxicity check and the prompt detection may use
+        self.__classifier_share = float(self.__config.get('DEADLINE_CLASSIFIER_SHARE', '0.25'))
+        # Below this remaining budget, the prompt detection is skipped
+        self.__min_detect_ms = float(self.__config.get('DEADLINE_MIN_DETECT_MS', '2000'))
+
+    @classmethod
+    def from_headers(cls, headers):
+        """
+        Builds the deadline of a request from its headers. An invalid header value is ignored.
+        """
+        budget_ms = headers.get(cls.header_name) or Config('dispatcher').get('REQUEST_DEADLINE_MS')
+        try:
+            budget_ms = float(budget_ms) if budget_ms else None
+        except ValueError:
+            budget_ms = None
+        return cls(budget_ms if budget_ms and budget_ms > 0 else None)
+
+    def remaining(self):
+        """Remaining budget in seconds, or None without a deadline"""
+        if self.__expires is None:
+            return None
+        return max(self.__expires - time.monotonic(), 0)
+
+    def expired(self):
+        return self.__expires is not None and time.monotonic() >= self.__expires
+
+    def can_detect(self):
+        remaining = self.remaining()
+        return remaining is None or remaining * 1000 >= self.__min_detect_ms
+
+    def timeouts(self, llm, share=1.0):
+        """
+        Connect and read timeouts for a call to the LLM, capped by its share of the remaining budget.
+
+        Args:
+            llm (dict): The LLM record. Its connect_timeout and read_timeout fields override the defaults.
+            share (float): The fraction of the remaining budget this call may use.
+
+        Returns:
+            Timeouts: (connect timeout, read timeout) in seconds.
+
+        Raises:
+            DeadlineExceededException: If no budget is left.
+        """
+        connect_timeout = float(llm.get('connect_timeout') or self.__connect_timeout)
+        read_timeout = float(llm.get('read_timeout') or self.__read_timeout)
+        remaining = self.remaining()
+        if remaining is None:
+            return Timeouts(connect_timeout, read_timeout)
+        if remaining <= 0:
+            raise DeadlineExceededException()
+        budget = remaining * share
+        return Timeouts(min(connect_timeout, budget), min(read_timeout, budget), budget < connect_timeout, budget < read_timeout, budget, self.__expires)
+
+    def classifier_timeouts(self, llm):
+        """Timeouts for the toxicity check and the prompt detection"""
+        return self.timeouts(llm, self.__classifier_share)
+
+    def attempt_timeouts(self, llm, candidates_left):
+        """Timeouts for a failover attempt. The remaining budget is split evenly across the candidates left"""
+        return self.timeouts(llm, 1.0 / max(candidates_left, 1))
+
+    @contextmanager
+    def stage(self, name):
+        """Records the time used by the stage, even when it fails"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.__stages.append((name, int((time.monotonic() - started) * 1000)))
+
+    def headers(self):
+        """The response headers reporting the budget used by each stage and what is left"""
+        headers = {'Liev-Stage-Ms': ','.join(f'{name}={ms}' for name, ms in self.__stages)}
+        remaining = self.remaining()
+        if remaining is not None:
+            headers['Liev-Deadline-Remaining-Ms'] = str(int(remaining * 1000))
+        return headers
@@ -1,14 +1,34 @@
 import json
 import logging
 import os
-import requests
 from config.config import Config
 import controllers.constants as constants
 import concurrent.futures
+import contextlib
+import functools
+import time
+import requests
+from collections import deque
 
-from exception.exceptions import FimNotSupportedException, HttpStreamingNotSupportedException
+from exception.exceptions import FimNotSupportedException, HttpStreamingNotSupportedException, DeadlineExceededException, CircuitOpenException, LLMUnhealthyException, ConcurrencyLimitException, ToxicPromptException
+from controllers.deadline import Deadline, caused_by_deadline
 from liev_llm_manager.manager import get_manager
-from requests.auth import HTTPBasicAuth as HTTPBasicAuthServer
+from controllers.session_pool import SessionPool
+from controllers.hedging import HedgePolicy
+from controllers.circuit_breaker import CircuitBreaker
+from controllers.health_checker import get_health_checker
+from controllers.load_balancer import LoadBalancer
+from controllers.replica_pool import ReplicaPool
+from controllers.concurrency_limiter import ConcurrencyLimiter
+from controllers.retry_policy import RetryPolicy
+from controllers.metrics import get_metrics
+import controllers.multi_stream as multi_stream
+import controllers.fast_json as fast_json
+from controllers.payload import Payload
+from controllers.response_cache import ResponseCache
+from controllers.similarity_cache import SimilarityCache
+from controllers.prompt_classifier import PromptClassifier
+from controllers.toxicity_prefilter import ToxicityPrefilter
 from flask import Response, request as flask_request
 
 
@@ -31,12 +51,58 @@ class DispatcherController:
         # Initialize the LLM manager
         self.__manager = get_manager()
 
+        # Keep-alive HTTP sessions, one per upstream LLM
+        self.__sessions = SessionPool()
+
+        # Circuit breakers of the upstream LLMs. Open ones are skipped without a network call
+        self.__breakers = CircuitBreaker()
+
+        # Health of the upstream LLMs, from the background prober
+        self.__health = get_health_checker()
+
+        # Spreads the requests across the LLMs sharing a priority
+        self.__balancer = LoadBalancer()
+
+        # Replicas of the LLMs serving one name from several model servers
+        self.__replicas = ReplicaPool()
+
+        # Adaptive limits of the calls in flight to each LLM, so one slow model cannot take every thread
+        self.__limiter = ConcurrencyLimiter()
+
+        # Retries on the same LLM before the failover, for its brief errors
+        self.__retries = RetryPolicy()
+        self.__metrics = get_metrics()
+
+        # Answers of the repeated deterministic prompts
+        self.__cache = ResponseCache()
+        # And of the near-duplicate ones
+        self.__similar = SimilarityCache()
+
+        # Hedged requests to the next priority LLM, for the latency critical types
+        self.__hedging = HedgePolicy()
+        self.__hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(self.__config.get('HEDGE_MAX_WORKERS', '100')), thread_name_prefix='hedge')
+
+        # The calls of the multi-LLM requests share one bounded pool, each request using a few of its threads at most
+        self.__fanout_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(self.__config.get('FANOUT_MAX_WORKERS', '64')), thread_name_prefix='fanout')
+        self.__fanout_per_request = int(self.__config.get('FANOUT_MAX_PER_REQUEST', '8'))
+
         # Initialize Toxicity
         self.__toxicity_filter = self.__str_to_bool(self.__config.get('TOXICITY_FILTER', 'false'))
         if (self.__toxicity_filter):
             self.__toxicity_message="This message contains toxic language and is not allowed.\nEsta mensagem contém linguagem tóxica e não é permitida.\nEste mensaje contiene lenguaje tóxico y no está permitido."
+            # Term lists and cached verdicts, answering the clear cases without the toxicity LLM
+            self.__toxicity_prefilter = ToxicityPrefilter()
+            # The toxicity checks run alongside the prompt detection and, with GUARDRAIL_SPECULATIVE, the LLM call
+            self.__guardrail_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(self.__config.get('GUARDRAIL_MAX_WORKERS', '100')), thread_name_prefix='guardrail')
         else:
             self.__logger.warn('Toxicity filter is disabled! Counting only with model protections.')
+        self.__guardrail_speculative = self.__str_to_bool(self.__config.get('GUARDRAIL_SPECULATIVE', 'false'))
+
+        # The type used when the prompt detection is skipped because the request deadline is too close
+        self.__detect_fallback_type = self.__config.get('DETECT_FALLBACK_TYPE', 'text')
+
+        # Cached detections and a local classifier, answering the easy prompts without the detect LLM
+        self.__classifier = PromptClassifier()
 
     def get_response(self, data, auth, is_fim = False, stream = False):
         """
@@ -50,9 +116,34 @@ class DispatcherController:
             Tuple: Response content, status code, and response headers.
         """
 
-        # Filter Toxicity
-        if (self.__is_prompt_toxic(data, auth)):
-            return self.__toxicity_message, 400
+        # The end-to-end budget of the request, split across toxicity, detection and each failover attempt
+        deadline = Deadline.from_headers(flask_request.headers)
+
+        # The body sent to the LLMs, the original bytes when no LLM overlay applies. data itself is never changed
+        payload = Payload(data, flask_request.get_data())
+
+        # Filter Toxicity. The check runs in the background, and the answer is only returned once the prompt is known not to be toxic
+        toxicity = None
+        if self.__toxicity_filter:
+            log_prefix = f'LLM Request: {flask_request.method} {flask_request.path}'
+            log_user = f'Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}'
+            toxicity = self.__guardrail_executor.submit(self.__is_prompt_toxic, data, log_prefix, log_user, deadline)
+
+        response = self.__get_response(data, auth, is_fim, stream, deadline, payload, toxicity)
+        # A speculative answer to a toxic prompt is discarded. The calls not made yet were skipped on the verdict, see __refused
+        if toxicity is not None:
+            refusal = self.__toxicity_refusal(toxicity.result(), deadline)
+            if refusal is not None:
+                return refusal
+        return response
+
+    def __get_response(self, data, auth, is_fim, stream, deadline, payload, toxicity):
+        """
+        Processes a request once its deadline and payload are set. See get_response.
+
+        Args:
+            toxicity (Future): The toxicity check in flight, or None without the toxicity filter.
+        """
 
         # Whether the user wants the failover or not
         try_next_on_failure = data.get('try_next_on_failure', True)
@@ -78,17 +169,36 @@ class DispatcherController:
         # The flag indicating when a failover occurs. This will be returned in the Liev-Response-Is-Failover header in the end
         is_failover_response = False
 
-        # Start searching the LLM for the type specified by the first priority
-        current_priority = 1
+        # The flag indicating when the hedge LLM answered first. This will be returned in the Liev-Response-Is-Hedge header in the end
+        is_hedge_response = False
+
+        # The calls retried on the same LLM, one entry per retry. Their number will be returned in the Liev-Response-Retries header in the end
+        retried_llms = []
+
+        # The LLMs of the type ordered by priority, resolved once. The failover walks this chain locally
+        failover_chain = deque()
 
         # An list of failed failover LLMs. This will be returned in the Liev-Response-Failed-Models header in the end
         failed_llms = []
 
 
-        # If type is set to "detect", enter the prompt detection flow
-        if type_str == "detect":
+        # If type is set to "detect", enter the prompt detection flow. The fast path needs no budget
+        fast_type = self.__classify_prompt(data) if type_str == "detect" else None
+        if fast_type is not None:
+            type_str = fast_type
+        elif type_str == "detect" and not deadline.can_detect():
+            self.__logger.warning(f'Type not informed, but the deadline is too close for prompt detection. Using type {self.__detect_fallback_type}')
+            type_str = self.__detect_fallback_type
+        elif type_str == "detect":
             self.__logger.debug('Type not informed. Prompt detection needed.')
-            type_str = self.__detect_prompt(data, auth)
+            with deadline.stage('detect'):
+                type_str = self.__detect_prompt(data, auth, deadline)
+
+        # Without speculation, the LLMs are only called once the prompt is known not to be toxic. Streams never speculate
+        if toxicity is not None and (stream or not self.__guardrail_speculative):
+            refusal = self.__toxicity_refusal(toxicity.result(), deadline)
+            if refusal is not None:
+                return refusal
 
         # Declare a list of choosen llms that will be used
         chosen_llms = []
@@ -112,7 +222,9 @@ class DispatcherController:
                             chosen_llms.append(llm)
                             self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
                         elif llm is None and try_next_on_failure: 
-                            chosen_llms.append(self.__manager.get_llm_by_priority(type_str, current_priority))
+                            llm_name = None
+                            failover_chain = self.__get_failover_chain(type_str)
+                            chosen_llms.append(failover_chain.popleft())
                             self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
                         else:
                            raise Exception(f"LLM not found")
@@ -121,13 +233,16 @@ class DispatcherController:
                             self.__logger.error(f'Error calling {llm_name}: {e}. Won\'t trying failover - Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
                             return f"No LLMs were available to process the request. Won't trying failover. Error message: {str(e)}", 500
                         else:
-                            chosen_llms.append(self.__manager.get_llm_by_priority(type_str, current_priority))
+                            llm_name = None
+                            failover_chain = self.__get_failover_chain(type_str)
+                            chosen_llms = [failover_chain.popleft()]
                             self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
                     
 
-            # If the payload doesn't contain the LLM name, let's get from the manager the LLM in the current priority for the given type
+            # If the payload doesn't contain the LLM name, let's get from the manager the failover chain for the given type
             else:
-                chosen_llms.append(self.__manager.get_llm_by_priority(type_str, current_priority))
+                failover_chain = self.__get_failover_chain(type_str)
+                chosen_llms.append(failover_chain.popleft())
                 self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
         except Exception as e:
             self.__logger.error(f'LLM Request: {flask_request.method} {flask_request.path} Type: {type_str}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
@@ -142,19 +257,70 @@ class DispatcherController:
             response_content = ''
             response_code = None
 
+            # A cached answer of the chosen LLM to the same payload is returned without calling it
+            use_cache = self.__cache.applies(type_str, data, stream)
+            cached = None
+            cache_status = 'hit'
+            if use_cache:
+                cached = self.__cache.get(self.__cache.key(chosen_llm, payload, is_fim))
+                self.__metrics.increment('cache_hits' if cached is not None else 'cache_misses', chosen_llm)
+
+            # Or its answer to a near-duplicate prompt. A sample of these hits still calls the LLM, to count the false positives
+            use_similar = cached is None and self.__similar.applies(type_str, data, stream)
+            similar = None
+            similar_llm = chosen_llm
+            if use_similar:
+                similar = self.__similar.get(type_str, chosen_llm, data)
+                self.__metrics.increment('similar_hits' if similar is not None else 'similar_misses', chosen_llm)
+                if similar is not None and not similar[2]:
+                    cached, cache_status = similar[0], 'similar'
+
+            if cached is not None:
+                self.__logger.info(f'LLM Request: {flask_request.method} {flask_request.path} LLM_Name: {chosen_llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}, Response_Bytes: {len(cached)}, Cache: {cache_status}')
+                cache_headers = {
+                    'Content-Type': chosen_llm['response_mime'],
+                    'Liev-Response-Model': f"{chosen_llm['name']}({chosen_llm['model']})",
+                    'Liev-Response-Is-Failover': False,
+                    'Liev-Response-Is-Hedge': False,
+                    'Liev-Response-Retries': 0,
+                    'Liev-Response-Failed-Models': '',
+                    'Liev-Response-Cache': cache_status,
+                    **deadline.headers()
+                }
+                if similar is not None:
+                    cache_headers['Liev-Response-Cache-Similarity'] = f'{similar[1]:.3f}'
+                return cached, 200, cache_headers
+
             # While I don't have an answer from an LLM
             while not processed:
                 try:
-                    # Call the LLM
-                    response = self.__call_llm(chosen_llm, data, is_fim, stream)
+                    # A speculative request stops before each attempt once the prompt is found toxic
+                    if self.__refused(toxicity):
+                        raise ToxicPromptException()
+                    # An unhealthy LLM is skipped, unless it is the last candidate
+                    if failover_chain and not self.__health.is_healthy(chosen_llm, 'http_stream_url' if stream else 'url'):
+                        raise LLMUnhealthyException(f"{chosen_llm['name']} failed its health checks. Not calling it")
+                    if not self.__breakers.allow(chosen_llm):
+                        raise CircuitOpenException(f"The circuit of {chosen_llm['name']} is open. Not calling it")
+                    with deadline.stage(chosen_llm['name']):
+                        # For the latency critical types, race the next priority LLM when this one is slow
+                        if not stream and try_next_on_failure and self.__hedging.should_hedge(type_str, len(failover_chain)):
+                            answered_llm, response = self.__call_llm_hedged(chosen_llm, failover_chain, payload, is_fim, deadline, failed_llms, toxicity)
+                            if answered_llm is not chosen_llm:
+                                is_failover_response = is_hedge_response = True
+                                chosen_llm = answered_llm
+                        else:
+                            # Call the LLM, with its share of the remaining budget, retrying its brief errors
+                            response = self.__call_llm_retried(chosen_llm, payload, is_fim, stream, deadline, len(failover_chain) + 1 if try_next_on_failure else 1, retried_llms, toxicity)
+                        response_code = response.status_code
+                        if (stream == False):
+                            response_content = response.content
 
                     # Set the response type based on chosen llm information
                     response_mime = chosen_llm['response_mime']
 
                     # If sync http , get the response content and responde code
-                    response_code = response.status_code
                     if (stream == False):
-                        response_content = response.content
                         self.__logger.info(f'LLM Request: {flask_request.method} {flask_request.path} LLM_Name: {chosen_llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
 
 
@@ -162,32 +328,65 @@ class DispatcherController:
                     if response_code != 200:
                         raise Exception(f"Response code not successful: {response_code} {response_content}")
 
+                    if (stream == False):
+                        self.__hedging.record(chosen_llm, response.elapsed.total_seconds())
+                        # A speculative answer is only cached once the prompt is known not to be toxic
+                        if (use_cache or use_similar) and toxicity is not None and toxicity.result() is not False:
+                            use_cache = use_similar = False
+                        if use_cache:
+                            self.__cache.put(self.__cache.key(chosen_llm, payload, is_fim), response_content)
+                        if use_similar:
+                            if similar is not None and similar_llm is chosen_llm:
+                                # A sampled similarity hit. The LLM should have given the cached answer
+                                self.__metrics.increment('similar_verified', chosen_llm)
+                                if response_content != similar[0]:
+                                    self.__metrics.increment('similar_false_positives', chosen_llm)
+                                    self.__similar.put(chosen_llm, data, response_content)
+                            else:
+                                self.__similar.put(chosen_llm, data, response_content)
+
                     
                 
                 # Oops, got problems on calling the current LLM
                 except Exception as e:
 
+                    if isinstance(e, ToxicPromptException):
+                        return self.__toxicity_refusal(toxicity.result(), deadline)
+
+                    # No budget left for another attempt
+                    if isinstance(e, DeadlineExceededException) or deadline.expired():
+                        self.__logger.error(f'Error calling {chosen_llm["name"]}: {e}. Request deadline exceeded - Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
+                        failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+                        return json.dumps("The request deadline was exceeded"), 504, {**deadline.headers(), 'Liev-Response-Failed-Models': ",".join(failed_llms)}
+
+                    # The LLM is at its concurrency limit. Shed the request, unless the failover may take it
+                    if isinstance(e, ConcurrencyLimitException) and not (self.__limiter.failover and try_next_on_failure and (failover_chain or llm_name is not None)):
+                        self.__logger.warning(f'Error calling {chosen_llm["name"]}: {e}. Request shed - Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
+                        failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+                        return json.dumps("The LLMs are overloaded. Retry later"), 503, {**deadline.headers(), 'Retry-After': self.__limiter.retry_after, 'Liev-Response-Failed-Models': ",".join(failed_llms)}
+
                     # If the user wants failover
                     if try_next_on_failure:
 
                         # Set the indicator that the response is already a failover
                         is_failover_response = True
+                        self.__metrics.increment('failovers', chosen_llm)
                         self.__logger.error(f'Error calling {chosen_llm["name"]}: {e}. Trying the next priority LLM for type {type_str} - Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
                         
-                        # If the request is based just on the llm_name, there is no failover
-                        if llm_name is not None:
-                            current_priority = 1
-                            llm_name = None
-                        # Else, increment the current priority to try to get the next one
-                        else:
-                            current_priority += 1
-                        
                         # Add the failed LLM to the failed list. This will be returned in the Liev-Response-Failed-Models header in the end
                         failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
                         
                         # AGAIN, get the next priority LLM for the type 
                         try:
-                            chosen_llm = self.__manager.get_llm_by_priority(type_str, current_priority)
+                            # If the request was based on the llm_name, the failover starts from the top of the type chain, without the failed LLM
+                            if llm_name is not None:
+                                failed_llm_name = chosen_llm['name']
+                                llm_name = None
+                                failover_chain = deque(llm for llm in self.__get_failover_chain(type_str) if llm['name'] != failed_llm_name)
+
+                            chosen_llm = failover_chain.popleft() if failover_chain else None
+                            if chosen_llm is None:
+                                raise Exception(f"No more LLMs in the failover chain for type {type_str}")
                             self.__logger.debug(f"Chosen LLM is: {chosen_llm['name']}")
 
                             # Continue the "While not processed" loop ^^^
@@ -217,8 +416,13 @@ class DispatcherController:
                     'Content-Type': response_mime,
                     'Liev-Response-Model': f"{chosen_llm['name']}({chosen_llm['model']})",
                     'Liev-Response-Is-Failover': is_failover_response,
-                    'Liev-Response-Failed-Models': ",".join(failed_llms)
+                    'Liev-Response-Is-Hedge': is_hedge_response,
+                    'Liev-Response-Retries': len(retried_llms),
+                    'Liev-Response-Failed-Models': ",".join(failed_llms),
+                    **deadline.headers()
                 }
+                if use_cache or use_similar:
+                    response_headers['Liev-Response-Cache'] = 'miss' if similar is None else 'verified'
                 
                 # If streaming
                 if stream:
@@ -231,11 +435,19 @@ class DispatcherController:
                     def generate():
                         response_bytes = 0
                         for chunk in response.iter_content(chunk_size=1000):
+                            # The request deadline bounds the whole stream, not only each read
+                            if deadline.expired():
+                                self.__logger.error(f'LLM Request: {flask_request_method} {flask_request_path} LLM_Name: {chosen_llm_name}, Application: {auth_application}, User: {auth_username}, Response_Bytes: {response_bytes}. Request deadline exceeded while streaming')
+                                response.close()
+                                raise DeadlineExceededException()
                             if chunk:
                                 response_bytes += len(chunk)
                                 yield chunk
                         self.__logger.info(f'LLM Request: {flask_request_method} {flask_request_path} LLM_Name: {chosen_llm_name}, Application: {auth_application}, User: {auth_username}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {response_bytes}, Response_Time: {response.elapsed.total_seconds()}')
-                    return Response(generate(), mimetype='application/json',  headers=response_headers)
+                    streamed_response = Response(generate(), mimetype='application/json',  headers=response_headers)
+                    # The LLM stays in flight for the load balancer and the concurrency limiter until the stream is closed
+                    streamed_response.call_on_close(functools.partial(self.__finish_call, chosen_llm))
+                    return streamed_response
                     
                 # If http sync
                 else:
@@ -249,104 +461,356 @@ class DispatcherController:
             combined_answers = []
             combined_mime = 'application/json'
             
-            # Start concurrent request for all wanted LLMs. Combining all the answerds
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_to_url = {executor.submit(self.__call_llm, chosen_llm, data): [chosen_llm, f'{flask_request.method}', f'{flask_request.path}', auth.current_user()] for chosen_llm in chosen_llms}
-                successful_llms = []
-                failed_llms = []
-                
-                for future in concurrent.futures.as_completed(future_to_url):
-                    llm = future_to_url[future][0]
-                    method = future_to_url[future][1]
-                    path = future_to_url[future][2]
-                    user = future_to_url[future][3]
-                    
+            # The LLMs failing their health checks or with an open circuit are not called
+            failed_llms = [f'{llm["name"]}({llm["model"]})' for llm in chosen_llms if not self.__health.is_healthy(llm) or self.__breakers.is_open(llm)]
+            chosen_llms = [llm for llm in chosen_llms if f'{llm["name"]}({llm["model"]})' not in failed_llms]
+
+            log_prefix = f'LLM Request: {flask_request.method} {flask_request.path}'
+            log_user = f'Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}'
+
+            # Return after the first N successful answers, dropping the calls still running
+            try:
+                first_n = int(data.get('first_n') or 0)
+            except (TypeError, ValueError):
+                return json.dumps("first_n must be an integer"), 400
+
+            # Opt-in: stream each answer as soon as its LLM completes, as NDJSON or server-sent events
+            mime = multi_stream.stream_mime(flask_request.headers.get('Accept'))
+            if mime is not None:
+                def generate():
+                    successes = 0
+                    with contextlib.closing(self.__fan_out(chosen_llms, payload, deadline, toxicity)) as answers:
+                        for llm, response, exc in answers:
+                            try:
+                                if exc is not None:
+                                    raise exc
+                                if response.status_code != 200:
+                                    raise Exception(f"Response code not successful: {response.status_code}")
+                                answer = multi_stream.encode(mime, f'{llm["name"]}({llm["model"]})', response.content)
+                                successes += 1
+                                self.__logger.info(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
+                            except Exception as error:
+                                self.__logger.error(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}')
+                                self.__logger.error(f"Error calling {llm['name']}: {error}")
+                                answer = multi_stream.encode(mime, f'{llm["name"]}({llm["model"]})', error=error)
+                            yield answer
+                            if first_n and successes >= first_n:
+                                break
+                response_headers = {
+                    'Liev-Response-Is-Failover': 'False',
+                    'Liev-Response-Failed-Models': ', '.join(failed_llms),
+                    **deadline.headers()
+                }
+                return Response(generate(), mimetype=mime, headers=response_headers)
+
+            # Call all the wanted LLMs concurrently. Combining all the answers
+            successful_llms = []
+            with contextlib.closing(self.__fan_out(chosen_llms, payload, deadline, toxicity)) as answers:
+                for llm, response, exc in answers:
                     try:
-                        data = future.result()
-                        combined_answers.append(json.loads(f'{{"name":"{llm["name"]}({llm["model"]})", "response": {data.text}}}'))
+                        if exc is not None:
+                            raise exc
+                        if response.status_code != 200:
+                            raise Exception(f"Response code not successful: {response.status_code}")
+                        # The upstream answer is spliced as is, without decoding it. See fast_json
+                        combined_answers.append(fast_json.splice_object([('name', fast_json.dumps(f'{llm["name"]}({llm["model"]})')), ('response', fast_json.raw_value(response.content))]))
                         successful_llms.append(f'{llm["name"]}({llm["model"]})')
-                        self.__logger.info(f'LLM Request: {method} {path} LLM_Name: {llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}, Request_Bytes: {len(data.request.body)}, Response_Bytes: {len(data.text)}, Response_Time: {data.elapsed.total_seconds()}')
+                        self.__logger.info(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
                     except Exception as exc:
-                        self.__logger.error(f'LLM Request: {method} {path} LLM_Name: {llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
+                        self.__logger.error(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}')
                         self.__logger.error(f"Error calling {llm['name']}: {exc}", exc_info=True)
                         failed_llms.append(f'{llm["name"]}({llm["model"]})')
-                
-                response_headers = {
-                    'Content-Type': combined_mime,
-                    'Liev-Response-Model': ','.join(map(lambda llm: llm, successful_llms)),
-                    'Liev-Response-Is-Failover': 'False',
-                    'Liev-Response-Failed-Models': ', '.join(map(lambda llm: llm, failed_llms))
-                }
-                return json.dumps(combined_answers), 200, response_headers
+                    if first_n and len(successful_llms) >= first_n:
+                        break
+
+            # The LLMs whose answer was no longer needed
+            cancelled_llms = [f'{llm["name"]}({llm["model"]})' for llm in chosen_llms if f'{llm["name"]}({llm["model"]})' not in successful_llms and f'{llm["name"]}({llm["model"]})' not in failed_llms]
+            # Some answers wanted were still missing when the request deadline expired
+            partial = bool(cancelled_llms) and (not first_n or len(successful_llms) < first_n)
+
+            response_headers = {
+                'Content-Type': combined_mime,
+                'Liev-Response-Model': ','.join(map(lambda llm: llm, successful_llms)),
+                'Liev-Response-Is-Failover': 'False',
+                'Liev-Response-Failed-Models': ', '.join(map(lambda llm: llm, failed_llms)),
+                'Liev-Response-Cancelled-Models': ', '.join(cancelled_llms),
+                'Liev-Response-Partial': partial,
+                **deadline.headers()
+            }
+            return fast_json.splice_array(combined_answers), 200, response_headers
 
-    def __call_llm(self, chosen_llm, data, is_fim = False, stream = False):
+    def __fan_out(self, chosen_llms, payload, deadline, toxicity=None):
         """
-        Calls the specified LLM with the given data.
-        Replaces system message and sets prompt mask, if defined in LLM endpoint configuration
+        Calls the LLMs of a multi-LLM request on the shared fan-out executor, FANOUT_MAX_PER_REQUEST at a time. A
+        speculative fan-out stops on a toxic verdict: the calls not started are dropped, the others discarded.
+
+        Yields:
+            tuple: (llm, response, exception) of each call, in order of completion. The response is None on errors.
+                   The calls still running when the request deadline expires are not waited for.
+        """
+        def call(llm):
+            # The timeouts come from the budget left when the call starts, not when it was queued
+            return self.__call_llm_guarded(llm, payload, False, False, deadline.timeouts(llm))
+
+        waiting = deque(chosen_llms)
+        running = {}
+        try:
+            while waiting or running:
+                while waiting and len(running) < self.__fanout_per_request:
+                    llm = waiting.popleft()
+                    running[self.__fanout_executor.submit(call, llm)] = llm
+                # The verdict wakes the wait too
+                verdict = [toxicity] if toxicity is not None and not toxicity.done() else []
+                done, _ = concurrent.futures.wait([*running, *verdict], timeout=deadline.remaining(), return_when=concurrent.futures.FIRST_COMPLETED)
+                if self.__refused(toxicity):
+                    return
+                if not done:
+                    # The request deadline expired: the answers yielded so far are the partial result
+                    return
+                for future in done:
+                    if future is toxicity:
+                        continue
+                    llm = running.pop(future)
+                    try:
+                        yield llm, future.result(), None
+                    except Exception as exc:
+                        yield llm, None, exc
+        finally:
+            # Enough answers, or the client went away: the calls not started yet are dropped. A request already
+            # sent cannot be aborted with requests; its answer is closed when it arrives
+            for future in running:
+                if not future.cancel():
+                    future.add_done_callback(self.__discard_fan_out_call)
+
+    def __discard_fan_out_call(self, future):
+        """Closes the answer of a multi-LLM call no longer needed"""
+        if future.exception() is None:
+            future.result().close()
+
+    def __call_llm(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the specified LLM with the given payload.
+        Replaces system message and sets prompt mask, if defined in LLM endpoint configuration. See Payload
 
         Args:
             chosen_llm (dict): The chosen LLM configuration.
-            data (dict): The request payload.
+            payload (Payload): The request payload.
+            timeout (tuple): The (connect, read) timeouts in seconds. See Deadline.
 
         Returns:
             Response: The response from the LLM.
         """
-        username = chosen_llm['username']
-        password = chosen_llm['password']
-        
-        auth_server = HTTPBasicAuthServer(username, password)    
-
         response = None
         if not is_fim:
-            
-            # Use the prompt mask, if defined in the LLM configuration
-            if 'instruction' in data:
-                data['instruction'] = self.__set_prompt_to_prompt_mask(data['instruction'], chosen_llm)
-
-            # Use the default system message, if defined in the LLM configuration
-            if 'system_message' in chosen_llm and len(chosen_llm['system_message']) > 0:
-                data['system_msg'] = chosen_llm['system_message']
             if stream:
                 if 'http_stream_url' in chosen_llm:
                     address = chosen_llm['http_stream_url']
-                    response = requests.post(address, data=json.dumps(data), auth=auth_server, stream=True)
+                    response = self.__sessions.post(chosen_llm, address, data=payload.body(chosen_llm), stream=True, timeout=timeout)
                 else:
                     raise HttpStreamingNotSupportedException()
             else:
                 address = chosen_llm['url']
-                response = requests.get(address, data=json.dumps(data), auth=auth_server)
+                response = self.__sessions.get(chosen_llm, address, data=payload.body(chosen_llm), timeout=timeout)
         else:
             if 'fim_url' in chosen_llm:
                 address = chosen_llm['fim_url']
-                response = requests.get(address, data=json.dumps(data), auth=auth_server)
+                response = self.__sessions.get(chosen_llm, address, data=payload.body(chosen_llm, is_fim=True), timeout=timeout)
             else: 
                 raise FimNotSupportedException()
         return response
     
-    def __set_prompt_to_prompt_mask(self, prompt, chosen_llm):
+    def __get_failover_chain(self, type_str):
+        """The failover chain of the type, with the LLMs sharing a priority in load balancing order"""
+        return deque(self.__balancer.order(self.__manager.get_failover_chain(type_str)))
+
+    def __call_llm_guarded(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the LLM within its concurrency limit, and records the outcome in its circuit breaker, in the load balancer
+        and in the concurrency limiter. The caller checks the circuit first. A successful stream stays in flight until
+        it is closed. See __call_llm.
         """
-        Set the prompt in the prompt mask defined in the LLM Configuration
+        try:
+            self.__limiter.acquire(chosen_llm)
+        except ConcurrencyLimitException:
+            # The call is not made: the half-open trial the caller may have taken is left to the next call
+            self.__breakers.release_trial(chosen_llm)
+            raise
+        response = None
+        failed = False
+        self.__balancer.start(chosen_llm)
+        try:
+            response = self.__call_llm_replicas(chosen_llm, payload, is_fim, stream, timeout)
+        except (FimNotSupportedException, HttpStreamingNotSupportedException):
+            raise
+        except Exception as e:
+            failed = True
+            # A timeout shortened by the client deadline says nothing of the LLM health
+            if not caused_by_deadline(e, timeout):
+                self.__breakers.record_failure(chosen_llm)
+            raise
+        finally:
+            if response is None or response.status_code != 200:
+                self.__finish_call(chosen_llm, failed=failed or (response is not None and response.status_code >= 500))
+            elif not stream:
+                self.__finish_call(chosen_llm, response.elapsed.total_seconds())
+        self.__breakers.record(chosen_llm, response.status_code)
+        return response
 
-        Example:
-        Prompt Mask: Generate Unit tests for the For the code. Code: %PROMPT%
-        Prompt: <Program code>
+    def __call_llm_retried(self, chosen_llm, payload, is_fim, stream, deadline, candidates_left, retried_llms, toxicity=None):
+        """
+        Calls the LLM, retrying it after a backoff while its errors are retryable and the deadline allows. See
+        RetryPolicy.
+
+        Args:
+            chosen_llm (dict): The LLM record.
+            payload (Payload): The request payload.
+            is_fim (bool): Whether it is a fill in the middle request.
+            stream (bool): Whether it is a streaming request.
+            deadline (Deadline): The request deadline. Each attempt gets the LLM share of the remaining budget.
+            candidates_left (int): The LLMs left to try, this one included.
+            retried_llms (list): Gets the LLM appended on each retry.
+            toxicity (Future): The toxicity check of a speculative request. No retry is made once the prompt is toxic.
+
+        Returns:
+            The last response.
+        """
+        attempt = 1
+        while True:
+            timeout = deadline.attempt_timeouts(chosen_llm, candidates_left)
+            try:
+                response = self.__call_llm_guarded(chosen_llm, payload, is_fim, stream, timeout)
+            except Exception as e:
+                delay = self.__retries.delay(chosen_llm, attempt, deadline, exception=e)
+                if delay is None:
+                    raise
+                reason = e
+            else:
+                if response.status_code == 200 and attempt > 1:
+                    self.__metrics.increment('retry_successes', chosen_llm)
+                delay = None if response.status_code == 200 else self.__retries.delay(chosen_llm, attempt, deadline, status_code=response.status_code)
+                if delay is None:
+                    return response
+                reason = f"Response code not successful: {response.status_code}"
+                response.close()
+
+            self.__logger.warning(f"Error calling {chosen_llm['name']}: {reason}. Retrying it in {delay:.3f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+            # The circuit may have opened meanwhile, with the failures of the other requests
+            if self.__breakers.is_open(chosen_llm):
+                raise CircuitOpenException(f"The circuit of {chosen_llm['name']} is open. Not retrying it")
+            if self.__refused(toxicity):
+                raise ToxicPromptException()
+            self.__metrics.increment('retries', chosen_llm)
+            retried_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+            attempt += 1
+
+    def __finish_call(self, chosen_llm, seconds=None, failed=False):
+        """Ends a call started by __call_llm_guarded, in the load balancer and in the concurrency limiter"""
+        self.__balancer.finish(chosen_llm, seconds, failed)
+        self.__limiter.release(chosen_llm, seconds, failed)
+
+    def __call_llm_replicas(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the LLM. If its record lists replicas, a failing replica is ejected and the next one is tried before
+        the call fails. See ReplicaPool. The replicas tried share the timeouts of the attempt.
+        """
+        replicas = self.__replicas.order(chosen_llm)
+        if len(replicas) == 1:
+            return self.__call_llm(replicas[0], payload, is_fim, stream, timeout)
+
+        started = time.monotonic()
+        for i, replica_llm in enumerate(replicas):
+            is_last = i == len(replicas) - 1
+            # The budget left is split across the replicas left
+            replica_timeout = timeout.split(time.monotonic() - started, len(replicas) - i) if timeout is not None else None
+            try:
+                response = self.__call_llm(replica_llm, payload, is_fim, stream, replica_timeout)
+            except (FimNotSupportedException, HttpStreamingNotSupportedException):
+                raise
+            except Exception as e:
+                # A timeout shortened by the deadline says nothing of the replica health
+                if not caused_by_deadline(e, replica_timeout):
+                    self.__replicas.eject(replica_llm, e)
+                if is_last:
+                    raise
+                continue
+            self.__logger.info(f"Replica {replica_llm['replica']} of {replica_llm['name']}: Response_Code: {response.status_code}, Response_Time: {response.elapsed.total_seconds()}")
+            if response.status_code >= 500:
+                self.__replicas.eject(replica_llm, f"Response code not successful: {response.status_code}")
+                if not is_last:
+                    response.close()
+                    continue
+            return response
+
+    def __call_llm_hedged(self, chosen_llm, failover_chain, payload, is_fim, deadline, failed_llms, toxicity=None):
+        """
+        Calls the chosen LLM and, if it has not answered within the hedge delay, also the next LLM of the failover chain.
+        The first successful answer wins. The loser cannot be interrupted in its thread: its response is discarded.
 
         Args:
-            prompt (str): The prompt received by the user
             chosen_llm (dict): The chosen LLM configuration.
+            failover_chain (deque): The LLMs left. The hedge LLM is taken off the chain once called.
+            payload (Payload): The request payload.
+            deadline (Deadline): The request deadline.
+            failed_llms (list): The failed LLMs. The hedge LLM is added if it fails.
+            toxicity (Future): The toxicity check of a speculative request. The hedge is not made once the prompt is
+                               toxic, and the chosen LLM answer is discarded.
+
         Returns:
-            Response: The response from the LLM.
+            tuple: The LLM that answered first and its response. The chosen LLM outcome if no call succeeded.
+        """
+        candidates_left = len(failover_chain) + 1
+        calls = {self.__hedge_executor.submit(self.__call_llm_guarded, chosen_llm, payload, is_fim, False, deadline.attempt_timeouts(chosen_llm, candidates_left)): chosen_llm}
+        done, _ = concurrent.futures.wait(calls, timeout=self.__hedging.delay(chosen_llm))
+        if self.__refused(toxicity):
+            for future, llm in calls.items():
+                future.add_done_callback(functools.partial(self.__discard_hedge_loser, llm))
+            raise ToxicPromptException()
+        # The hedge LLM is not called while it is unhealthy or its circuit is open
+        if not done and self.__health.is_healthy(failover_chain[0]) and self.__breakers.allow(failover_chain[0]):
+            hedge_llm = failover_chain.popleft()
+            self.__logger.info(f"{chosen_llm['name']} did not answer within the hedge delay. Hedging with {hedge_llm['name']}")
+            calls[self.__hedge_executor.submit(self.__call_llm_guarded, hedge_llm, payload, is_fim, False, deadline.attempt_timeouts(hedge_llm, candidates_left - 1))] = hedge_llm
+
+        for future in concurrent.futures.as_completed(calls):
+            llm = calls[future]
+            if future.exception() is None and future.result().status_code == 200:
+                for loser, loser_llm in calls.items():
+                    if loser is not future and loser.done() and (loser.exception() is not None or loser.result().status_code != 200):
+                        failed_llms.append(f"{loser_llm['name']}({loser_llm['model']})")
+                    elif loser is not future:
+                        loser.add_done_callback(functools.partial(self.__discard_hedge_loser, loser_llm))
+                return llm, future.result()
+            if llm is not chosen_llm:
+                self.__logger.error(f"Error calling {llm['name']}: {future.exception() or future.result().status_code}")
+                failed_llms.append(f"{llm['name']}({llm['model']})")
+
+        # No call succeeded: the failover goes on from the chosen LLM outcome
+        return chosen_llm, next(future for future, llm in calls.items() if llm is chosen_llm).result()
+
+    def __discard_hedge_loser(self, llm, future):
+        # A slow answer still counts for the observed latency of the LLM
+        if future.exception() is None:
+            response = future.result()
+            if response.status_code == 200:
+                self.__hedging.record(llm, response.elapsed.total_seconds())
+            response.close()
+
+    def __classify_prompt(self, data):
         """
-        # Get the prompt mask - the original prompt will be masked with these instructions
-        if ('prompt_mask' in chosen_llm and len(chosen_llm['prompt_mask']) > 0):
-            prompt_mask = chosen_llm['prompt_mask']
+        The fast path of the prompt detection: a cached detection or a confident local classifier.
 
-            # Set the original prompt in the prompt mask
-            return prompt_mask.replace('%PROMPT%', prompt)
-        else:
-            return prompt
-        
-    def __detect_prompt(self, data, auth):
+        Returns:
+            str: The type of the prompt, or None if the detect LLM is needed.
+        """
+        self.__metrics.increment('detect_requests')
+        type_str, source = self.__classifier.classify(data.get('instruction'))
+        if type_str is not None:
+            self.__metrics.increment(f'detect_{source}_hits')
+            self.__logger.debug(f"Type detected by the {source}: {type_str}")
+        return type_str
+
+    def __detect_prompt(self, data, auth, deadline):
         """
         Detects the type of prompt from the given data using the Default LLM for detect
 
@@ -378,7 +842,7 @@ class DispatcherController:
             }
             
             # Call The LLM
-            response = self.__call_llm(detect_llm, data_detect)        
+            response = self.__call_llm(detect_llm, Payload(data_detect), timeout=deadline.classifier_timeouts(detect_llm))
             self.__logger.info(f'LLM Request: {flask_request.method} {flask_request.path} LLM_Name: {detect_llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
             
             # Strip the detected type from extra chars, giving just the type word
@@ -388,6 +852,7 @@ class DispatcherController:
             # If the detected type is not in the constansts.allowed_detect_types, than the LLM was not able to detect. Raise Exception and stop.
             if type_str not in constants.allowed_detect_types:
                 raise Exception("Could not detect type")
+            self.__classifier.learn(data.get('instruction'), type_str)
             
             self.__logger.debug(f"Type detected: {type_str}")
             return type_str
@@ -396,9 +861,24 @@ class DispatcherController:
             self.__logger.error(f"Error calling {detect_llm['name']}: {e}", exc_info=True)
             return json.dumps("No LLMs were available to process the content detection. Try specifying type in payload"), 500
         
-    def __is_prompt_toxic(self, data, auth):
-        if (self.__toxicity_filter):
+    def __is_prompt_toxic(self, data, log_prefix, log_user, deadline):
+        """
+        Checks the prompt against the toxicity LLM. Runs in the guardrail executor, out of the Flask request context.
+
+        Returns:
+            bool: Whether the prompt is toxic. A failed check counts as toxic. None when the check timed out or the
+                  request deadline expired.
+        """
+        toxicity_llm = {'name': 'toxicity'}
+        with deadline.stage('toxicity'):
             try:
+                # The clear cases are settled locally
+                toxic, source = self.__toxicity_prefilter.check(data.get('instruction'))
+                if toxic is not None:
+                    self.__metrics.increment(f'toxicity_{source}_hits')
+                    return toxic
+                self.__metrics.increment('toxicity_model_calls')
+
                 # Get an LLM of type "toxicity"
                 toxicity_llm = self.__manager.get_llm_by_priority("toxicity", 1)
                 self.__logger.debug(f"Chosen LLM is: {toxicity_llm['name']}")
@@ -408,25 +888,38 @@ class DispatcherController:
                     "sentence": data.get('instruction'),
                 }
 
-                # Model Server Auth
-                username = toxicity_llm['username']
-                password = toxicity_llm['password']
-        
-                auth_server = HTTPBasicAuthServer(username, password)
                 address = toxicity_llm['url']
 
                 # Call The LLM
-                response = requests.get(address, data=json.dumps(data_toxicity), auth=auth_server)        
-                self.__logger.info(f'LLM Request: {flask_request.method} {flask_request.path} LLM_Name: {toxicity_llm["name"]}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
+                response = self.__sessions.get(toxicity_llm, address, data=json.dumps(data_toxicity), timeout=deadline.classifier_timeouts(toxicity_llm))
+                self.__logger.info(f'{log_prefix} LLM_Name: {toxicity_llm["name"]}, {log_user}, Request_Bytes: {len(response.request.body)}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed.total_seconds()}')
                 
                 # Parse the boolean return
                 bool_toxic = self.__str_to_bool(response.text.replace("'", "").replace('"', '').strip().lower())
+                self.__toxicity_prefilter.remember(data.get('instruction'), bool_toxic)
                 
                 return bool_toxic
+            except (requests.exceptions.Timeout, DeadlineExceededException) as e:
+                self.__logger.warning(f"{log_prefix} {log_user}. The toxicity check by {toxicity_llm['name']} ran out of time: {e}")
+                self.__metrics.increment('toxicity_timeouts')
+                return None
             except Exception as e:
-                self.__logger.error(f'LLM Request: {flask_request.method} {flask_request.path} Type: detect, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
+                self.__logger.error(f'{log_prefix} Type: detect, {log_user}')
                 self.__logger.error(f"Error calling {toxicity_llm['name']}: {e}", exc_info=True)
-                return json.dumps("No LLMs were available to process toxicity. Try specifying type in payload"), 500
+                return True
+
+    @staticmethod
+    def __refused(toxicity):
+        """Whether the toxicity check of a speculative request already refused the prompt, toxic or out of time"""
+        return toxicity is not None and toxicity.done() and toxicity.result() is not False
+
+    def __toxicity_refusal(self, toxic, deadline):
+        """The answer refusing the request after the toxicity check, or None when the prompt may be answered"""
+        if toxic is None:
+            return json.dumps("The request deadline was exceeded"), 504, deadline.headers()
+        if toxic:
+            return self.__toxicity_message, 400
+        return None
 
     def __str_to_bool(self, v):
         return v.lower() in ("yes", "true", "t", "1")
\ No newline at end of file
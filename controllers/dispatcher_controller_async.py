@@ -0,0 +1,849 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import time
+from collections import deque
+from config.config import Config
+import controllers.constants as constants
+
+from exception.exceptions import FimNotSupportedException, HttpStreamingNotSupportedException, DeadlineExceededException, CircuitOpenException, LLMUnhealthyException, ConcurrencyLimitException
+from controllers.deadline import Deadline, caused_by_deadline
+from liev_llm_manager.manager import get_manager
+from controllers.session_pool import AsyncSessionPool
+from controllers.hedging import HedgePolicy
+from controllers.circuit_breaker import CircuitBreaker
+from controllers.health_checker import get_health_checker
+from controllers.load_balancer import LoadBalancer
+from controllers.replica_pool import ReplicaPool
+from controllers.concurrency_limiter import ConcurrencyLimiter
+from controllers.retry_policy import RetryPolicy
+from controllers.metrics import get_metrics
+import controllers.multi_stream as multi_stream
+import controllers.fast_json as fast_json
+from controllers.payload import Payload
+from controllers.response_cache import ResponseCache
+from controllers.similarity_cache import SimilarityCache
+from controllers.prompt_classifier import PromptClassifier
+from controllers.toxicity_prefilter import ToxicityPrefilter
+from starlette.responses import StreamingResponse
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse awaiting on_close however it ends. The generator's own finally does not run when the client
+    disconnects before its first chunk, nor right away when a send fails.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.__on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.__on_close()
+
+
+class AsyncDispatcherController:
+    """
+    Async version of DispatcherController, used by the ASGI app.
+
+    Same flow (toxicity, prompt detection, failover chain, multi-LLM), but the upstream calls go through a
+    non-blocking HTTP client, so a long generation holds a coroutine instead of a thread.
+    The managers are synchronous: their lookups run in the default executor, off the event loop.
+    """
+
+    def __init__(self) -> None:
+
+        self.__config = Config('dispatcher')
+        # Configure logging
+        logging.basicConfig(
+            level=self.__config.get('LOG_LEVEL', 'DEBUG'),
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        self.__logger = logging.getLogger(__name__)
+
+        # Initialize the LLM manager
+        self.__manager = get_manager()
+
+        # Non-blocking HTTP clients, one per upstream LLM
+        self.__sessions = AsyncSessionPool()
+
+        # Circuit breakers of the upstream LLMs. Open ones are skipped without a network call
+        self.__breakers = CircuitBreaker()
+
+        # Health of the upstream LLMs, from the background prober
+        self.__health = get_health_checker()
+
+        # Spreads the requests across the LLMs sharing a priority
+        self.__balancer = LoadBalancer()
+
+        # Replicas of the LLMs serving one name from several model servers
+        self.__replicas = ReplicaPool()
+
+        # Adaptive limits of the calls in flight to each LLM, so one slow model cannot take every thread
+        self.__limiter = ConcurrencyLimiter()
+
+        # Retries on the same LLM before the failover, for its brief errors
+        self.__retries = RetryPolicy()
+        self.__metrics = get_metrics()
+
+        # Answers of the repeated deterministic prompts
+        self.__cache = ResponseCache()
+        # And of the near-duplicate ones
+        self.__similar = SimilarityCache()
+
+        # Hedged requests to the next priority LLM, for the latency critical types
+        self.__hedging = HedgePolicy()
+
+        # Calls of the multi-LLM requests in flight, across the requests and per request
+        self.__fanout_slots = asyncio.Semaphore(int(self.__config.get('FANOUT_MAX_WORKERS', '64')))
+        self.__fanout_per_request = int(self.__config.get('FANOUT_MAX_PER_REQUEST', '8'))
+
+        # Initialize Toxicity
+        self.__toxicity_filter = self.__str_to_bool(self.__config.get('TOXICITY_FILTER', 'false'))
+        if (self.__toxicity_filter):
+            self.__toxicity_message="This message contains toxic language and is not allowed.\nEsta mensagem contém linguagem tóxica e não é permitida.\nEste mensaje contiene lenguaje tóxico y no está permitido."
+            # Term lists and cached verdicts, answering the clear cases without the toxicity LLM
+            self.__toxicity_prefilter = ToxicityPrefilter()
+        else:
+            self.__logger.warning('Toxicity filter is disabled! Counting only with model protections.')
+        # With GUARDRAIL_SPECULATIVE, the LLMs are called while the toxicity check runs
+        self.__guardrail_speculative = self.__str_to_bool(self.__config.get('GUARDRAIL_SPECULATIVE', 'false'))
+
+        # The type used when the prompt detection is skipped because the request deadline is too close
+        self.__detect_fallback_type = self.__config.get('DETECT_FALLBACK_TYPE', 'text')
+
+        # Cached detections and a local classifier, answering the easy prompts without the detect LLM
+        self.__classifier = PromptClassifier()
+
+    async def aclose(self):
+        await self.__sessions.aclose()
+
+    async def get_response(self, data, request, user, is_fim = False, stream = False):
+        """
+        Processes a request to the dispatcher, managing LLM interactions and handling failovers.
+
+        Args:
+            data (dict): The request payload.
+            request (Request): The incoming request. Used for logging.
+            user (dict): The authenticated user info, with username and application.
+
+        Returns:
+            Tuple: Response content, status code, and response headers. A StreamingResponse if stream is True.
+        """
+        log_prefix = f'LLM Request: {request.method} {request.url.path}'
+        log_user = f'Application: {user["application"]}, User: {user["username"]}'
+
+        # The end-to-end budget of the request, split across toxicity, detection and each failover attempt
+        deadline = Deadline.from_headers(request.headers)
+
+        # The body sent to the LLMs, the original bytes when no LLM overlay applies. data itself is never changed
+        payload = Payload(data, await request.body())
+
+        # Filter Toxicity. The check runs alongside the request, whose answer is only returned once the prompt is known not to be toxic
+        if not self.__toxicity_filter:
+            return await self.__get_response(data, request, log_prefix, log_user, is_fim, stream, deadline, payload, None)
+        toxicity = asyncio.ensure_future(self.__is_prompt_toxic(data, log_prefix, log_user, deadline))
+        answer = asyncio.ensure_future(self.__get_response(data, request, log_prefix, log_user, is_fim, stream, deadline, payload, toxicity))
+        try:
+            refusal = self.__toxicity_refusal(await asyncio.shield(toxicity), deadline)
+            if refusal is not None:
+                return refusal
+            return await answer
+        finally:
+            # A toxic prompt cancels the speculative LLM calls still in flight
+            for task in (toxicity, answer):
+                if not task.done():
+                    task.cancel()
+
+    async def __get_response(self, data, request, log_prefix, log_user, is_fim, stream, deadline, payload, toxicity):
+        """
+        Processes a request once its deadline and payload are set. See get_response.
+
+        Args:
+            toxicity (Task): The toxicity check in flight, or None without the toxicity filter.
+        """
+
+        # Whether the user wants the failover or not
+        try_next_on_failure = data.get('try_next_on_failure', True)
+
+        # Get llm name, if specified
+        llm_name = data.get('llm_name', None)
+
+        # Get the Function or Type from payload. They are synonym.
+        type_str = data.get('function')  # For backward compatibility
+        if type_str is None:
+            type_str = data.get('type')  # New format
+
+            # If Function/Type is not specified, set it for "detect" to enter the LLM Detection flow
+            if type_str is None and llm_name is None:
+                type_str = "detect"
+            elif type_str is None and llm_name is not None:
+                # If the user is specifiying the llm name, automatically disable the failover
+                try_next_on_failure = False
+
+        # The flag indicating when a failover occurs. This will be returned in the Liev-Response-Is-Failover header in the end
+        is_failover_response = False
+
+        # The flag indicating when the hedge LLM answered first. This will be returned in the Liev-Response-Is-Hedge header in the end
+        is_hedge_response = False
+
+        # The calls retried on the same LLM, one entry per retry. Their number will be returned in the Liev-Response-Retries header in the end
+        retried_llms = []
+
+        # The LLMs of the type ordered by priority, resolved once. The failover walks this chain locally
+        failover_chain = deque()
+
+        # An list of failed failover LLMs. This will be returned in the Liev-Response-Failed-Models header in the end
+        failed_llms = []
+
+        # If type is set to "detect", enter the prompt detection flow. The fast path needs no budget
+        fast_type = self.__classify_prompt(data) if type_str == "detect" else None
+        if fast_type is not None:
+            type_str = fast_type
+        elif type_str == "detect" and not deadline.can_detect():
+            self.__logger.warning(f'Type not informed, but the deadline is too close for prompt detection. Using type {self.__detect_fallback_type}')
+            type_str = self.__detect_fallback_type
+        elif type_str == "detect":
+            self.__logger.debug('Type not informed. Prompt detection needed.')
+            with deadline.stage('detect'):
+                type_str = await self.__detect_prompt(data, log_prefix, log_user, deadline)
+
+        # Without speculation, the LLMs are only called once the prompt is known not to be toxic. Streams never speculate
+        if toxicity is not None and (stream or not self.__guardrail_speculative):
+            refusal = self.__toxicity_refusal(await asyncio.shield(toxicity), deadline)
+            if refusal is not None:
+                return refusal
+
+        # Declare a list of choosen llms that will be used
+        chosen_llms = []
+
+        # Get LLMs that will be used based on type and/or llm_name
+        try:
+            if llm_name == 'all':
+                # Put all the available LLMs for this type in the choosen_llms
+                chosen_llms = await self.__run(self.__manager.get_llms_by_type, type_str)
+                self.__logger.debug(f"Multi LLMs requested. Chosen LLMs are: {', '.join(map(lambda llm: llm['name'], chosen_llms))}")
+            elif llm_name:
+                llm = None
+                try:
+                    llm = await self.__run(self.__manager.get_llm_by_name, llm_name)
+                except Exception as e:
+                    if not try_next_on_failure:
+                        self.__logger.error(f'Error calling {llm_name}: {e}. Won\'t trying failover - {log_user}')
+                        return f"No LLMs were available to process the request. Won't trying failover. Error message: {str(e)}", 500
+                if llm is not None:
+                    chosen_llms.append(llm)
+                elif try_next_on_failure:
+                    llm_name = None
+                    failover_chain = await self.__get_failover_chain(type_str)
+                    chosen_llms.append(failover_chain.popleft())
+                else:
+                    self.__logger.error(f'Error calling {llm_name}: LLM not found. Won\'t trying failover - {log_user}')
+                    return "No LLMs were available to process the request. Won't trying failover. Error message: LLM not found", 500
+                self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
+
+            # If the payload doesn't contain the LLM name, let's get from the manager the failover chain for the given type
+            else:
+                failover_chain = await self.__get_failover_chain(type_str)
+                chosen_llms.append(failover_chain.popleft())
+                self.__logger.debug(f"Chosen LLM is: {chosen_llms[0]['name']}")
+        except Exception as e:
+            self.__logger.error(f'{log_prefix} Type: {type_str}, {log_user}')
+            self.__logger.error(f"Error getting next priority LLM: {e}", exc_info=True)
+            return json.dumps("No LLMs were available to process the request"), 500
+
+        # Start the flow with multi LLM responses
+        if len(chosen_llms) != 1:
+            return await self.__get_multi_response(chosen_llms, data, payload, log_prefix, log_user, deadline, multi_stream.stream_mime(request.headers.get('Accept')))
+
+        chosen_llm = chosen_llms[0]
+        response_code = None
+
+        # A cached answer of the chosen LLM to the same payload is returned without calling it
+        use_cache = self.__cache.applies(type_str, data, stream)
+        cached = None
+        cache_status = 'hit'
+        if use_cache:
+            cached = self.__cache.get(self.__cache.key(chosen_llm, payload, is_fim))
+            self.__metrics.increment('cache_hits' if cached is not None else 'cache_misses', chosen_llm)
+
+        # Or its answer to a near-duplicate prompt. A sample of these hits still calls the LLM, to count the false positives
+        use_similar = cached is None and self.__similar.applies(type_str, data, stream)
+        similar = None
+        similar_llm = chosen_llm
+        if use_similar:
+            similar = self.__similar.get(type_str, chosen_llm, data)
+            self.__metrics.increment('similar_hits' if similar is not None else 'similar_misses', chosen_llm)
+            if similar is not None and not similar[2]:
+                cached, cache_status = similar[0], 'similar'
+
+        if cached is not None:
+            self.__logger.info(f'{log_prefix} LLM_Name: {chosen_llm["name"]}, {log_user}, Response_Bytes: {len(cached)}, Cache: {cache_status}')
+            cache_headers = {
+                'Content-Type': chosen_llm['response_mime'],
+                'Liev-Response-Model': f"{chosen_llm['name']}({chosen_llm['model']})",
+                'Liev-Response-Is-Failover': 'False',
+                'Liev-Response-Is-Hedge': 'False',
+                'Liev-Response-Retries': '0',
+                'Liev-Response-Failed-Models': '',
+                'Liev-Response-Cache': cache_status,
+                **deadline.headers()
+            }
+            if similar is not None:
+                cache_headers['Liev-Response-Cache-Similarity'] = f'{similar[1]:.3f}'
+            return cached, 200, cache_headers
+
+        # While I don't have an answer from an LLM
+        while True:
+            try:
+                # An unhealthy LLM is skipped, unless it is the last candidate
+                if failover_chain and not self.__health.is_healthy(chosen_llm, 'http_stream_url' if stream else 'url'):
+                    raise LLMUnhealthyException(f"{chosen_llm['name']} failed its health checks. Not calling it")
+                if not self.__breakers.allow(chosen_llm):
+                    raise CircuitOpenException(f"The circuit of {chosen_llm['name']} is open. Not calling it")
+                with deadline.stage(chosen_llm['name']):
+                    # For the latency critical types, race the next priority LLM when this one is slow
+                    if not stream and try_next_on_failure and self.__hedging.should_hedge(type_str, len(failover_chain)):
+                        answered_llm, response = await self.__call_llm_hedged(chosen_llm, failover_chain, payload, is_fim, deadline, failed_llms)
+                        if answered_llm is not chosen_llm:
+                            is_failover_response = is_hedge_response = True
+                            chosen_llm = answered_llm
+                    else:
+                        # Call the LLM, with its share of the remaining budget, retrying its brief errors
+                        response = await self.__call_llm_retried(chosen_llm, payload, is_fim, stream, deadline, len(failover_chain) + 1 if try_next_on_failure else 1, retried_llms)
+                response_code = response.status_code
+
+                # If unsuccessful, raise
+                if response_code != 200:
+                    response_content = (await response.read()) if stream else response.content
+                    if stream:
+                        await response.aclose()
+                    raise Exception(f"Response code not successful: {response_code} {response_content}")
+                if not stream:
+                    self.__hedging.record(chosen_llm, response.elapsed)
+                    # A speculative answer is only cached once the prompt is known not to be toxic
+                    if (use_cache or use_similar) and toxicity is not None and await asyncio.shield(toxicity) is not False:
+                        use_cache = use_similar = False
+                    if use_cache:
+                        self.__cache.put(self.__cache.key(chosen_llm, payload, is_fim), response.content)
+                    if use_similar:
+                        if similar is not None and similar_llm is chosen_llm:
+                            # A sampled similarity hit. The LLM should have given the cached answer
+                            self.__metrics.increment('similar_verified', chosen_llm)
+                            if response.content != similar[0]:
+                                self.__metrics.increment('similar_false_positives', chosen_llm)
+                                self.__similar.put(chosen_llm, data, response.content)
+                        else:
+                            self.__similar.put(chosen_llm, data, response.content)
+                break
+
+            # Oops, got problems on calling the current LLM
+            except Exception as e:
+
+                # No budget left for another attempt
+                if isinstance(e, DeadlineExceededException) or deadline.expired():
+                    self.__logger.error(f'Error calling {chosen_llm["name"]}: {e}. Request deadline exceeded - {log_user}')
+                    failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+                    return json.dumps("The request deadline was exceeded"), 504, {**deadline.headers(), 'Liev-Response-Failed-Models': ",".join(failed_llms)}
+
+                # The LLM is at its concurrency limit. Shed the request, unless the failover may take it
+                if isinstance(e, ConcurrencyLimitException) and not (self.__limiter.failover and try_next_on_failure and (failover_chain or llm_name is not None)):
+                    self.__logger.warning(f'Error calling {chosen_llm["name"]}: {e}. Request shed - {log_user}')
+                    failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+                    return json.dumps("The LLMs are overloaded. Retry later"), 503, {**deadline.headers(), 'Retry-After': self.__limiter.retry_after, 'Liev-Response-Failed-Models': ",".join(failed_llms)}
+
+                # If the user doesn't want failover
+                if not try_next_on_failure:
+                    if response_code is None:
+                        response_code = 500
+                    # Return error
+                    self.__logger.error(f'Error calling {chosen_llm["name"]}: {e}. Won\'t trying failover - {log_user}')
+                    return f"No LLMs were available to process the request. Won't trying failover. Error message: {str(e)}", response_code
+
+                # Set the indicator that the response is already a failover
+                is_failover_response = True
+                self.__metrics.increment('failovers', chosen_llm)
+                self.__logger.error(f'Error calling {chosen_llm["name"]}: {e}. Trying the next priority LLM for type {type_str} - {log_user}')
+
+                # Add the failed LLM to the failed list. This will be returned in the Liev-Response-Failed-Models header in the end
+                failed_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+
+                # AGAIN, get the next priority LLM for the type
+                try:
+                    # If the request was based on the llm_name, the failover starts from the top of the type chain, without the failed LLM
+                    if llm_name is not None:
+                        failed_llm_name = chosen_llm['name']
+                        llm_name = None
+                        failover_chain = deque(llm for llm in await self.__get_failover_chain(type_str) if llm['name'] != failed_llm_name)
+
+                    chosen_llm = failover_chain.popleft() if failover_chain else None
+                    if chosen_llm is None:
+                        raise Exception(f"No more LLMs in the failover chain for type {type_str}")
+                    self.__logger.debug(f"Chosen LLM is: {chosen_llm['name']}")
+                    response_code = None
+                except Exception as e:
+
+                    # No LLMs were available. Return error.
+                    self.__logger.error(f'{log_prefix} {log_user}')
+                    self.__logger.error(f"Error getting next priority LLM: {e}", exc_info=True)
+                    return json.dumps("No LLMs were available to process the request"), 500
+
+        # Set response and headers
+        response_headers = {
+            'Content-Type': chosen_llm['response_mime'],
+            'Liev-Response-Model': f"{chosen_llm['name']}({chosen_llm['model']})",
+            'Liev-Response-Is-Failover': str(is_failover_response),
+            'Liev-Response-Is-Hedge': str(is_hedge_response),
+            'Liev-Response-Retries': str(len(retried_llms)),
+            'Liev-Response-Failed-Models': ",".join(failed_llms),
+            **deadline.headers()
+        }
+        if use_cache or use_similar:
+            response_headers['Liev-Response-Cache'] = 'miss' if similar is None else 'verified'
+
+        # If streaming
+        if stream:
+            chosen_llm_name = chosen_llm["name"]
+            streamed_llm = chosen_llm
+            closed = False
+
+            async def close():
+                # The LLM stays in flight for the load balancer and the concurrency limiter until the stream is closed
+                nonlocal closed
+                if not closed:
+                    closed = True
+                    self.__finish_call(streamed_llm)
+                    await response.aclose()
+
+            async def generate():
+                response_bytes = 0
+                try:
+                    async for chunk in response.iter_bytes(1000):
+                        if chunk:
+                            response_bytes += len(chunk)
+                            yield chunk
+                finally:
+                    await close()
+                self.__logger.info(f'{log_prefix} LLM_Name: {chosen_llm_name}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {response_bytes}, Response_Time: {response.elapsed}')
+            del response_headers['Content-Type']
+            return _ClosingStreamingResponse(generate(), close, media_type='application/json', headers=response_headers)
+
+        # If http sync
+        self.__logger.info(f'{log_prefix} LLM_Name: {chosen_llm["name"]}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed}')
+        return response.content, response_code, response_headers
+
+    async def __get_multi_response(self, chosen_llms, data, payload, log_prefix, log_user, deadline, mime=None):
+        """
+        Calls all the chosen LLMs concurrently and combines the answers, in order of completion. With a streaming
+        mime (see multi_stream), each answer is written as soon as its LLM completes.
+        """
+        combined_answers = []
+        combined_mime = 'application/json'
+        successful_llms = []
+
+        # The LLMs failing their health checks or with an open circuit are not called
+        failed_llms = [f'{llm["name"]}({llm["model"]})' for llm in chosen_llms if not self.__health.is_healthy(llm) or self.__breakers.is_open(llm)]
+        chosen_llms = [llm for llm in chosen_llms if f'{llm["name"]}({llm["model"]})' not in failed_llms]
+
+        # Return after the first N successful answers, cancelling the calls still running
+        try:
+            first_n = int(data.get('first_n') or 0)
+        except (TypeError, ValueError):
+            return json.dumps("first_n must be an integer"), 400
+
+        if mime is not None:
+            async def generate():
+                successes = 0
+                async with contextlib.aclosing(self.__fan_out(chosen_llms, payload, deadline)) as answers:
+                    async for llm, response, exc in answers:
+                        try:
+                            if exc is not None:
+                                raise exc
+                            if response.status_code != 200:
+                                raise Exception(f"Response code not successful: {response.status_code}")
+                            answer = multi_stream.encode(mime, f'{llm["name"]}({llm["model"]})', response.content)
+                            successes += 1
+                            self.__logger.info(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed}')
+                        except Exception as error:
+                            self.__logger.error(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}')
+                            self.__logger.error(f"Error calling {llm['name']}: {error}")
+                            answer = multi_stream.encode(mime, f'{llm["name"]}({llm["model"]})', error=error)
+                        yield answer
+                        if first_n and successes >= first_n:
+                            break
+            response_headers = {
+                'Liev-Response-Is-Failover': 'False',
+                'Liev-Response-Failed-Models': ', '.join(failed_llms),
+                **deadline.headers()
+            }
+            return StreamingResponse(generate(), media_type=mime, headers=response_headers)
+
+        async with contextlib.aclosing(self.__fan_out(chosen_llms, payload, deadline)) as answers:
+            async for llm, response, exc in answers:
+                try:
+                    if exc is not None:
+                        raise exc
+                    if response.status_code != 200:
+                        raise Exception(f"Response code not successful: {response.status_code}")
+                    # The upstream answer is spliced as is, without decoding it. See fast_json
+                    combined_answers.append(fast_json.splice_object([('name', fast_json.dumps(f'{llm["name"]}({llm["model"]})')), ('response', fast_json.raw_value(response.content))]))
+                    successful_llms.append(f'{llm["name"]}({llm["model"]})')
+                    self.__logger.info(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed}')
+                except Exception as exc:
+                    self.__logger.error(f'{log_prefix} LLM_Name: {llm["name"]}, {log_user}')
+                    self.__logger.error(f"Error calling {llm['name']}: {exc}", exc_info=True)
+                    failed_llms.append(f'{llm["name"]}({llm["model"]})')
+                if first_n and len(successful_llms) >= first_n:
+                    break
+
+        # The LLMs whose answer was no longer needed
+        cancelled_llms = [f'{llm["name"]}({llm["model"]})' for llm in chosen_llms if f'{llm["name"]}({llm["model"]})' not in successful_llms and f'{llm["name"]}({llm["model"]})' not in failed_llms]
+        # Some answers wanted were still missing when the request deadline expired
+        partial = bool(cancelled_llms) and (not first_n or len(successful_llms) < first_n)
+
+        response_headers = {
+            'Content-Type': combined_mime,
+            'Liev-Response-Model': ','.join(successful_llms),
+            'Liev-Response-Is-Failover': 'False',
+            'Liev-Response-Failed-Models': ', '.join(failed_llms),
+            'Liev-Response-Cancelled-Models': ', '.join(cancelled_llms),
+            'Liev-Response-Partial': partial,
+            **deadline.headers()
+        }
+        return fast_json.splice_array(combined_answers), 200, response_headers
+
+    async def __fan_out(self, chosen_llms, payload, deadline):
+        """
+        Calls the LLMs of a multi-LLM request concurrently, FANOUT_MAX_PER_REQUEST at a time and FANOUT_MAX_WORKERS
+        at a time across the requests.
+
+        Yields:
+            tuple: (llm, response, exception) of each call, in order of completion. The response is None on errors.
+                   The calls still running when the request deadline expires are not waited for.
+        """
+        request_slots = asyncio.Semaphore(self.__fanout_per_request)
+
+        async def call(llm):
+            async with request_slots, self.__fanout_slots:
+                # The timeouts come from the budget left when the call starts, not when it was queued
+                try:
+                    return llm, await self.__call_llm_guarded(llm, payload, timeout=deadline.timeouts(llm)), None
+                except Exception as exc:
+                    return llm, None, exc
+
+        calls = [asyncio.ensure_future(call(llm)) for llm in chosen_llms]
+        try:
+            for future in asyncio.as_completed(calls, timeout=deadline.remaining()):
+                try:
+                    answer = await future
+                except asyncio.TimeoutError:
+                    # The request deadline expired: the answers yielded so far are the partial result
+                    return
+                yield answer
+        finally:
+            # Enough answers, or the client went away: the calls still running are cancelled, closing their connections
+            for future in calls:
+                future.cancel()
+
+    async def __call_llm(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the specified LLM with the given payload.
+        Replaces system message and sets prompt mask, if defined in LLM endpoint configuration. See Payload
+
+        Args:
+            chosen_llm (dict): The chosen LLM configuration.
+            payload (Payload): The request payload.
+            timeout (tuple): The (connect, read) timeouts in seconds. See Deadline.
+
+        Returns:
+            AsyncLLMResponse: The response from the LLM. Still open if stream is True.
+        """
+        if not is_fim:
+            if stream:
+                if 'http_stream_url' in chosen_llm:
+                    return await self.__sessions.request('POST', chosen_llm, chosen_llm['http_stream_url'], payload.body(chosen_llm), stream=True, timeout=timeout)
+                raise HttpStreamingNotSupportedException()
+            return await self.__sessions.request('GET', chosen_llm, chosen_llm['url'], payload.body(chosen_llm), timeout=timeout)
+        if 'fim_url' in chosen_llm:
+            return await self.__sessions.request('GET', chosen_llm, chosen_llm['fim_url'], payload.body(chosen_llm, is_fim=True), timeout=timeout)
+        raise FimNotSupportedException()
+
+    async def __get_failover_chain(self, type_str):
+        """The failover chain of the type, with the LLMs sharing a priority in load balancing order"""
+        return deque(self.__balancer.order(await self.__run(self.__manager.get_failover_chain, type_str)))
+
+    async def __call_llm_guarded(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the LLM within its concurrency limit, and records the outcome in its circuit breaker, in the load balancer
+        and in the concurrency limiter. The caller checks the circuit first. A cancelled call records nothing in the circuit breaker. A successful stream stays in flight
+        until it is closed.
+        """
+        try:
+            await self.__limiter.acquire_async(chosen_llm)
+        except ConcurrencyLimitException:
+            # The call is not made: the half-open trial the caller may have taken is left to the next call
+            self.__breakers.release_trial(chosen_llm)
+            raise
+        response = None
+        failed = False
+        self.__balancer.start(chosen_llm)
+        try:
+            response = await self.__call_llm_replicas(chosen_llm, payload, is_fim, stream, timeout)
+        except (FimNotSupportedException, HttpStreamingNotSupportedException):
+            raise
+        except Exception as e:
+            failed = True
+            # A timeout shortened by the client deadline says nothing of the LLM health
+            if not caused_by_deadline(e, timeout):
+                self.__breakers.record_failure(chosen_llm)
+            raise
+        finally:
+            if response is None or response.status_code != 200:
+                self.__finish_call(chosen_llm, failed=failed or (response is not None and response.status_code >= 500))
+            elif not stream:
+                self.__finish_call(chosen_llm, response.elapsed)
+        self.__breakers.record(chosen_llm, response.status_code)
+        return response
+
+    async def __call_llm_retried(self, chosen_llm, payload, is_fim, stream, deadline, candidates_left, retried_llms):
+        """
+        Calls the LLM, retrying it after a backoff while its errors are retryable and the deadline allows. See
+        RetryPolicy.
+
+        Args:
+            chosen_llm (dict): The LLM record.
+            payload (Payload): The request payload.
+            is_fim (bool): Whether it is a fill in the middle request.
+            stream (bool): Whether it is a streaming request.
+            deadline (Deadline): The request deadline. Each attempt gets the LLM share of the remaining budget.
+            candidates_left (int): The LLMs left to try, this one included.
+            retried_llms (list): Gets the LLM appended on each retry.
+
+        Returns:
+            The last response.
+        """
+        attempt = 1
+        while True:
+            timeout = deadline.attempt_timeouts(chosen_llm, candidates_left)
+            try:
+                response = await self.__call_llm_guarded(chosen_llm, payload, is_fim, stream, timeout)
+            except Exception as e:
+                delay = self.__retries.delay(chosen_llm, attempt, deadline, exception=e)
+                if delay is None:
+                    raise
+                reason = e
+            else:
+                if response.status_code == 200 and attempt > 1:
+                    self.__metrics.increment('retry_successes', chosen_llm)
+                delay = None if response.status_code == 200 else self.__retries.delay(chosen_llm, attempt, deadline, status_code=response.status_code)
+                if delay is None:
+                    return response
+                reason = f"Response code not successful: {response.status_code}"
+                await response.aclose()
+
+            self.__logger.warning(f"Error calling {chosen_llm['name']}: {reason}. Retrying it in {delay:.3f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+            # The circuit may have opened meanwhile, with the failures of the other requests
+            if self.__breakers.is_open(chosen_llm):
+                raise CircuitOpenException(f"The circuit of {chosen_llm['name']} is open. Not retrying it")
+            self.__metrics.increment('retries', chosen_llm)
+            retried_llms.append(f"{chosen_llm['name']}({chosen_llm['model']})")
+            attempt += 1
+
+    def __finish_call(self, chosen_llm, seconds=None, failed=False):
+        """Ends a call started by __call_llm_guarded, in the load balancer and in the concurrency limiter"""
+        self.__balancer.finish(chosen_llm, seconds, failed)
+        self.__limiter.release(chosen_llm, seconds, failed)
+
+    async def __call_llm_replicas(self, chosen_llm, payload, is_fim = False, stream = False, timeout = None):
+        """
+        Calls the LLM. If its record lists replicas, a failing replica is ejected and the next one is tried before
+        the call fails. See ReplicaPool. The replicas tried share the timeouts of the attempt.
+        """
+        replicas = self.__replicas.order(chosen_llm)
+        if len(replicas) == 1:
+            return await self.__call_llm(replicas[0], payload, is_fim, stream, timeout)
+
+        started = time.monotonic()
+        for i, replica_llm in enumerate(replicas):
+            is_last = i == len(replicas) - 1
+            # The budget left is split across the replicas left
+            replica_timeout = timeout.split(time.monotonic() - started, len(replicas) - i) if timeout is not None else None
+            try:
+                response = await self.__call_llm(replica_llm, payload, is_fim, stream, replica_timeout)
+            except (FimNotSupportedException, HttpStreamingNotSupportedException):
+                raise
+            except Exception as e:
+                # A timeout shortened by the deadline says nothing of the replica health
+                if not caused_by_deadline(e, replica_timeout):
+                    self.__replicas.eject(replica_llm, e)
+                if is_last:
+                    raise
+                continue
+            self.__logger.info(f"Replica {replica_llm['replica']} of {replica_llm['name']}: Response_Code: {response.status_code}, Response_Time: {response.elapsed}")
+            if response.status_code >= 500:
+                self.__replicas.eject(replica_llm, f"Response code not successful: {response.status_code}")
+                if not is_last:
+                    await response.aclose()
+                    continue
+            return response
+
+    async def __call_llm_hedged(self, chosen_llm, failover_chain, payload, is_fim, deadline, failed_llms):
+        """
+        Calls the chosen LLM and, if it has not answered within the hedge delay, also the next LLM of the failover chain.
+        The first successful answer wins and the other call is cancelled. See DispatcherController.
+
+        Returns:
+            tuple: The LLM that answered first and its response. The chosen LLM outcome if no call succeeded.
+        """
+        candidates_left = len(failover_chain) + 1
+        primary = asyncio.ensure_future(self.__call_llm_guarded(chosen_llm, payload, is_fim, timeout=deadline.attempt_timeouts(chosen_llm, candidates_left)))
+        calls = {primary: chosen_llm}
+        started = {primary: time.monotonic()}
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.__hedging.delay(chosen_llm))
+            # The hedge LLM is not called while it is unhealthy or its circuit is open
+            if not done and self.__health.is_healthy(failover_chain[0]) and self.__breakers.allow(failover_chain[0]):
+                hedge_llm = failover_chain.popleft()
+                self.__logger.info(f"{chosen_llm['name']} did not answer within the hedge delay. Hedging with {hedge_llm['name']}")
+                hedge = asyncio.ensure_future(self.__call_llm_guarded(hedge_llm, payload, is_fim, timeout=deadline.attempt_timeouts(hedge_llm, candidates_left - 1)))
+                calls[hedge] = hedge_llm
+                started[hedge] = time.monotonic()
+                pending.add(hedge)
+
+            while done or pending:
+                for task in done:
+                    llm = calls[task]
+                    if task.exception() is None and task.result().status_code == 200:
+                        for loser, loser_llm in calls.items():
+                            if loser is not task and loser.done() and (loser.exception() is not None or loser.result().status_code != 200):
+                                failed_llms.append(f"{loser_llm['name']}({loser_llm['model']})")
+                            elif loser is not task:
+                                # The loser was at least this slow, which still counts for its observed latency
+                                self.__hedging.record(loser_llm, time.monotonic() - started[loser])
+                        return llm, task.result()
+                    if llm is not chosen_llm:
+                        self.__logger.error(f"Error calling {llm['name']}: {task.exception() or task.result().status_code}")
+                        failed_llms.append(f"{llm['name']}({llm['model']})")
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # No call succeeded: the failover goes on from the chosen LLM outcome
+        return chosen_llm, primary.result()
+
+    def __classify_prompt(self, data):
+        """
+        The fast path of the prompt detection: a cached detection or a confident local classifier.
+
+        Returns:
+            str: The type of the prompt, or None if the detect LLM is needed.
+        """
+        self.__metrics.increment('detect_requests')
+        type_str, source = self.__classifier.classify(data.get('instruction'))
+        if type_str is not None:
+            self.__metrics.increment(f'detect_{source}_hits')
+            self.__logger.debug(f"Type detected by the {source}: {type_str}")
+        return type_str
+
+    async def __detect_prompt(self, data, log_prefix, log_user, deadline):
+        """
+        Detects the type of prompt from the given data using the Default LLM for detect. See DispatcherController.
+
+        Returns:
+            str: The detected type of the prompt, or None if detection fails.
+        """
+        detect_llm = {'name': 'detect'}
+        try:
+            # Get an LLM of type "detect" - capable of do prompt categorization. Usually codellama.
+            detect_llm = await self.__run(self.__manager.get_llm_by_priority, "detect", 1)
+            self.__logger.debug(f"Chosen LLM is: {detect_llm['name']}")
+            # WARNING: This payload is only used for the classification/detect task.
+            data_detect = {
+                "instruction": data.get('instruction'),
+                "max_new_tokens": 512,
+                "temperature": 0.1,
+                "timeout": 60,
+            }
+
+            # Call The LLM
+            response = await self.__call_llm(detect_llm, Payload(data_detect), timeout=deadline.classifier_timeouts(detect_llm))
+            self.__logger.info(f'{log_prefix} LLM_Name: {detect_llm["name"]}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed}')
+
+            # Strip the detected type from extra chars, giving just the type word
+            type_str = response.text.replace("'", "").replace('"', '').strip().lower()
+
+            # If the detected type is not in the constansts.allowed_detect_types, than the LLM was not able to detect. Raise Exception and stop.
+            if type_str not in constants.allowed_detect_types:
+                raise Exception("Could not detect type")
+            await self.__run(self.__classifier.learn, data.get('instruction'), type_str)
+
+            self.__logger.debug(f"Type detected: {type_str}")
+            return type_str
+        except Exception as e:
+            self.__logger.error(f'{log_prefix} Type: detect, {log_user}')
+            self.__logger.error(f"Error calling {detect_llm['name']}: {e}", exc_info=True)
+            return None
+
+    async def __is_prompt_toxic(self, data, log_prefix, log_user, deadline):
+        """
+        Checks the prompt against the toxicity LLM. As in DispatcherController, a failed check counts as toxic, and a
+        check out of time returns None.
+        """
+        toxicity_llm = {'name': 'toxicity'}
+        with deadline.stage('toxicity'):
+            try:
+                # The clear cases are settled locally
+                toxic, source = self.__toxicity_prefilter.check(data.get('instruction'))
+                if toxic is not None:
+                    self.__metrics.increment(f'toxicity_{source}_hits')
+                    return toxic
+                self.__metrics.increment('toxicity_model_calls')
+
+                # Get an LLM of type "toxicity"
+                toxicity_llm = await self.__run(self.__manager.get_llm_by_priority, "toxicity", 1)
+                self.__logger.debug(f"Chosen LLM is: {toxicity_llm['name']}")
+                data_toxicity = {
+                    "sentence": data.get('instruction'),
+                }
+
+                # Call The LLM
+                response = await self.__sessions.request('GET', toxicity_llm, toxicity_llm['url'], json.dumps(data_toxicity), timeout=deadline.classifier_timeouts(toxicity_llm))
+                self.__logger.info(f'{log_prefix} LLM_Name: {toxicity_llm["name"]}, {log_user}, Request_Bytes: {response.request_bytes}, Response_Bytes: {len(response.content)}, Response_Time: {response.elapsed}')
+
+                # Parse the boolean return
+                toxic = self.__str_to_bool(response.text.replace("'", "").replace('"', '').strip().lower())
+                self.__toxicity_prefilter.remember(data.get('instruction'), toxic)
+                return toxic
+            except (asyncio.TimeoutError, DeadlineExceededException) as e:
+                self.__logger.warning(f"{log_prefix} {log_user}. The toxicity check by {toxicity_llm['name']} ran out of time: {e}")
+                self.__metrics.increment('toxicity_timeouts')
+                return None
+            except Exception as e:
+                self.__logger.error(f'{log_prefix} Type: detect, {log_user}')
+                self.__logger.error(f"Error calling {toxicity_llm['name']}: {e}", exc_info=True)
+                return True
+
+    async def __run(self, function, *args):
+        """Runs a synchronous manager lookup in the default executor, so a slow backend never blocks the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+    def __toxicity_refusal(self, toxic, deadline):
+        """The answer refusing the request after the toxicity check, or None when the prompt may be answered"""
+        if toxic is None:
+            return json.dumps("The request deadline was exceeded"), 504, deadline.headers()
+        if toxic:
+            return self.__toxicity_message, 400
+        return None
+
+    def __str_to_bool(self, v):
+        return v.lower() in ("yes", "true", "t", "1")
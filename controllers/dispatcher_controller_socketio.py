@@ -4,6 +4,7 @@ import socketio
 import logging
 from config.config import Config
 from liev_llm_manager.manager import get_manager
+from controllers.health_checker import get_health_checker
 
 class DispatcherControllerSocketio:
     def __init__(self):
@@ -17,6 +18,9 @@ class DispatcherControllerSocketio:
         self.__logger = logging.getLogger(__name__)
 
         self._connection_map = {}
+
+        # Health of the upstream Socket.io servers, from the background prober
+        self.__health = get_health_checker()
         
 
     def __get_client(self, socketio_server):
@@ -41,6 +45,13 @@ class DispatcherControllerSocketio:
 
         return client
     
+    def __get_stream_llm_name(self, manager, type_str):
+        """The highest priority LLM of the type with a healthy Socket.io server, or the priority 1 LLM if there is none"""
+        for llm in manager.get_failover_chain(type_str):
+            if 'stream_url' in llm and len(llm['stream_url']) > 0 and self.__health.is_healthy(llm, 'stream_url'):
+                return llm['name']
+        return manager.get_llm_by_priority(type = type_str, priority = 1)['name']
+
     def initialize_stream(self, request_data, socketio_server, request_sid):
         client = self.__get_client(socketio_server)
         manager = get_manager()
@@ -53,10 +64,10 @@ class DispatcherControllerSocketio:
                 llm_name = request_data.get('llm_name')
                 self.__logger.debug(f'Socket.io calling by llm_name parameter: {llm_name}')
             elif 'function' in request_data:
-                llm_name = manager.get_llm_by_priority(type = request_data['function'], priority = 1)['name']
+                llm_name = self.__get_stream_llm_name(manager, request_data['function'])
                 self.__logger.debug(f'Socket.io calling by function parameter: {llm_name}')
             elif 'type' in request_data:
-                llm_name = manager.get_llm_by_priority(type = request_data['type'], priority = 1)['name']
+                llm_name = self.__get_stream_llm_name(manager, request_data['type'])
                 self.__logger.debug(f'Socket.io calling by type parameter: {llm_name}')
             else:
                 self.__logger.error('You must specify an llm_name or function/type')
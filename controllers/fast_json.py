@@ -0,0 +1,93 @@
+"""
+JSON helpers for the bodies the dispatcher builds itself (multi-LLM answers, LLM payloads), without decoding the
+upstream answers into Python objects and encoding them back.
+
+The upstream bodies are checked once and spliced as raw bytes. A body that is not JSON (e.g. text/plain) is
+embedded as a JSON string. JSON_BACKEND selects the parser and serializer: 'orjson' if installed ('auto', the
+default), or the standard 'json' module.
+"""
+import json
+import logging
+import math
+from config.config import Config
+
+_backend = Config('dispatcher').get('JSON_BACKEND', 'auto')
+orjson = None
+if _backend in ('auto', 'orjson'):
+    try:
+        import orjson
+    except ImportError:
+        if _backend == 'orjson':
+            logging.getLogger(__name__).warning('JSON_BACKEND is orjson, but orjson is not installed. Using json')
+
+
+def dumps(value, sort_keys=False):
+    """Serializes a value to JSON bytes. With sort_keys, equal values give the same bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+        except TypeError:
+            # E.g. integers beyond 64 bits, parsed by json
+            pass
+    try:
+        return json.dumps(value, ensure_ascii=False, sort_keys=sort_keys, allow_nan=False).encode()
+    except ValueError:
+        # NaN and the infinities are not JSON. Written as null, as orjson does
+        return json.dumps(_finite(value), ensure_ascii=False, sort_keys=sort_keys, allow_nan=False).encode()
+
+
+def _finite(value):
+    """The value with its NaN and infinite floats replaced by None"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    return value
+
+
+def is_json(body):
+    """Whether the bytes are one valid JSON document"""
+    try:
+        if orjson is not None:
+            orjson.loads(body)
+        else:
+            # Only UTF-8 can be spliced, while json.loads also detects UTF-16 and UTF-32
+            json.loads(body.decode('utf-8'))
+        return True
+    except ValueError:
+        return False
+
+
+def raw_value(body):
+    """
+    An upstream body as a JSON value to splice in a document.
+
+    Args:
+        body (bytes): The upstream body.
+
+    Returns:
+        bytes: The body itself if it is JSON, otherwise the body as a JSON string.
+    """
+    if body and is_json(body):
+        return body
+    return dumps(body.decode('utf-8', errors='replace'))
+
+
+def splice_object(fields):
+    """
+    A JSON object of pre-encoded values.
+
+    Args:
+        fields (list): (key, JSON bytes) pairs.
+
+    Returns:
+        bytes: The object.
+    """
+    return b'{' + b','.join(dumps(key) + b':' + value for key, value in fields) + b'}'
+
+
+def splice_array(values):
+    """A JSON array of pre-encoded values"""
+    return b'[' + b','.join(values) + b']'
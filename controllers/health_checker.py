@@ -0,0 +1,147 @@
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import concurrent.futures
+from urllib.parse import urlparse
+from config.config import Config
+from liev_llm_manager.manager import get_manager
+from controllers.session_pool import SessionPool
+
+
+class HealthChecker:
+    """
+    Background prober of the upstream LLMs.
+
+    Every HEALTH_CHECK_INTERVAL seconds, with HEALTH_CHECK_JITTER, each LLM url and http_stream_url gets a request
+    with the cheap HEALTH_CHECK_PAYLOAD, and each stream_url (Socket.io) gets a TCP connect. An address is unhealthy
+    after HEALTH_CHECK_FAILURE_THRESHOLD failed probes in a row, and healthy again after one successful probe.
+    A 4xx answer counts as healthy: the server is up. Addresses not probed yet are considered healthy.
+
+    The health_check field of an LLM record sets its probe: 'request', 'tcp' (a TCP connect to every address) or
+    'off'. Without it, the external LLMs, billed per request, get the HEALTH_CHECK_EXTERNAL probe, 'off' by default.
+
+    The types of HEALTH_REQUIRED_TYPES without a healthy url make the dispatcher not ready.
+    """
+
+    PROBED_FIELDS = ('url', 'stream_url', 'http_stream_url')
+    PROBES = ('request', 'tcp', 'off')
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__manager = get_manager()
+        self.__sessions = SessionPool()
+        self.__interval = float(self.__config.get('HEALTH_CHECK_INTERVAL', '30'))
+        self.__jitter = float(self.__config.get('HEALTH_CHECK_JITTER', '0.1'))
+        self.__timeout = float(self.__config.get('HEALTH_CHECK_TIMEOUT', '5'))
+        self.__failure_threshold = int(self.__config.get('HEALTH_CHECK_FAILURE_THRESHOLD', '2'))
+        self.__payload = self.__config.get('HEALTH_CHECK_PAYLOAD', json.dumps({'instruction': 'ping', 'max_new_tokens': 1}))
+        self.__external_probe = self.__config.get('HEALTH_CHECK_EXTERNAL', 'off')
+        self.__required_types = [type_str.strip() for type_str in self.__config.get('HEALTH_REQUIRED_TYPES', '').split(',') if type_str.strip()]
+        # (LLM name, field) -> consecutive failed probes
+        self.__failures = {}
+        # The required types without a healthy LLM, as of the last round
+        self.__unavailable_types = []
+        if self.__interval > 0:
+            threading.Thread(target=self.__run, name='health-checker', daemon=True).start()
+
+    def is_healthy(self, llm, field='url'):
+        """
+        Whether the address of the LLM in the field answered its last probes.
+
+        Args:
+            llm (dict): The LLM record.
+            field (str): url, stream_url or http_stream_url.
+        """
+        return self.__failures.get((llm['name'], field), 0) < self.__failure_threshold
+
+    def ready(self):
+        """
+        Returns:
+            tuple: Whether every required type has a healthy LLM, and the required types without one.
+        """
+        unavailable_types = self.__unavailable_types
+        return len(unavailable_types) == 0, unavailable_types
+
+    def __run(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=int(self.__config.get('HEALTH_CHECK_WORKERS', '8')), thread_name_prefix='health-probe') as executor:
+            while True:
+                try:
+                    self.__check(executor)
+                except Exception as e:
+                    self.__logger.error(f"Error checking the LLMs health: {e}", exc_info=True)
+                # Jitter, so the workers of a deployment do not probe the model servers at the same time
+                time.sleep(self.__interval * random.uniform(1 - self.__jitter, 1 + self.__jitter))
+
+    def __check(self, executor):
+        llms = self.__manager.get_all_llms()
+        probes = {}
+        for llm in llms:
+            probe = self.__probe_of(llm)
+            if probe == 'off':
+                continue
+            for field in self.PROBED_FIELDS:
+                if llm.get(field):
+                    probes[executor.submit(self.__probe, llm, field, probe)] = (llm, field)
+        failures = {}
+        for future in concurrent.futures.as_completed(probes):
+            llm, field = probes[future]
+            key = (llm['name'], field)
+            if future.result():
+                if self.__failures.get(key, 0) >= self.__failure_threshold:
+                    self.__logger.info(f"{llm['name']} {field} is healthy again")
+                continue
+            failures[key] = self.__failures.get(key, 0) + 1
+            if failures[key] == self.__failure_threshold:
+                self.__logger.warning(f"{llm['name']} {field} is unhealthy: {llm[field]}")
+        # Swapped in one step, as the readers do not lock
+        self.__failures = failures
+
+        unavailable_types = []
+        for type_str in self.__required_types:
+            if not any(self.is_healthy(llm) for llm in self.__manager.get_llms_by_type(type_str)):
+                unavailable_types.append(type_str)
+        if unavailable_types and unavailable_types != self.__unavailable_types:
+            self.__logger.error(f"No healthy LLM for the required types: {', '.join(unavailable_types)}. Dispatcher not ready")
+        self.__unavailable_types = unavailable_types
+
+    def __probe_of(self, llm):
+        probe = llm.get('health_check')
+        if not probe:
+            is_external = str(llm.get('is_external', False)).lower() in ("yes", "true", "t", "1")
+            probe = self.__external_probe if is_external else 'request'
+        if probe not in self.PROBES:
+            self.__logger.warning(f"Unknown health_check {probe} of {llm['name']}. Probing it with requests")
+            return 'request'
+        return probe
+
+    def __probe(self, llm, field, probe='request'):
+        try:
+            if field == 'stream_url' or probe == 'tcp':
+                address = urlparse(llm[field])
+                port = address.port or (443 if address.scheme in ('https', 'wss') else 80)
+                with socket.create_connection((address.hostname, port), timeout=self.__timeout):
+                    return True
+            method = 'POST' if field == 'http_stream_url' else 'GET'
+            with self.__sessions.request(method, llm, llm[field], data=self.__payload, stream=True, timeout=self.__timeout) as response:
+                return response.status_code < 500
+        except Exception as e:
+            self.__logger.debug(f"Health probe of {llm['name']} {field} failed: {e}")
+            return False
+
+
+# One health checker per process, shared by the controllers and the readiness probe
+_health_checker = None
+_health_checker_lock = threading.Lock()
+
+def get_health_checker():
+    global _health_checker
+    if _health_checker is not None:
+        return _health_checker
+    with _health_checker_lock:
+        if _health_checker is None:
+            _health_checker = HealthChecker()
+    return _health_checker
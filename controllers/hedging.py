@@ -0,0 +1,51 @@
+import threading
+from collections import deque
+from config.config import Config
+
+
+class HedgePolicy:
+    """
+    Decides when a request is hedged: a duplicate is sent to the next LLM of the failover chain when the first one
+    has not answered within a delay. The first successful answer wins.
+
+    Only the types in HEDGE_TYPES are hedged. The delay is HEDGE_DELAY_MS if set, otherwise the observed p95
+    latency of the LLM, from its last HEDGE_WINDOW successful calls. Until HEDGE_MIN_SAMPLES calls are observed,
+    HEDGE_DEFAULT_DELAY_MS is used.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__types = set(filter(None, (type_str.strip() for type_str in self.__config.get('HEDGE_TYPES', '').split(','))))
+        delay_ms = self.__config.get('HEDGE_DELAY_MS')
+        self.__fixed_delay = float(delay_ms) / 1000 if delay_ms else None
+        self.__default_delay = float(self.__config.get('HEDGE_DEFAULT_DELAY_MS', '2000')) / 1000
+        self.__min_samples = int(self.__config.get('HEDGE_MIN_SAMPLES', '20'))
+        self.__window = int(self.__config.get('HEDGE_WINDOW', '200'))
+        self.__lock = threading.Lock()
+        # LLM name -> latencies in seconds of its last successful calls
+        self.__latencies = {}
+
+    def should_hedge(self, type_str, candidates_left):
+        """
+        Args:
+            type_str (str): The type of the request.
+            candidates_left (int): LLMs left in the failover chain after the current one.
+        """
+        return type_str in self.__types and candidates_left > 0
+
+    def delay(self, llm):
+        """Seconds to wait for the LLM before sending the hedge"""
+        if self.__fixed_delay is not None:
+            return self.__fixed_delay
+        with self.__lock:
+            latencies = sorted(self.__latencies.get(llm['name'], ()))
+        if len(latencies) < self.__min_samples:
+            return self.__default_delay
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def record(self, llm, seconds):
+        """Records the latency of a successful call to the LLM"""
+        with self.__lock:
+            if llm['name'] not in self.__latencies:
+                self.__latencies[llm['name']] = deque(maxlen=self.__window)
+            self.__latencies[llm['name']].append(seconds)
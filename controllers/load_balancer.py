@@ -0,0 +1,80 @@
+import random
+import threading
+from config.config import Config
+
+
+class LoadBalancer:
+    """
+    Spreads the requests of a type across its LLMs of equal priority.
+
+    Each LLM has a count of in-flight calls and an EWMA of its response time. Within a priority, the first LLM
+    tried is picked by the power of two choices: of two random LLMs, the one with the lowest
+    (in-flight + 1) * EWMA. The other LLMs of the priority follow, by the same score, then the next priority.
+    An LLM without an observed response time scores 0, so new model servers get traffic right away. A failed call
+    counts in the EWMA as a response time of LB_FAILURE_PENALTY seconds, so an LLM failing fast does not win.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__alpha = float(self.__config.get('LB_EWMA_ALPHA', '0.3'))
+        self.__failure_penalty = float(self.__config.get('LB_FAILURE_PENALTY', '10'))
+        self.__lock = threading.Lock()
+        # LLM name -> in-flight calls
+        self.__in_flight = {}
+        # LLM name -> EWMA of the response time in seconds
+        self.__ewma = {}
+
+    def order(self, chain):
+        """
+        Reorders a failover chain, sorted by priority, so that the LLMs sharing a priority are balanced.
+
+        Args:
+            chain (list): The LLMs of the type, ordered by priority.
+
+        Returns:
+            list: The same LLMs, in the order they should be tried.
+        """
+        ordered = []
+        start = 0
+        while start < len(chain):
+            end = start + 1
+            while end < len(chain) and chain[end]['priority'] == chain[start]['priority']:
+                end += 1
+            ordered.extend(self.__order_group(chain[start:end]))
+            start = end
+        return ordered
+
+    def __order_group(self, group):
+        if len(group) == 1:
+            return group
+        with self.__lock:
+            scores = {llm['name']: ((self.__in_flight.get(llm['name'], 0) + 1) * self.__ewma.get(llm['name'], 0), self.__in_flight.get(llm['name'], 0)) for llm in group}
+        first, second = random.sample(group, 2)
+        chosen = first if scores[first['name']] <= scores[second['name']] else second
+        return [chosen] + sorted((llm for llm in group if llm is not chosen), key=lambda llm: scores[llm['name']])
+
+    def start(self, llm):
+        """Counts a call to the LLM as in flight"""
+        with self.__lock:
+            self.__in_flight[llm['name']] = self.__in_flight.get(llm['name'], 0) + 1
+
+    def finish(self, llm, seconds=None, failed=False):
+        """
+        Counts a call to the LLM as done.
+
+        Args:
+            llm (dict): The LLM record.
+            seconds (float): The response time, for successful calls. None otherwise.
+            failed (bool): Whether the call failed (connection error, timeout or 5xx answer).
+        """
+        if failed:
+            seconds = self.__failure_penalty
+        with self.__lock:
+            in_flight = self.__in_flight.get(llm['name'], 0) - 1
+            if in_flight > 0:
+                self.__in_flight[llm['name']] = in_flight
+            else:
+                self.__in_flight.pop(llm['name'], None)
+            if seconds is not None:
+                ewma = self.__ewma.get(llm['name'])
+                self.__ewma[llm['name']] = seconds if ewma is None else self.__alpha * seconds + (1 - self.__alpha) * ewma
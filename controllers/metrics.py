@@ -0,0 +1,38 @@
+import threading
+
+
+class Metrics:
+    """
+    Counters of the dispatcher, in total and per LLM, served by the /v1/metrics route.
+    They count since the process started, one set per worker process.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        # Counter name -> {'total', 'by_llm': {LLM name -> count}}
+        self.__counters = {}
+
+    def increment(self, name, llm=None, value=1):
+        with self.__lock:
+            counter = self.__counters.setdefault(name, {'total': 0, 'by_llm': {}})
+            counter['total'] += value
+            if llm is not None:
+                counter['by_llm'][llm['name']] = counter['by_llm'].get(llm['name'], 0) + value
+
+    def snapshot(self):
+        with self.__lock:
+            return {name: {'total': counter['total'], 'by_llm': dict(counter['by_llm'])} for name, counter in self.__counters.items()}
+
+
+# One set of counters per process, shared by the controllers
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    global _metrics
+    if _metrics is not None:
+        return _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+    return _metrics
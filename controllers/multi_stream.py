@@ -0,0 +1,49 @@
+"""
+Streamed answers of the multi-LLM ("all") requests: each LLM answer is written as soon as it completes, instead of
+one JSON array once the slowest LLM answered. The client opts in with its Accept header.
+"""
+import controllers.fast_json as fast_json
+
+NDJSON_MIME = 'application/x-ndjson'
+EVENT_STREAM_MIME = 'text/event-stream'
+
+
+def stream_mime(accept):
+    """
+    The streaming format asked for by an Accept header.
+
+    Args:
+        accept (str): The Accept header of the request, if any.
+
+    Returns:
+        str: NDJSON_MIME or EVENT_STREAM_MIME, or None for the combined JSON array.
+    """
+    if not accept:
+        return None
+    for mime in (NDJSON_MIME, EVENT_STREAM_MIME):
+        if mime in accept:
+            return mime
+    return None
+
+
+def encode(mime, name, body=None, error=None):
+    """
+    One streamed answer: an NDJSON line, or a server-sent event named 'response' or 'error'.
+
+    Args:
+        mime (str): NDJSON_MIME or EVENT_STREAM_MIME.
+        name (str): The LLM, as name(model).
+        body (bytes): The upstream answer, spliced as is if it is JSON. See fast_json.raw_value.
+        error (str): The error of a failed LLM, instead of a body.
+
+    Returns:
+        bytes: The encoded answer.
+    """
+    if error is None:
+        # Line breaks of a pretty-printed JSON body can only be whitespace between its tokens
+        line = fast_json.splice_object([('name', fast_json.dumps(name)), ('response', fast_json.raw_value(body).replace(b'\r', b' ').replace(b'\n', b' '))])
+    else:
+        line = fast_json.splice_object([('name', fast_json.dumps(name)), ('error', fast_json.dumps(str(error)))])
+    if mime == EVENT_STREAM_MIME:
+        return b'event: ' + (b'response' if error is None else b'error') + b'\ndata: ' + line + b'\n\n'
+    return line + b'\n'
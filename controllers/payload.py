@@ -0,0 +1,75 @@
+import hashlib
+import controllers.fast_json as fast_json
+
+
+class Payload:
+    """
+    The body of a request to the dispatcher, as sent to each LLM attempt. The parsed request is never changed, so
+    retries, hedges and failovers all start from what the client sent.
+
+    When the LLM has no prompt_mask nor system_message, the original bytes are forwarded as they are. Otherwise the
+    body is serialized from the parsed request with the LLM overlay (the masked instruction and the system_msg),
+    once per distinct overlay.
+    """
+
+    # Options of the dispatcher, not of the LLM generation. Left out of the digest
+    DISPATCHER_FIELDS = ('try_next_on_failure', 'llm_name', 'type', 'function', 'first_n', 'cache')
+
+    def __init__(self, data, raw=None) -> None:
+        """
+        Args:
+            data (dict): The parsed request. Read only.
+            raw (bytes): The request body data was parsed from, if available.
+        """
+        self.__data = data
+        self.__raw = raw
+        # Overlay -> serialized body
+        self.__bodies = {}
+        # Overlay -> digest
+        self.__digests = {}
+
+    def body(self, llm, is_fim=False):
+        """
+        The body to send to the LLM.
+
+        Args:
+            llm (dict): The LLM record. Its prompt_mask and system_message fields are applied.
+            is_fim (bool): Whether it is a fill in the middle request, sent without the LLM overlay.
+
+        Returns:
+            bytes: The JSON body.
+        """
+        overlay = () if is_fim else self.__overlay(llm)
+        if not overlay and self.__raw is not None:
+            return self.__raw
+        body = self.__bodies.get(overlay)
+        if body is None:
+            body = fast_json.dumps({**self.__data, **dict(overlay)})
+            self.__bodies[overlay] = body
+        return body
+
+    def digest(self, llm, is_fim=False):
+        """
+        A hash of the body sent to the LLM, the same for equal JSON documents whatever their key order and spacing.
+        The DISPATCHER_FIELDS are left out.
+
+        Returns:
+            str: The SHA-256 of the normalized body.
+        """
+        overlay = () if is_fim else self.__overlay(llm)
+        digest = self.__digests.get(overlay)
+        if digest is None:
+            document = {key: value for key, value in {**self.__data, **dict(overlay)}.items() if key not in self.DISPATCHER_FIELDS}
+            digest = hashlib.sha256(fast_json.dumps(document, sort_keys=True)).hexdigest()
+            self.__digests[overlay] = digest
+        return digest
+
+    def __overlay(self, llm):
+        overlay = []
+        # Set the prompt in the prompt mask defined in the LLM configuration. E.g. "Generate unit tests for the code: %PROMPT%"
+        if 'instruction' in self.__data and llm.get('prompt_mask'):
+            overlay.append(('instruction', llm['prompt_mask'].replace('%PROMPT%', self.__data['instruction'])))
+        # Use the default system message, if defined in the LLM configuration
+        if llm.get('system_message'):
+            overlay.append(('system_msg', llm['system_message']))
+        return tuple(overlay)
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from config.config import Config
+import controllers.constants as constants
+from controllers.similarity_cache import normalized_words
+
+
+class PromptClassifier:
+    """
+    Fast path of the prompt detection, answering before the detect LLM when it can.
+
+    The types detected by the LLM are cached by a hash of the normalized instruction (see normalized_words), up to
+    DETECT_CACHE_MAX_ENTRIES for DETECT_CACHE_TTL seconds. With DETECT_CLASSIFIER, a naive Bayes classifier of the
+    words and word pairs of the instruction learns from every LLM detection. Once it has seen
+    DETECT_CLASSIFIER_MIN_SAMPLES, it answers when the probability of its type reaches DETECT_CLASSIFIER_CONFIDENCE.
+
+    With DETECT_CLASSIFIER_LOG, the LLM detections are appended to that JSON lines file ({"instruction", "type"}),
+    and the classifier is trained from it at startup. The file holds prompts: keep it where the logs may be kept.
+    Once it reaches DETECT_CLASSIFIER_LOG_MAX_BYTES, it is rotated to the same path with a '.1' suffix, replacing
+    the previous one. So at most twice that size of the latest detections is kept and replayed at startup.
+    """
+
+    # The type shows in the beginning of a prompt. The words after it are not classified, bounding the cost
+    MAX_WORDS = 512
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__cache_max_entries = int(self.__config.get('DETECT_CACHE_MAX_ENTRIES', '10000'))
+        self.__cache_ttl = float(self.__config.get('DETECT_CACHE_TTL', '86400'))
+        self.__classifier = self.__config.get('DETECT_CLASSIFIER', 'false').lower() in ("yes", "true", "t", "1")
+        self.__min_samples = int(self.__config.get('DETECT_CLASSIFIER_MIN_SAMPLES', '200'))
+        self.__confidence = float(self.__config.get('DETECT_CLASSIFIER_CONFIDENCE', '0.95'))
+        self.__log_path = self.__config.get('DETECT_CLASSIFIER_LOG', None)
+        self.__log_max_bytes = int(self.__config.get('DETECT_CLASSIFIER_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+        self.__lock = threading.Lock()
+        # Instruction hash -> (expires, type), least recently used first
+        self.__cache = OrderedDict()
+        # Type -> number of samples, type -> {feature -> count}, type -> number of features, all the features
+        self.__samples = {}
+        self.__counts = {}
+        self.__totals = {}
+        self.__vocabulary = set()
+        if self.__classifier and self.__log_path:
+            self.__train_from_log()
+
+    def classify(self, instruction):
+        """
+        The type of the instruction, without calling the detect LLM.
+
+        Args:
+            instruction (str): The prompt.
+
+        Returns:
+            tuple: (type, source), source being 'cache' or 'classifier'. (None, None) when the LLM must detect it.
+        """
+        if not isinstance(instruction, str):
+            return None, None
+        words = normalized_words(instruction)
+        key = self.__key(words)
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.__cache.move_to_end(key)
+                return entry[1], 'cache'
+            if not self.__classifier or sum(self.__samples.values()) < self.__min_samples:
+                return None, None
+            type_str, probability = self.__predict(self.__features(words))
+        if type_str in constants.allowed_detect_types and probability >= self.__confidence:
+            return type_str, 'classifier'
+        return None, None
+
+    def learn(self, instruction, type_str):
+        """Caches and learns the type detected by the LLM. It must be one of constants.allowed_detect_types"""
+        if not isinstance(instruction, str):
+            return
+        words = normalized_words(instruction)
+        key = self.__key(words)
+        with self.__lock:
+            self.__cache.pop(key, None)
+            if self.__cache_max_entries > 0:
+                self.__cache[key] = (time.monotonic() + self.__cache_ttl, type_str)
+                while len(self.__cache) > self.__cache_max_entries:
+                    self.__cache.popitem(last=False)
+            if self.__classifier:
+                self.__train(self.__features(words), type_str)
+        if self.__classifier and self.__log_path:
+            try:
+                with open(self.__log_path, 'a', encoding='utf-8') as log:
+                    log.write(json.dumps({'instruction': instruction, 'type': type_str}, ensure_ascii=False) + '\n')
+                    size = log.tell()
+                # The workers share the file: the first one past the size rotates it, the others find it rotated
+                if size >= self.__log_max_bytes and os.path.getsize(self.__log_path) >= self.__log_max_bytes:
+                    os.replace(self.__log_path, f'{self.__log_path}.1')
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.__logger.warning(f'Could not log the detected type to {self.__log_path}: {e}')
+
+    def __train_from_log(self):
+        # The rotated detections first, the oldest
+        for path in (f'{self.__log_path}.1', self.__log_path):
+            try:
+                with open(path, encoding='utf-8') as log:
+                    for line in log:
+                        try:
+                            sample = json.loads(line)
+                        except ValueError:
+                            continue
+                        if sample.get('type') in constants.allowed_detect_types and isinstance(sample.get('instruction'), str):
+                            self.__train(self.__features(normalized_words(sample['instruction'])), sample['type'])
+            except FileNotFoundError:
+                continue
+        if not self.__samples:
+            return
+        self.__logger.info(f'Prompt classifier trained with {sum(self.__samples.values())} detections from {self.__log_path}')
+
+    def __train(self, features, type_str):
+        self.__samples[type_str] = self.__samples.get(type_str, 0) + 1
+        counts = self.__counts.setdefault(type_str, {})
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+        self.__totals[type_str] = self.__totals.get(type_str, 0) + len(features)
+        self.__vocabulary.update(features)
+
+    def __predict(self, features):
+        # Multinomial naive Bayes with Laplace smoothing. Returns the most likely type and its posterior probability
+        samples = sum(self.__samples.values())
+        vocabulary = len(self.__vocabulary) + 1
+        scores = {}
+        for type_str, type_samples in self.__samples.items():
+            counts = self.__counts[type_str]
+            denominator = math.log(self.__totals[type_str] + vocabulary)
+            scores[type_str] = math.log(type_samples / samples) + sum(math.log(counts.get(feature, 0) + 1) - denominator for feature in features)
+        best = max(scores, key=scores.get)
+        return best, 1 / sum(math.exp(score - scores[best]) for score in scores.values())
+
+    @staticmethod
+    def __features(words):
+        words = words[:PromptClassifier.MAX_WORDS]
+        return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+    @staticmethod
+    def __key(words):
+        return hashlib.sha256(' '.join(words).encode()).digest()
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from config.config import Config
+
+
+class ReplicaPool:
+    """
+    Replicas of the LLMs whose record lists several model servers under one name.
+
+    An LLM record may have a replicas list of {url, stream_url, http_stream_url, fim_url, weight}. The fields a
+    replica does not set come from the record. Each call picks a replica by smooth weighted round robin. A replica
+    that fails is ejected for REPLICA_EJECT_SECONDS and the call goes to the next one, before the dispatcher gives
+    up on the LLM. If every replica is ejected, they are all tried, as an ejection may be stale.
+    """
+
+    URL_FIELDS = ('url', 'stream_url', 'http_stream_url', 'fim_url')
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__eject_seconds = float(self.__config.get('REPLICA_EJECT_SECONDS', '30'))
+        self.__lock = threading.Lock()
+        # LLM name -> (replica list signature, current weights of the smooth weighted round robin)
+        self.__weights = {}
+        # (LLM name, replica url) -> ejected until
+        self.__ejected = {}
+
+    def order(self, llm):
+        """
+        The replicas to try for a call to the LLM, in order.
+
+        Args:
+            llm (dict): The LLM record.
+
+        Returns:
+            list: The LLM record once per replica, with the replica addresses and the replica field set to its url.
+                  The record itself if it has no replicas.
+        """
+        replicas = llm.get('replicas')
+        if not replicas:
+            return [llm]
+        now = time.monotonic()
+        with self.__lock:
+            available = [i for i, replica in enumerate(replicas) if self.__ejected.get((llm['name'], replica['url']), 0) <= now]
+            if not available:
+                available = list(range(len(replicas)))
+            signature = tuple((replica['url'], int(replica.get('weight', 1))) for replica in replicas)
+            entry = self.__weights.get(llm['name'])
+            if entry is None or entry[0] != signature:
+                entry = (signature, [0] * len(replicas))
+                self.__weights[llm['name']] = entry
+            current = entry[1]
+
+            # Smooth weighted round robin: every available replica gains its weight, the highest one is picked
+            # and loses the total
+            total = 0
+            for i in available:
+                current[i] += signature[i][1]
+                total += signature[i][1]
+            chosen = max(available, key=lambda i: current[i])
+            current[chosen] -= total
+
+        ordered = [chosen] + sorted((i for i in available if i != chosen), key=lambda i: -signature[i][1])
+        return [self.__replica_llm(llm, replicas[i]) for i in ordered]
+
+    def eject(self, llm, reason):
+        """Ejects the replica of the LLM view returned by order()"""
+        if 'replica' not in llm:
+            return
+        self.__logger.warning(f"Replica {llm['replica']} of {llm['name']} ejected for {self.__eject_seconds}s: {reason}")
+        with self.__lock:
+            self.__ejected[(llm['name'], llm['replica'])] = time.monotonic() + self.__eject_seconds
+
+    def __replica_llm(self, llm, replica):
+        replica_llm = {**llm, 'replica': replica['url']}
+        for field in self.URL_FIELDS:
+            if replica.get(field):
+                replica_llm[field] = replica[field]
+        return replica_llm
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+from config.config import Config
+
+
+class ResponseCache:
+    """
+    Exact-match cache of the LLM answers, for repeated deterministic prompts.
+
+    An answer is cached under the LLM name, its model and a hash of the payload it was sent (see Payload.digest),
+    for RESPONSE_CACHE_TTL seconds. The least recently used answers are evicted beyond RESPONSE_CACHE_MAX_BYTES.
+    Only successful, non streamed answers of the types in RESPONSE_CACHE_TYPES (all types if unset) are cached. With
+    RESPONSE_CACHE_DETERMINISTIC_ONLY, only the requests with temperature 0 or do_sample false are. A request
+    sending "cache": false bypasses the cache.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__enabled = self.__config.get('RESPONSE_CACHE', 'false').lower() in ("yes", "true", "t", "1")
+        self.__types = {type_str.strip() for type_str in self.__config.get('RESPONSE_CACHE_TYPES', '').split(',') if type_str.strip()}
+        self.__deterministic_only = self.__config.get('RESPONSE_CACHE_DETERMINISTIC_ONLY', 'true').lower() in ("yes", "true", "t", "1")
+        self.__ttl = float(self.__config.get('RESPONSE_CACHE_TTL', '3600'))
+        self.__max_bytes = int(self.__config.get('RESPONSE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+        self.__max_entry_bytes = int(self.__config.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024)))
+        self.__lock = threading.Lock()
+        # Key -> (expires, answer), least recently used first
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+
+    def applies(self, type_str, data, stream=False):
+        """
+        Whether the answers of a request may be served from and stored in the cache.
+
+        Args:
+            type_str (str): The type of the request.
+            data (dict): The request payload.
+            stream (bool): Whether the answer is streamed.
+
+        Returns:
+            bool: True if the cache applies.
+        """
+        if not self.__enabled or stream or data.get('cache', True) is False:
+            return False
+        if self.__types and type_str not in self.__types:
+            return False
+        if self.__deterministic_only:
+            return data.get('temperature') == 0 or data.get('do_sample') is False
+        return True
+
+    def key(self, llm, payload, is_fim=False):
+        """The cache key of a call to the LLM with the payload"""
+        return llm['name'], llm['model'], is_fim, payload.digest(llm, is_fim)
+
+    def get(self, key):
+        """
+        The cached answer, if any.
+
+        Returns:
+            bytes: The answer, or None if it is not cached or has expired.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self.__remove(key)
+                return None
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, answer):
+        """Caches an answer, evicting the least recently used ones beyond the memory bound"""
+        if len(answer) > self.__max_entry_bytes:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.monotonic() + self.__ttl, answer)
+            self.__bytes += len(answer)
+            while self.__bytes > self.__max_bytes:
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key):
+        expires, answer = self.__entries.pop(key)
+        self.__bytes -= len(answer)
@@ -0,0 +1,69 @@
+import asyncio
+import random
+import aiohttp
+import requests
+from config.config import Config
+
+# A connect timeout is retried like a refused connection. aiohttp tells it from the read timeouts since 3.10
+_CONNECT_TIMEOUTS = (requests.exceptions.ConnectTimeout, getattr(aiohttp, 'ConnectionTimeoutError', ()))
+
+
+class RetryPolicy:
+    """
+    When a failed call is retried on the same LLM before the failover moves to the next priority.
+
+    A call is retried on the status codes of RETRY_STATUS_CODES and on connection errors (refused, reset, connect
+    timeout), not on read timeouts. An LLM is called RETRY_MAX_ATTEMPTS times at most. The LLM record may override
+    both with its retry_max_attempts and retry_status_codes fields. Between attempts, the wait is a random share (full jitter)
+    of RETRY_BACKOFF_MS doubled on each attempt, up to RETRY_BACKOFF_MAX_MS. No retry is made when the request
+    deadline would expire during the wait.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__max_attempts = int(self.__config.get('RETRY_MAX_ATTEMPTS', '2'))
+        self.__status_codes = self.__parse_status_codes(self.__config.get('RETRY_STATUS_CODES', '502,503,504'))
+        self.__backoff = float(self.__config.get('RETRY_BACKOFF_MS', '100')) / 1000
+        self.__backoff_max = float(self.__config.get('RETRY_BACKOFF_MAX_MS', '1000')) / 1000
+
+    def delay(self, llm, attempt, deadline, status_code=None, exception=None):
+        """
+        Whether to retry after a failed attempt, and how long to wait first.
+
+        Args:
+            llm (dict): The LLM record.
+            attempt (int): The number of the failed attempt, from 1.
+            deadline (Deadline): The request deadline.
+            status_code (int): The status code of the answer, if any.
+            exception (Exception): The error of the call, if it got no answer.
+
+        Returns:
+            float: Seconds to wait before the next attempt, or None if the call is not retried.
+        """
+        if attempt >= int(llm.get('retry_max_attempts') or self.__max_attempts):
+            return None
+        if exception is not None and not self.__is_retryable_error(exception):
+            return None
+        if exception is None:
+            status_codes = self.__parse_status_codes(llm['retry_status_codes']) if llm.get('retry_status_codes') else self.__status_codes
+            if status_code not in status_codes:
+                return None
+        delay = random.uniform(0, min(self.__backoff_max, self.__backoff * 2 ** (attempt - 1)))
+        remaining = deadline.remaining()
+        if remaining is not None and remaining <= delay:
+            return None
+        return delay
+
+    def __is_retryable_error(self, exception):
+        if isinstance(exception, _CONNECT_TIMEOUTS):
+            return True
+        # A read timeout already used the attempt budget: the failover goes on
+        if isinstance(exception, (requests.exceptions.ReadTimeout, asyncio.TimeoutError)):
+            return False
+        return isinstance(exception, (requests.exceptions.ConnectionError, aiohttp.ClientConnectionError))
+
+    @staticmethod
+    def __parse_status_codes(status_codes):
+        if isinstance(status_codes, str):
+            status_codes = status_codes.split(',')
+        return {int(status_code) for status_code in status_codes if str(status_code).strip()}
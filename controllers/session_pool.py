@@ -0,0 +1,277 @@
+import base64
+import functools
+import logging
+import threading
+import time
+import aiohttp
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from config.config import Config
+from exception.exceptions import DeadlineExceededException
+from controllers.deadline import Timeouts
+
+
+def basic_auth_headers(llm):
+    """Builds the Basic auth header of the LLM model server once, instead of a new HTTPBasicAuth per call"""
+    credentials = f"{llm['username']}:{llm['password']}".encode('latin1')
+    return {'Authorization': f"Basic {base64.b64encode(credentials).decode('ascii')}"}
+
+
+class SessionPool:
+    """
+    Keep-alive HTTP sessions, one per upstream LLM.
+
+    Each LLM gets its own requests.Session, so the TCP (and TLS) connections to its model server are reused
+    between calls. The pool size, the max connections kept per host and the idle timeout can be set in the LLM
+    record with pool_connections, pool_maxsize and pool_idle_timeout. Otherwise the HTTP_POOL_* config values are used.
+    The Basic auth header is built once per session instead of a new HTTPBasicAuth per call.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__default_pool_connections = int(self.__config.get('HTTP_POOL_CONNECTIONS', '10'))
+        self.__default_pool_maxsize = int(self.__config.get('HTTP_POOL_MAXSIZE', '50'))
+        self.__default_pool_idle_timeout = float(self.__config.get('HTTP_POOL_IDLE_TIMEOUT', '60'))
+        self.__lock = threading.Lock()
+        # LLM name -> [signature, session, auth headers, last use, calls in flight]
+        self.__sessions = {}
+
+    def get(self, llm, address, **kwargs):
+        return self.request('GET', llm, address, **kwargs)
+
+    def post(self, llm, address, **kwargs):
+        return self.request('POST', llm, address, **kwargs)
+
+    def request(self, method, llm, address, **kwargs):
+        """
+        Sends the request through the session of the LLM.
+
+        Args:
+            method (str): The HTTP method.
+            llm (dict): The LLM record. Its name, credentials and pool settings select the session.
+            address (str): The URL to call.
+            **kwargs: Passed to requests.Session.request. With a Timeouts timeout, the answer is read until the request deadline at most.
+
+        Returns:
+            Response: The response from the LLM.
+        """
+        entry = self.__acquire_session(llm)
+        try:
+            session, auth_headers = entry[1], entry[2]
+            kwargs['headers'] = {**auth_headers, **kwargs.get('headers', {})}
+            timeout = kwargs.get('timeout')
+            if not isinstance(timeout, Timeouts) or timeout.expires is None or kwargs.get('stream'):
+                return session.request(method, address, **kwargs)
+
+            # The read timeout bounds each read only: a model server sending its answer slowly is cut at the request deadline
+            kwargs['stream'] = True
+            response = session.request(method, address, **kwargs)
+            try:
+                # As requests itself stores the body of a response read in full
+                response._content = self.__read_body(response, timeout.expires)
+                response._content_consumed = True
+            except Exception:
+                response.close()
+                raise
+            return response
+        finally:
+            self.__release_session(llm['name'], entry)
+
+    def __read_body(self, response, expires):
+        """Reads the body of a streamed response, checking the deadline each time some of it arrives"""
+        # read1 returns as soon as some bytes arrived (urllib3 2.3+), read waits for the whole chunk
+        read = getattr(response.raw, 'read1', response.raw.read)
+        chunks = []
+        try:
+            while True:
+                if time.monotonic() >= expires:
+                    raise DeadlineExceededException()
+                chunk = read(10240, decode_content=True)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        # The errors requests raises when it reads the body itself
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+
+    def __acquire_session(self, llm):
+        """The session entry of the LLM, counted in flight until __release_session"""
+        pool_connections = int(llm.get('pool_connections') or self.__default_pool_connections)
+        pool_maxsize = int(llm.get('pool_maxsize') or self.__default_pool_maxsize)
+        pool_idle_timeout = float(llm.get('pool_idle_timeout') or self.__default_pool_idle_timeout)
+        signature = (llm['username'], llm['password'], pool_connections, pool_maxsize)
+        now = time.monotonic()
+
+        with self.__lock:
+            entry = self.__sessions.get(llm['name'])
+            # Replace the session when the LLM record changed or when its connections were idle for too long.
+            # A session with calls in flight is never idle, and is only closed once its last call finishes
+            if entry is not None and (entry[0] != signature or (entry[4] == 0 and now - entry[3] > pool_idle_timeout)):
+                if entry[4] == 0:
+                    entry[1].close()
+                entry = None
+            if entry is None:
+                entry = [signature, self.__create_session(pool_connections, pool_maxsize), basic_auth_headers(llm), now, 0]
+                self.__sessions[llm['name']] = entry
+                self.__logger.debug(f"New HTTP session for {llm['name']}: pool_connections={pool_connections}, pool_maxsize={pool_maxsize}")
+            entry[4] += 1
+            return entry
+
+    def __release_session(self, name, entry):
+        """
+        Ends a call on the session entry. Its idle time starts when its last call finishes. A streamed call ends with
+        its headers: closing its session afterwards only closes the idle connections, not the one being read.
+        """
+        with self.__lock:
+            entry[3] = time.monotonic()
+            entry[4] -= 1
+            if entry[4] == 0 and self.__sessions.get(name) is not entry:
+                entry[1].close()
+
+    def __create_session(self, pool_connections, pool_maxsize):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+class AsyncLLMResponse:
+    """
+    Response of an AsyncSessionPool call, with the fields the dispatcher logs.
+    The body is read by the pool, unless the call is streamed: then iter_bytes() and aclose() are used.
+    """
+
+    def __init__(self, response, request_bytes, started, on_close=None):
+        self.__response = response
+        self.__started = started
+        # Called once by aclose: the pool keeps the session of a stream until then
+        self.__on_close = on_close
+        self.status_code = response.status
+        self.request_bytes = request_bytes
+        self.content = b''
+        self.elapsed = 0.0
+
+    @property
+    def text(self):
+        try:
+            encoding = self.__response.get_encoding()
+        except Exception:
+            encoding = 'utf-8'
+        return self.content.decode(encoding, errors='replace')
+
+    async def read(self):
+        try:
+            self.content = await self.__response.read()
+        finally:
+            self.elapsed = time.monotonic() - self.__started
+        return self.content
+
+    async def iter_bytes(self, chunk_size):
+        async for chunk in self.__response.content.iter_chunked(chunk_size):
+            yield chunk
+
+    async def aclose(self):
+        self.__response.release()
+        self.elapsed = time.monotonic() - self.__started
+        on_close, self.__on_close = self.__on_close, None
+        if on_close is not None:
+            await on_close()
+
+
+class AsyncSessionPool:
+    """
+    Non-blocking counterpart of SessionPool, used by the async dispatcher. One aiohttp.ClientSession per upstream LLM.
+
+    The same pool_maxsize and pool_idle_timeout LLM fields (or HTTP_POOL_* config values) apply: pool_maxsize caps
+    the connections to the LLM and pool_idle_timeout is how long an idle connection is kept alive.
+    Upstream calls have no timeout unless the caller passes one. See Deadline.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__default_pool_maxsize = int(self.__config.get('HTTP_POOL_MAXSIZE', '50'))
+        self.__default_pool_idle_timeout = float(self.__config.get('HTTP_POOL_IDLE_TIMEOUT', '60'))
+        # LLM name -> [signature, session, calls in flight]. Only touched from the event loop, so no lock is needed
+        self.__sessions = {}
+
+    async def request(self, method, llm, address, data, stream=False, timeout=None):
+        """
+        Sends the request through the session of the LLM.
+
+        Args:
+            method (str): The HTTP method.
+            llm (dict): The LLM record. Its name, credentials and pool settings select the session.
+            address (str): The URL to call.
+            data (bytes): The request body. A str is encoded to UTF-8.
+            stream (bool): If True, returns as soon as the headers arrive. The caller must aclose() the response.
+            timeout (tuple): The (connect, read) timeouts in seconds. None for no timeout. A Timeouts with a deadline
+                             also bounds the whole call, streamed body included.
+
+        Returns:
+            AsyncLLMResponse: The response from the LLM.
+        """
+        body = data if isinstance(data, bytes) else data.encode('utf-8')
+        started = time.monotonic()
+        client_timeout = None
+        if timeout:
+            # The socket timeouts bound each network operation, the total one the whole call and the streamed body
+            total = timeout.remaining() if isinstance(timeout, Timeouts) else None
+            if total == 0:
+                raise DeadlineExceededException()
+            client_timeout = aiohttp.ClientTimeout(total=total, sock_connect=timeout[0], sock_read=timeout[1])
+        entry = await self.__acquire_session(llm)
+        release = functools.partial(self.__release_session, llm['name'], entry)
+        streaming = False
+        try:
+            response = AsyncLLMResponse(await entry[1].request(method, address, data=body, timeout=client_timeout), len(body), started, release if stream else None)
+            # A stream keeps its session in use until it is closed
+            streaming = stream
+            if not stream:
+                await response.read()
+            return response
+        finally:
+            if not streaming:
+                await release()
+
+    async def aclose(self):
+        for signature, session, in_flight in self.__sessions.values():
+            await session.close()
+        self.__sessions = {}
+
+    async def __acquire_session(self, llm):
+        """The session entry of the LLM, counted in flight until __release_session"""
+        pool_maxsize = int(llm.get('pool_maxsize') or self.__default_pool_maxsize)
+        pool_idle_timeout = float(llm.get('pool_idle_timeout') or self.__default_pool_idle_timeout)
+        signature = (llm['username'], llm['password'], pool_maxsize, pool_idle_timeout)
+
+        entry = self.__sessions.get(llm['name'])
+        if entry is None or entry[0] != signature:
+            # New LLM, or its record changed
+            old_entry = entry
+            session = aiohttp.ClientSession(headers=basic_auth_headers(llm),
+                                            connector=aiohttp.TCPConnector(limit=pool_maxsize, keepalive_timeout=pool_idle_timeout),
+                                            timeout=aiohttp.ClientTimeout(total=None))
+            entry = [signature, session, 0]
+            self.__sessions[llm['name']] = entry
+            self.__logger.debug(f"New async HTTP session for {llm['name']}: pool_maxsize={pool_maxsize}")
+            # The old session is closed once its calls in flight finish, see __release_session
+            if old_entry is not None and old_entry[2] == 0:
+                await old_entry[1].close()
+        entry[2] += 1
+        return entry
+
+    async def __release_session(self, name, entry):
+        """Ends a call on the session entry, closing the session if it was replaced and this was its last call"""
+        entry[2] -= 1
+        if entry[2] == 0 and self.__sessions.get(name) is not entry:
+            await entry[1].close()
@@ -0,0 +1,183 @@
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from config.config import Config
+import controllers.fast_json as fast_json
+from controllers.payload import Payload
+
+# Tokens differing between requests that are otherwise the same: timestamps, dates, UUIDs and hex ids (with letters
+# and digits). The other numbers are part of the prompt and are kept
+_VOLATILE = re.compile(
+    r'\d{4}-\d{2}-\d{2}(?:t\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?'
+    r'|\d{1,2}:\d{2}:\d{2}(?:\.\d+)?'
+    r'|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+    r'|\b1\d{9}(?:\d{3})?\b'
+    r'|\b(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{8,}\b')
+VOLATILE_TOKEN = '_id_'
+_WORDS = re.compile(r'\w+')
+_TOKENS = re.compile(r'\w+|[^\w\s]')
+
+
+def normalized_words(text, symbols=True):
+    """
+    The words of a prompt, lowercase, with each timestamp, UUID and hex id replaced by VOLATILE_TOKEN.
+
+    Args:
+        text (str): The prompt.
+        symbols (bool): Whether the punctuation and operators are tokens too, so "2 + 2" and "2 * 2" differ.
+
+    Returns:
+        list: The tokens.
+    """
+    words = []
+    tokens = _TOKENS if symbols else _WORDS
+    # Split with str methods, much faster than the regular expressions. Only the words with digits or symbols go
+    # through them
+    for word in text.lower().split():
+        if word.isalpha():
+            words.append(word)
+        else:
+            words.extend(tokens.findall(_VOLATILE.sub(f' {VOLATILE_TOKEN} ', word)))
+    return words
+
+
+class SimilarityCache:
+    """
+    Cache of the LLM answers for near-duplicate prompts: prompts differing in whitespace, casing, timestamps, ids or
+    a few words.
+
+    The instruction is normalized and split in word 3-grams, fingerprinted by MinHash (one permutation, BINS bins)
+    and indexed in BANDS bands of BINS / BANDS bins. The prompts sharing a band with a new one are compared by their
+    estimated Jaccard similarity; the most similar answer is returned when it reaches the threshold of the type.
+    Only prompts sent to the same LLM with the same other fields (temperature, max_new_tokens...) and the same
+    numbers are compared: "What is 2 + 2?" never answers "What is 17 + 25?".
+
+    The types and their thresholds are set by SIMILAR_CACHE_TYPES, e.g. "code:0.9,text". A type without a threshold
+    uses SIMILAR_CACHE_THRESHOLD. SIMILAR_CACHE_VERIFY_RATE of the hits still call the LLM and compare its answer
+    with the cached one, to count the false positives.
+    """
+
+    BINS = 64
+    BANDS = 16
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        default_threshold = float(self.__config.get('SIMILAR_CACHE_THRESHOLD', '0.9'))
+        self.__thresholds = {}
+        for item in self.__config.get('SIMILAR_CACHE_TYPES', '').split(','):
+            if item.strip():
+                type_str, _, threshold = item.partition(':')
+                self.__thresholds[type_str.strip()] = float(threshold) if threshold.strip() else default_threshold
+        self.__deterministic_only = self.__config.get('RESPONSE_CACHE_DETERMINISTIC_ONLY', 'true').lower() in ("yes", "true", "t", "1")
+        self.__ttl = float(self.__config.get('SIMILAR_CACHE_TTL', '3600'))
+        self.__max_entries = int(self.__config.get('SIMILAR_CACHE_MAX_ENTRIES', '10000'))
+        self.__verify_rate = float(self.__config.get('SIMILAR_CACHE_VERIFY_RATE', '0.01'))
+        self.__rows = self.BINS // self.BANDS
+        self.__lock = threading.Lock()
+        # Entry id -> (expires, partition, signature, answer), least recently used first
+        self.__entries = OrderedDict()
+        # (partition, band number, band values) -> entry ids
+        self.__index = {}
+        self.__next_id = 0
+
+    def applies(self, type_str, data, stream=False):
+        """Whether the request may be answered from the cache. See ResponseCache.applies"""
+        if type_str not in self.__thresholds or stream or data.get('cache', True) is False:
+            return False
+        if not isinstance(data.get('instruction'), str):
+            return False
+        if self.__deterministic_only:
+            return data.get('temperature') == 0 or data.get('do_sample') is False
+        return True
+
+    def get(self, type_str, llm, data):
+        """
+        The cached answer of the LLM to the most similar prompt, if similar enough.
+
+        Args:
+            type_str (str): The type of the request. It sets the threshold.
+            llm (dict): The LLM record.
+            data (dict): The request payload.
+
+        Returns:
+            tuple: (answer, similarity, verify), or None on a miss. When verify is True, the LLM should still be called
+                   and its answer compared with the cached one. A different answer is a false positive.
+        """
+        partition, signature = self.__fingerprint(llm, data)
+        now = time.monotonic()
+        best = None
+        with self.__lock:
+            candidates = set()
+            for band in self.__bands(partition, signature):
+                candidates.update(self.__index.get(band, ()))
+            for entry_id in candidates:
+                expires, _, entry_signature, answer = self.__entries[entry_id]
+                if expires <= now:
+                    continue
+                similarity = self.__similarity(signature, entry_signature)
+                if best is None or similarity > best[1]:
+                    best = (entry_id, similarity, answer)
+            if best is None or best[1] < self.__thresholds[type_str]:
+                return None
+            self.__entries.move_to_end(best[0])
+        return best[2], best[1], random.random() < self.__verify_rate
+
+    def put(self, llm, data, answer):
+        """Caches the answer of the LLM to the request, evicting the least recently used ones beyond the bound"""
+        partition, signature = self.__fingerprint(llm, data)
+        with self.__lock:
+            entry_id = self.__next_id
+            self.__next_id += 1
+            self.__entries[entry_id] = (time.monotonic() + self.__ttl, partition, signature, answer)
+            for band in self.__bands(partition, signature):
+                self.__index.setdefault(band, set()).add(entry_id)
+            while len(self.__entries) > self.__max_entries:
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, entry_id):
+        _, partition, signature, _ = self.__entries.pop(entry_id)
+        for band in self.__bands(partition, signature):
+            entry_ids = self.__index.get(band)
+            if entry_ids is not None:
+                entry_ids.discard(entry_id)
+                if not entry_ids:
+                    del self.__index[band]
+
+    def __fingerprint(self, llm, data):
+        words = normalized_words(data['instruction'])
+        # The LLM, the payload fields other than the instruction and the numbers of the instruction must be equal
+        others = {key: value for key, value in data.items() if key != 'instruction' and key not in Payload.DISPATCHER_FIELDS}
+        others['instruction_numbers'] = [word for word in words if not word.isalpha() and any(char.isdigit() for char in word)]
+        partition = llm['name'], llm['model'], hashlib.sha256(fast_json.dumps(others, sort_keys=True)).hexdigest()
+        return partition, self.__signature(words)
+
+    def __signature(self, words):
+        shingles = [tuple(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+        # One permutation MinHash: each shingle hash falls in a bin, which keeps its minimum. None for the empty bins
+        signature = [None] * self.BINS
+        for shingle in shingles:
+            value = hash(shingle) & 0xFFFFFFFFFFFFFFFF
+            i = value % self.BINS
+            if signature[i] is None or value < signature[i]:
+                signature[i] = value
+        return tuple(signature)
+
+    def __bands(self, partition, signature):
+        for band in range(self.BANDS):
+            values = signature[band * self.__rows:(band + 1) * self.__rows]
+            # A band of empty bins would match every short prompt
+            if any(value is not None for value in values):
+                yield partition, band, values
+
+    @staticmethod
+    def __similarity(first, second):
+        # Estimated Jaccard similarity, over the bins filled in either signature
+        filled = equal = 0
+        for a, b in zip(first, second):
+            if a is not None or b is not None:
+                filled += 1
+                equal += a == b
+        return equal / filled if filled else 1.0
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from config.config import Config
+from controllers.similarity_cache import normalized_words
+
+# Combining marks left by the NFKD decomposition: "não" and "nao" match the same terms
+_ACCENTS = re.compile(r'[\u0300-\u036f]')
+
+
+def _words(text):
+    return normalized_words(_ACCENTS.sub('', unicodedata.normalize('NFKD', text)), symbols=False)
+
+
+class ToxicityPrefilter:
+    """
+    Local verdicts of the toxicity filter, so only the ambiguous prompts reach the toxicity LLM.
+
+    A prompt containing a term of the TOXICITY_TERMS_FILES (comma separated paths, one term per line, '#' comments)
+    is toxic without calling the LLM. The terms may have several words and are matched as whole words, ignoring case
+    and accents, so one list per language (e.g. pt, en, es) can be kept. The terms are indexed by their first word:
+    one set intersection finds the prompt words a term may start with, and only those positions are matched.
+
+    The LLM verdicts are cached by a hash of the prompt, only folded in case and whitespace, up to
+    TOXICITY_CACHE_MAX_ENTRIES for TOXICITY_CACHE_TTL seconds: a prompt differing in punctuation, accents or digits
+    is checked again, so a cached harmless variant cannot clear a toxic one. Failed checks are not cached.
+    """
+
+    def __init__(self) -> None:
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger(__name__)
+        self.__cache_max_entries = int(self.__config.get('TOXICITY_CACHE_MAX_ENTRIES', '10000'))
+        self.__cache_ttl = float(self.__config.get('TOXICITY_CACHE_TTL', '86400'))
+        self.__lock = threading.Lock()
+        # Prompt hash -> (expires, toxic), least recently used first
+        self.__cache = OrderedDict()
+        # First word -> the terms starting with it, as word tuples
+        self.__terms = {}
+        paths = [path.strip() for path in self.__config.get('TOXICITY_TERMS_FILES', '').split(',') if path.strip()]
+        for path in paths:
+            self.__load_terms(path)
+
+    def check(self, instruction):
+        """
+        The verdict of the prompt, without calling the toxicity LLM.
+
+        Args:
+            instruction (str): The prompt.
+
+        Returns:
+            tuple: (toxic, source), source being 'prefilter' or 'cache'. (None, None) when the LLM must check it.
+        """
+        if not isinstance(instruction, str):
+            return None, None
+        words = _words(instruction)
+        starts = self.__terms.keys() & words
+        if starts:
+            for i, word in enumerate(words):
+                if word in starts and any(tuple(words[i:i + len(term)]) == term for term in self.__terms[word]):
+                    return True, 'prefilter'
+        key = self.__key(instruction)
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is None:
+                return None, None
+            if entry[0] <= time.monotonic():
+                del self.__cache[key]
+                return None, None
+            self.__cache.move_to_end(key)
+            return entry[1], 'cache'
+
+    def remember(self, instruction, toxic):
+        """Caches the verdict of the toxicity LLM for the prompt"""
+        if not isinstance(instruction, str) or self.__cache_max_entries <= 0:
+            return
+        key = self.__key(instruction)
+        with self.__lock:
+            self.__cache.pop(key, None)
+            self.__cache[key] = (time.monotonic() + self.__cache_ttl, toxic)
+            while len(self.__cache) > self.__cache_max_entries:
+                self.__cache.popitem(last=False)
+
+    def __load_terms(self, path):
+        try:
+            with open(path, encoding='utf-8') as terms:
+                for line in terms:
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        term = tuple(_words(line))
+                        if term:
+                            self.__terms.setdefault(term[0], set()).add(term)
+        except OSError as e:
+            self.__logger.error(f'Could not load the toxicity terms of {path}: {e}')
+            return
+        self.__logger.info(f'Toxicity prefilter loaded {path}: {sum(len(terms) for terms in self.__terms.values())} terms')
+
+    @staticmethod
+    def __key(instruction):
+        return hashlib.sha256(' '.join(instruction.lower().split()).encode()).digest()
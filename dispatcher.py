@@ -9,6 +9,8 @@ from requests.auth import HTTPBasicAuth
 from config.config import Config
 from controllers.dispatcher_controller import DispatcherController
 from controllers.dispatcher_controller_socketio import DispatcherControllerSocketio
+from controllers.health_checker import get_health_checker
+from controllers.metrics import get_metrics
 from exception.exceptions import FimNotSupportedException
 from liev_llm_manager.etcd import EtcdEndpointManager
 from liev_llm_manager.exception.exception import LLMMissingRequiredFieldException
@@ -75,7 +77,8 @@ def post_endpoint():
                             prompt_mask = data['prompt_mask'] if 'prompt_mask' in data else '',
                             stream_url = data['stream_url'] if 'stream_url' in data else '',
                             http_stream_url = data['http_stream_url'] if 'http_stream_url' in data else '', 
-                            fim_url = data['fim_url'] if 'fim_url' in data else '',                       
+                            fim_url = data['fim_url'] if 'fim_url' in data else '',
+                            replicas = data.get('replicas'),
         )
         logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
         return 'Success',201
@@ -105,7 +108,8 @@ def update_endpoint():
                             prompt_mask = data['prompt_mask'] if 'prompt_mask' in data else '',
                             stream_url = data['stream_url'] if 'stream_url' in data else '',
                             http_stream_url = data['http_stream_url'] if 'http_stream_url' in data else '',  
-                            fim_url = data['fim_url'] if 'fim_url' in data else '',                        
+                            fim_url = data['fim_url'] if 'fim_url' in data else '',
+                            replicas = data.get('replicas'),
         )
         logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
         return 'Success',201
@@ -126,7 +130,8 @@ def post_type():
         manager.create_llm_type(
                             data['name'],
                             data['type'],
-                            data['priority'],                   
+                            data['priority'],
+                            data.get('share_priority', False),
         )
         logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
         return 'Success',201
@@ -200,7 +205,7 @@ def get_llms_types():
     # Remove the sensible fields
     filtered_fields_llms = []
     for llm in llms:
-        filtered_field_llm = {key: value for key, value in llm.items() if key not in ['url', 'fim_url', 'stream_url','http_stream_url', 'api', 'username', 'password', 'prompt_mask', 'system_message']}
+        filtered_field_llm = {key: value for key, value in llm.items() if key not in ['url', 'fim_url', 'stream_url','http_stream_url', 'replicas', 'api', 'username', 'password', 'prompt_mask', 'system_message']}
         filtered_fields_llms.append(filtered_field_llm)
     logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
     return json.dumps(filtered_fields_llms), 200
@@ -225,7 +230,7 @@ def get_llms_types_per_type(type_str):
     # Remove the sensible fields
     filtered_fields_llms = []
     for llm in llms:
-        filtered_field_llm = {key: value for key, value in llm.items() if key not in ['url', 'fim_url', 'stream_url','http_stream_url', 'api', 'username', 'password', 'prompt_mask', 'system_message']}
+        filtered_field_llm = {key: value for key, value in llm.items() if key not in ['url', 'fim_url', 'stream_url','http_stream_url', 'replicas', 'api', 'username', 'password', 'prompt_mask', 'system_message']}
         filtered_fields_llms.append(filtered_field_llm)
     logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
     return json.dumps(filtered_fields_llms), 200
@@ -236,6 +241,13 @@ def get_llm(name, type):
     logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
     return manager
 
+# GET THE DISPATCHER COUNTERS (retries, failovers) OF THIS WORKER
+@app.route('/v1/metrics', methods=['GET'])
+@auth.login_required(role=llm_admin_role)
+def get_dispatcher_metrics():
+    logger.info(f'Request: {request.method} {request.path}, Application: {auth.current_user()["application"]}, User: {auth.current_user()["username"]}')
+    return json.dumps(get_metrics().snapshot()), 200
+
 #----------------------------------------------------------------------------------------------------
 # HTTP Response Endpoints
 #----------------------------------------------------------------------------------------------------
@@ -352,4 +364,8 @@ def liveness():
 # Health check endpoint for readiness probe
 @app.route('/readyz')
 def readiness():
+    # Not ready when a required type has no healthy LLM, so no traffic is sent that could only fail
+    is_ready, unavailable_types = get_health_checker().ready()
+    if not is_ready:
+        return json.dumps({'status': 'NOT READY', 'unavailable_types': unavailable_types}), 503
     return json.dumps({'status': 'OK'})
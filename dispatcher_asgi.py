@@ -0,0 +1,299 @@
+import functools
+import json
+import logging
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+from config.config import Config
+from controllers.dispatcher_controller_async import AsyncDispatcherController
+from controllers.health_checker import get_health_checker
+from controllers.metrics import get_metrics
+from exception.exceptions import FimNotSupportedException
+from liev_llm_manager.exception.exception import LLMMissingRequiredFieldException
+from auth.auth import AuthHelper
+from utils import print_banner
+
+from liev_llm_manager.manager import get_manager
+
+"""
+ASGI version of the Dispatcher, served by uvicorn. See start_dispatcher_uvicorn.sh
+
+Same HTTP routes as dispatcher.py, backed by AsyncDispatcherController: upstream LLM calls are non-blocking,
+so thousands of long generations can run concurrently on one event loop. Socket.io stays on the Flask app.
+"""
+
+# Constants
+json_payload_msg = 'JSON load conversion problem. Not a dict ! Are you using data payload  ?'
+json_load_prob_msg = 'JSON load problem!'
+
+# Fields never returned by the listing routes
+sensible_fields = ['url', 'fim_url', 'stream_url','http_stream_url', 'replicas', 'api', 'username', 'password', 'prompt_mask', 'system_message']
+
+#Init
+print_banner()
+
+#Configuration Load
+load_dotenv()
+config = Config('dispatcher')
+
+## Logging in containers MUST be console.
+logging.basicConfig(level=config.get('LOG_LEVEL', 'DEBUG'), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Get a LLM manager dynamically
+manager = get_manager()
+
+# Get the async dispatcher controller
+controller = AsyncDispatcherController()
+
+#Auth
+auth_mode = config.get('AUTH_MODE', 'basic')
+auth_helper = AuthHelper(auth_mode)
+llm_admin_role = config.get('AUTH_LLM_ADMIN_ROLE_NAME', 'LLM.Admin')
+llm_user_role = config.get('AUTH_LLM_USER_ROLE_NAME', 'LLM.User')
+
+
+def login_required(role):
+    """Same contract as flask_httpauth login_required: 401 if not authenticated, 403 without the role"""
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapped(request):
+            userinfo, roles = await run_in_threadpool(auth_helper.authenticate, request.headers)
+            if not userinfo:
+                scheme = 'Basic realm="Authentication Required"' if auth_mode == 'basic' else 'Bearer realm="Authentication Required"'
+                return Response('Unauthorized Access', status_code=401, headers={'WWW-Authenticate': scheme})
+            if roles is None or (role not in roles if isinstance(roles, list) else role != roles):
+                return Response('Forbidden', status_code=403)
+            request.state.user = userinfo
+            return await f(request)
+        return wrapped
+    return decorator
+
+def to_response(result):
+    """Converts the (content, status[, headers]) tuples used by the controllers to a Response"""
+    if isinstance(result, Response):
+        return result
+    content, status_code = result[0], result[1]
+    headers = dict(result[2]) if len(result) > 2 else {}
+    media_type = headers.pop('Content-Type', None)
+    return Response(content, status_code=status_code, headers=headers, media_type=media_type)
+
+def log_request(request):
+    user = request.state.user
+    logger.info(f'Request: {request.method} {request.url.path}, Application: {user["application"]}, User: {user["username"]}')
+
+async def load_payload(request):
+    """Returns the request payload as a dict, or the error Response"""
+    try:
+        data = json.loads(await request.body())
+    except Exception as e :
+        user = request.state.user
+        logger.error(f'Request: {request.method} {request.url.path}, Application: {user["application"]}, User: {user["username"]}')
+        logger.error(f"{json_load_prob_msg}: {e}", exc_info=True)
+        return to_response((json.dumps("JSON load problem !"), 500))
+
+    if isinstance(data, dict) == False:
+        return to_response((json.dumps(json_payload_msg), 500))
+    return data
+
+#----------------------------------------------------------------------------------------------------
+# Admin Endpoints
+#----------------------------------------------------------------------------------------------------
+
+def llm_fields(data):
+    return dict(
+        name = data['name'],
+        model = data['model'],
+        url = data['url'],
+        username = data['username'],
+        password = data['password'],
+        response_mime = data['response_mime'],
+        is_external = data['is_external'],
+        system_message = data['system_message'] if 'system_message' in data else '',
+        prompt_mask = data['prompt_mask'] if 'prompt_mask' in data else '',
+        stream_url = data['stream_url'] if 'stream_url' in data else '',
+        http_stream_url = data['http_stream_url'] if 'http_stream_url' in data else '',
+        fim_url = data['fim_url'] if 'fim_url' in data else '',
+        replicas = data.get('replicas'),
+    )
+
+# POST AN LLM
+@login_required(llm_admin_role)
+async def post_endpoint(request):
+    try:
+        data = await request.json()
+        await run_in_threadpool(manager.create_llm, **llm_fields(data))
+        log_request(request)
+        return Response('Success', status_code=201)
+    except LLMMissingRequiredFieldException as llmex:
+        logger.error(f'Request: {request.method} {request.url.path}', exc_info=True)
+        return Response(str(llmex.message), status_code=400)
+    except Exception as e:
+        logger.error(f"Error calling post_endpoint: {e}", exc_info=True)
+        return Response(json.dumps("JSON load problem !"), status_code=500)
+
+# UPDATE AN LLM
+@login_required(llm_admin_role)
+async def update_endpoint(request):
+    try:
+        data = await request.json()
+        await run_in_threadpool(manager.update_llm, **llm_fields(data))
+        log_request(request)
+        return Response('Success', status_code=201)
+    except LLMMissingRequiredFieldException as llmex:
+        logger.error(f'Request: {request.method} {request.url.path}', exc_info=True)
+        return Response(str(llmex.message), status_code=400)
+    except Exception as e:
+        logger.error(f"Error calling update_endpoint: {e}", exc_info=True)
+        return Response(json.dumps("JSON load problem !"), status_code=500)
+
+# PUT A TYPE AND PRIORITY FOR AN LLM
+@login_required(llm_admin_role)
+async def post_type(request):
+    try:
+        data = await request.json()
+        await run_in_threadpool(manager.create_llm_type, data['name'], data['type'], data['priority'], data.get('share_priority', False))
+        log_request(request)
+        return Response('Success', status_code=201)
+    except LLMMissingRequiredFieldException as llmex:
+        logger.error(f'Request: {request.method} {request.url.path}')
+        return Response(str(llmex.message), status_code=400)
+    except Exception as e:
+        logger.error(f"Error calling post_type: {e}", exc_info=True)
+        return Response(json.dumps("JSON load problem !"), status_code=500)
+
+# DELETE A TYPE AND PRIORITY FOR AN LLM
+@login_required(llm_admin_role)
+async def delete_type(request):
+    try:
+        await run_in_threadpool(manager.delete_llm_type, request.path_params['llm_name'], request.path_params['type_str'])
+        log_request(request)
+        return Response('Success', status_code=202)
+    except Exception as e:
+        logger.error(f"Error calling delete_llm_type: {e}", exc_info=True)
+        return Response(json.dumps("JSON load problem !"), status_code=500)
+
+# GET ALL LLMS
+@login_required(llm_user_role)
+async def get_llms(request):
+    llms = await run_in_threadpool(manager.get_all_llms)
+    # Remove the sensible fields
+    filtered_fields_llms = [{key: value for key, value in llm.items() if key not in ['username', 'password']} for llm in llms]
+    log_request(request)
+    return Response(json.dumps(filtered_fields_llms), status_code=200)
+
+# DELETE AN LLM
+@login_required(llm_admin_role)
+async def delete_llm(request):
+    try:
+        await run_in_threadpool(manager.delete_llm, request.path_params['llm_name'])
+        log_request(request)
+        return Response('Success', status_code=204)
+    except Exception as e:
+        logger.error(f"Error calling delete_llm: {e}", exc_info=True)
+        return Response(json.dumps("JSON load problem !"), status_code=500)
+
+def filter_llms(request, llms):
+    # Filter only Socket.io or HTTP Stream capable LLMs, then remove the sensible fields
+    if request.query_params.get('socketio') == 'true':
+        llms = [llm for llm in llms if 'stream_url' in llm and llm['stream_url'] and len(llm['stream_url']) > 0]
+    elif request.query_params.get('stream') == 'true':
+        llms = [llm for llm in llms if 'http_stream_url' in llm and llm['http_stream_url'] and len(llm['http_stream_url']) > 0]
+    return [{key: value for key, value in llm.items() if key not in sensible_fields} for llm in llms]
+
+# GET ALL LLMS AND TYPES
+@login_required(llm_user_role)
+async def get_llms_types(request):
+    llms = await run_in_threadpool(manager.get_all_llms_and_types)
+    log_request(request)
+    return Response(json.dumps(filter_llms(request, llms)), status_code=200)
+
+# GET LLMS BY TYPE
+@login_required(llm_user_role)
+async def get_llms_types_per_type(request):
+    llms = await run_in_threadpool(manager.get_llms_by_type, request.path_params['type_str'])
+    log_request(request)
+    return Response(json.dumps(filter_llms(request, llms)), status_code=200)
+
+# GET THE DISPATCHER COUNTERS (retries, failovers) OF THIS WORKER
+@login_required(llm_admin_role)
+async def get_dispatcher_metrics(request):
+    log_request(request)
+    return Response(json.dumps(get_metrics().snapshot()), status_code=200)
+
+#----------------------------------------------------------------------------------------------------
+# HTTP Response Endpoints
+#----------------------------------------------------------------------------------------------------
+
+@login_required(llm_user_role)
+async def response(request):
+    data = await load_payload(request)
+    if isinstance(data, Response):
+        return data
+    return to_response(await controller.get_response(data, request, request.state.user))
+
+@login_required(llm_user_role)
+async def fim(request):
+    data = await load_payload(request)
+    if isinstance(data, Response):
+        return data
+    try:
+        return to_response(await controller.get_response(data, request, request.state.user, True))
+    except FimNotSupportedException as fn:
+        logger.error(fn, exc_info=True)
+        return Response(json.dumps(fn.message), status_code=500)
+
+#----------------------------------------------------------------------------------------------------
+# HTTP Streaming Response Endpoints
+#----------------------------------------------------------------------------------------------------
+
+@login_required(llm_user_role)
+async def stream(request):
+    data = await load_payload(request)
+    if isinstance(data, Response):
+        return data
+    return to_response(await controller.get_response(data, request, request.state.user, stream = True))
+
+#----------------------------------------------------------------------------------------------------
+# HTTP Healthchecks - Do not remove
+#----------------------------------------------------------------------------------------------------
+
+async def liveness(request):
+    return Response(json.dumps({'status': 'OK'}))
+
+# Health check endpoint for readiness probe
+async def readiness(request):
+    # Not ready when a required type has no healthy LLM, so no traffic is sent that could only fail
+    is_ready, unavailable_types = get_health_checker().ready()
+    if not is_ready:
+        return Response(json.dumps({'status': 'NOT READY', 'unavailable_types': unavailable_types}), status_code=503)
+    return Response(json.dumps({'status': 'OK'}))
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await controller.aclose()
+
+routes = [
+    Route('/v1/llm', post_endpoint, methods=['POST']),
+    Route('/v1/llm', update_endpoint, methods=['PATCH']),
+    Route('/v1/llm', get_llms, methods=['GET']),
+    Route('/v1/llm_type', post_type, methods=['POST', 'PUT']),
+    Route('/v1/llm_type/{type_str}/{llm_name}', delete_type, methods=['DELETE']),
+    Route('/v1/llm/{llm_name}', delete_llm, methods=['DELETE']),
+    Route('/v1/llms_and_types', get_llms_types, methods=['GET']),
+    Route('/v1/llms_and_types/{type_str}', get_llms_types_per_type, methods=['GET']),
+    Route('/v1/metrics', get_dispatcher_metrics, methods=['GET']),
+    Route('/response', response, methods=['GET', 'POST']),
+    Route('/fim', fim, methods=['GET', 'POST']),
+    Route('/stream', stream, methods=['GET', 'POST']),
+    Route('/healthz', liveness),
+    Route('/readyz', readiness),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[Middleware(CORSMiddleware, allow_origins=['*'])])
@@ -14,3 +14,42 @@ class HttpStreamingNotSupportedException(Exception):
     def __str__(self):
         return f'HttpStreamingNotSupportedException: {self.message}'
     
+class DeadlineExceededException(Exception):
+    def __init__(self, message="The request deadline was exceeded"):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'DeadlineExceededException: {self.message}'
+
+class CircuitOpenException(Exception):
+    def __init__(self, message="The circuit of this LLM is open. Not calling it"):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'CircuitOpenException: {self.message}'
+
+class LLMUnhealthyException(Exception):
+    def __init__(self, message="This LLM failed its health checks. Not calling it"):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'LLMUnhealthyException: {self.message}'
+
+class ConcurrencyLimitException(Exception):
+    def __init__(self, message="This LLM is at its concurrency limit"):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'ConcurrencyLimitException: {self.message}'
+
+class ToxicPromptException(Exception):
+    def __init__(self, message="The prompt was found toxic. Not calling the LLMs"):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'ToxicPromptException: {self.message}'
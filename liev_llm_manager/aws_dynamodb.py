@@ -1,8 +1,10 @@
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+import concurrent.futures
 from decimal import Decimal
 import logging
 import os
+import time
 from config.config import Config
 from liev_llm_manager.exception.exception import LLMMissingRequiredFieldException
 from liev_llm_manager.base_llm_manager import BaseLLMManager
@@ -19,6 +21,10 @@ class DynamoDBEndpointManager(BaseLLMManager):
         self.__region_name = self.__config.get('AWS_REGION')
         self.__endpoint_table_name = self.__config.get('AWS_ENDPOINT_TABLE_NAME')
         self.__type_table_name = self.__config.get('AWS_TYPE_TABLE_NAME')
+        # Optional. Used for DynamoDB Local or a moto server
+        self.__endpoint_url = self.__config.get('AWS_DYNAMODB_ENDPOINT_URL')
+        # Number of parallel segments used by full table scans. 1 means a plain sequential scan
+        self.__scan_segments = int(self.__config.get('AWS_SCAN_SEGMENTS', '1'))
 
         if None in (self.__aws_access_key_id, self.__aws_secret_access_key, self.__region_name, self.__endpoint_table_name, self.__type_table_name):
             raise Exception("If using LLM_MANAGER_IMPL='aws_dynamodb' you need to set AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_ENDPOINT_TABLE_NAME, AWS_TYPE_TABLE_NAME and AWS_REGION env vars!")
@@ -27,6 +33,7 @@ class DynamoDBEndpointManager(BaseLLMManager):
             self.__dynamodb = boto3.resource('dynamodb', aws_access_key_id=self.__aws_access_key_id,
                                             aws_secret_access_key=self.__aws_secret_access_key,
                                             region_name=self.__region_name,
+                                            endpoint_url=self.__endpoint_url,
                                             config=BotoConfig(max_pool_connections=50))
 
             # Endpoint table
@@ -99,7 +106,8 @@ class DynamoDBEndpointManager(BaseLLMManager):
                    is_external = False,
                    stream_url = None,
                    http_stream_url = None,
-                   fim_url = None):
+                   fim_url = None,
+                   replicas = None):
         try:
             # Create item in the endpoint table
             endpoint_data = {
@@ -116,6 +124,8 @@ class DynamoDBEndpointManager(BaseLLMManager):
                 "http_stream_url": http_stream_url if http_stream_url is not None else '',
                 "fim_url": fim_url if fim_url else None,
             }
+            if replicas:
+                endpoint_data['replicas'] = replicas
             required_fields = ["name", "model", "url", "username", "password", "response_mime"]
             for field in required_fields:
                 if field not in endpoint_data:
@@ -126,13 +136,10 @@ class DynamoDBEndpointManager(BaseLLMManager):
         except Exception as e:
             self.__logger.error(f'Error creating LLM: {e}', exc_info=True)
     
-    def create_llm_type(self, name, type, priority):
+    def create_llm_type(self, name, type, priority, share_priority=False):
         try:
             # Fetch all items of the given type
-            response = self.__type_table.query(
-                KeyConditionExpression=Key('type').eq(type)
-            )
-            items_type = response.get("Items", [])
+            items_type = self.__query(self.__type_table, KeyConditionExpression=Key('type').eq(type))
             serialized_items_type = self.__convert_decimal_to_numbers(items_type)
 
             # If priority is 0, set it to the highest available
@@ -145,9 +152,9 @@ class DynamoDBEndpointManager(BaseLLMManager):
             if priority > max_priority + 1:
                 priority = max_priority + 1
 
-            # Update priorities
+            # Update priorities. An LLM sharing the priority leaves the others in place
             for item in serialized_items_type:
-                if item['priority'] >= priority:
+                if item['priority'] >= priority and not share_priority:
                     item['priority'] += 1
                     self.__type_table.put_item(Item=item)
 
@@ -162,9 +169,9 @@ class DynamoDBEndpointManager(BaseLLMManager):
             self.__logger.error(f'Error creating LLM type: {e}', exc_info=True)
 
 
-    def update_llm_type(self, name, type, priority):
+    def update_llm_type(self, name, type, priority, share_priority=False):
         # In Dynamo, create again will replace
-        self.create_llm_type(name, type, priority)
+        self.create_llm_type(name, type, priority, share_priority)
     
     def delete_llm_type(self, name, type):
         try:
@@ -212,11 +219,8 @@ class DynamoDBEndpointManager(BaseLLMManager):
 
     def get_all_llms(self):
         try:
-            response = self.__endpoint_table.scan()
-            items_type = response.get("Items", [])
-            serialized_items_type = self.__convert_decimal_to_numbers(items_type)
-
-            return serialized_items_type
+            items_endpoint = self.__scan(self.__endpoint_table)
+            return self.__convert_decimal_to_numbers(items_endpoint)
         except Exception as e:
             self.__logger.error(f"Error getting all LLMs: {e}", exc_info=True)
             raise
@@ -224,19 +228,16 @@ class DynamoDBEndpointManager(BaseLLMManager):
     def get_all_llms_and_types(self):
         try:
             all_llms_list = []
-            response = self.__type_table.scan()
-            items_type = response.get("Items", [])
-            serialized_items_type = self.__convert_decimal_to_numbers(items_type)
+            serialized_items_type = self.__convert_decimal_to_numbers(self.__scan(self.__type_table))
+            serialized_items_endpoint = self.__convert_decimal_to_numbers(self.__scan(self.__endpoint_table))
 
-            response = self.__endpoint_table.scan()
-            items_endpoint = response.get("Items", [])
-            serialized_items_endpoint = self.__convert_decimal_to_numbers(items_endpoint)
+            # Join through a dict keyed by name
+            endpoints_by_name = {item_endpoint['name']: item_endpoint for item_endpoint in serialized_items_endpoint}
             for item_type in serialized_items_type:
-                for item_endpoint in serialized_items_endpoint:
-                        if item_type['name'] == item_endpoint['name']:
-                          llm_info_dict = {**item_endpoint, **item_type}
-                          #llm_info_dict['type'] = type_list['type']
-                          all_llms_list.append(llm_info_dict)
+                item_endpoint = endpoints_by_name.get(item_type['name'])
+                if item_endpoint:
+                    llm_info_dict = {**item_endpoint, **item_type}
+                    all_llms_list.append(llm_info_dict)
             return all_llms_list
         except Exception as e:
             self.__logger.error(f"Error getting all LLMs: {e}", exc_info=True)
@@ -254,7 +255,8 @@ class DynamoDBEndpointManager(BaseLLMManager):
                    is_external=False,
                    stream_url = None,
                    http_stream_url = None,
-                   fim_url = None):
+                   fim_url = None,
+                   replicas = None):
         try:
             # Fetch the existing item
             response = self.__endpoint_table.get_item(Key={'name': name})
@@ -275,6 +277,7 @@ class DynamoDBEndpointManager(BaseLLMManager):
                 "stream_url": stream_url if stream_url is not None else '',
                 "http_stream_url": http_stream_url if http_stream_url is not None else '',
                  "fim_url": fim_url if fim_url else None,
+                "replicas": replicas,
             }
 
             # Filter out None values
@@ -306,10 +309,7 @@ class DynamoDBEndpointManager(BaseLLMManager):
 
     def get_llm_by_priority(self, type='text', priority=0):       
         try:
-            response = self.__type_table.query(
-                KeyConditionExpression=Key('type').eq(type)
-            )
-            items_type = response.get("Items", [])
+            items_type = self.__query(self.__type_table, KeyConditionExpression=Key('type').eq(type))
             serialized_items_type = self.__convert_decimal_to_numbers(items_type)
             item_type = next((item for item in serialized_items_type if item['priority'] == priority), None)
 
@@ -331,20 +331,14 @@ class DynamoDBEndpointManager(BaseLLMManager):
     def get_llms_by_type(self, type):
         llms = []
         try:
-            response = self.__type_table.query(
-                KeyConditionExpression=Key('type').eq(type)
-            )
-            items_type = response.get("Items", [])
+            items_type = self.__query(self.__type_table, KeyConditionExpression=Key('type').eq(type))
             serialized_items_type = self.__convert_decimal_to_numbers(items_type)
-            
-            for item_type in serialized_items_type:
-                response = self.__endpoint_table.query(
-                    KeyConditionExpression=Key('name').eq(item_type['name'])
-                )
-                items_endpoint = response.get("Items", [])
-                item_endpoint = items_endpoint[0] if items_endpoint else None
 
-                if item_type and item_endpoint:
+            # One batch_get_item for all the endpoints of the type, instead of one query per type row
+            endpoints_by_name = self.__batch_get_endpoints([item_type['name'] for item_type in serialized_items_type])
+            for item_type in serialized_items_type:
+                item_endpoint = endpoints_by_name.get(item_type['name'])
+                if item_endpoint:
                     llm = {**item_type, **item_endpoint}
                     llms.append(llm)
             return llms
@@ -352,7 +346,75 @@ class DynamoDBEndpointManager(BaseLLMManager):
             self.__logger.error(f"Error getting LLM for type {type}: {e}", exc_info=True)
             #return None
             raise
-        
+
+    def get_failover_chain(self, type):
+        try:
+            # One query for the type rows and one batch_get_item for the endpoints
+            return sorted(self.get_llms_by_type(type), key=lambda llm: llm['priority'])
+        except Exception as e:
+            self.__logger.error(f"Error getting failover chain for type {type}: {e}", exc_info=True)
+            raise
+
+    def __query(self, table, **kwargs):
+        """
+        Runs a query following LastEvaluatedKey until all the pages are read.
+        """
+        items = []
+        while True:
+            response = table.query(**kwargs)
+            items.extend(response.get("Items", []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def __scan_segment(self, table, segment=None):
+        items = []
+        kwargs = {}
+        if segment is not None:
+            kwargs = {'Segment': segment, 'TotalSegments': self.__scan_segments}
+        while True:
+            response = table.scan(**kwargs)
+            items.extend(response.get("Items", []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def __scan(self, table):
+        """
+        Full table scan. Follows LastEvaluatedKey so large tables are not truncated.
+        When AWS_SCAN_SEGMENTS > 1, the segments are scanned in parallel.
+        """
+        if self.__scan_segments <= 1:
+            return self.__scan_segment(table)
+        items = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__scan_segments) as executor:
+            for segment_items in executor.map(lambda segment: self.__scan_segment(table, segment), range(self.__scan_segments)):
+                items.extend(segment_items)
+        return items
+
+    def __batch_get_endpoints(self, names):
+        """
+        Gets the endpoint items for the given names with batch_get_item, 100 keys per call.
+        Unprocessed keys are retried with a short backoff.
+
+        Returns:
+            dict: The serialized endpoint items keyed by name.
+        """
+        endpoints_by_name = {}
+        names = list(dict.fromkeys(names))
+        for start in range(0, len(names), 100):
+            request_items = {self.__endpoint_table_name: {'Keys': [{'name': name} for name in names[start:start + 100]]}}
+            retries = 0
+            while request_items:
+                response = self.__dynamodb.batch_get_item(RequestItems=request_items)
+                for item_endpoint in response.get('Responses', {}).get(self.__endpoint_table_name, []):
+                    endpoints_by_name[item_endpoint['name']] = self.__convert_decimal_to_numbers(item_endpoint)
+                request_items = response.get('UnprocessedKeys')
+                if request_items:
+                    retries += 1
+                    time.sleep(min(0.05 * (2 ** retries), 1))
+        return endpoints_by_name
+
     def __convert_decimal_to_numbers(self, obj):
         if isinstance(obj, Decimal):
             return int(obj) if obj % 1 == 0 else float(obj)
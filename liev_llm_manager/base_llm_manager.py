@@ -20,15 +20,24 @@ class BaseLLMManager():
                     is_external = False,
                     stream_url = None,
                     http_stream_url = None,
-                    fim_url = None):
+                    fim_url = None,
+                    replicas = None):
+        """
+        replicas: optional list of {url, stream_url, http_stream_url, fim_url, weight} served under this LLM name.
+        The fields a replica does not set come from the LLM. weight is an integer, 1 by default.
+        """
         pass
 
     @abstractmethod
-    def create_llm_type(self, name, type, priority):
+    def create_llm_type(self, name, type, priority, share_priority=False):
+        """
+        Sets the priority of the LLM for the type. The LLMs at or below that priority are shifted down one,
+        unless share_priority is True: then the LLM joins the LLMs already at that priority, balanced with them.
+        """
         pass
     
     @abstractmethod
-    def update_llm_type(self, name, type, priority):
+    def update_llm_type(self, name, type, priority, share_priority=False):
         pass
 
     @abstractmethod
@@ -60,7 +69,8 @@ class BaseLLMManager():
                    is_external = False,
                    stream_url = None,
                    http_stream_url = None,
-                   fim_url = None):
+                   fim_url = None,
+                   replicas = None):
         pass
 
     @abstractmethod
@@ -75,4 +85,9 @@ class BaseLLMManager():
     def get_llms_by_type(self, type):
         pass
 
+    @abstractmethod
+    def get_failover_chain(self, type):
+        """Returns all the LLMs of the type, ordered by priority, resolved in a single lookup"""
+        pass
+
 
@@ -1,67 +1,104 @@
 import yaml
+import logging
+import os
+import threading
+import time
+from config.config import Config
 from liev_llm_manager.base_llm_manager import BaseLLMManager
+from liev_llm_manager.routing_table import RoutingTable
 
 name = 'YAMLEndpointManager'
 class YAMLEndpointManager(BaseLLMManager):
-    
-    def __new__(cls):
-        with open("endpoints.yaml") as f:
-            cls.__endpoints = yaml.safe_load(f)
-            cls.__llms = cls.__endpoints['llms']
-            cls.__types = cls.__endpoints['types']
-        return super().__new__(cls)
+
+    def __init__(self, path="endpoints.yaml"):
+        super().__init__()
+        self.__config = Config('dispatcher')
+        self.__logger = logging.getLogger("YAMLEndpointManager")
+        self.__path = path
+        # Seconds between checks of the file mtime. 0 disables the hot reload
+        self.__reload_interval = float(self.__config.get('ENDPOINTS_YAML_RELOAD_INTERVAL', '5'))
+
+        self.__mtime = os.stat(self.__path).st_mtime_ns
+        self.__table = self.__load()
+
+        if self.__reload_interval > 0:
+            threading.Thread(target=self.__watch, name="YAMLEndpointManagerWatch", daemon=True).start()
+
+    def __load(self):
+        with open(self.__path) as f:
+            endpoints = yaml.safe_load(f)
+        return RoutingTable(endpoints['llms'], self.__flatten_types(endpoints['types']))
+
+    def __watch(self):
+        """
+        Polls the file mtime and rebuilds the routing table when it changes.
+        The new table is built aside and swapped in with a single assignment, so readers are never blocked
+        and never see a half-loaded file. If the new file is invalid, the last good table keeps being served, and the
+        file is read again on the next check until it loads, such as a file caught halfway through its write.
+        """
+        failed_mtime = None
+        while True:
+            time.sleep(self.__reload_interval)
+            mtime = None
+            try:
+                mtime = os.stat(self.__path).st_mtime_ns
+                if mtime == self.__mtime:
+                    continue
+                table = self.__load()
+                # The mtime is only taken once its file loaded
+                self.__table = table
+                self.__mtime = mtime
+                self.__logger.info(f"{self.__path} reloaded")
+            except Exception as e:
+                # Logged once per version of the file
+                if mtime is None or mtime != failed_mtime:
+                    self.__logger.error(f"Error reloading {self.__path}: {e}. Keeping the previous endpoints", exc_info=True)
+                failed_mtime = mtime
+
+    @staticmethod
+    def __flatten_types(types):
+        # The YAML nests the LLMs inside each type. Flatten to one record per (type, llm)
+        type_records = []
+        for type_list in types:
+            for llm_type_list in type_list['llms']:
+                type_records.append({**llm_type_list, 'type': type_list['type']})
+        return type_records
 
     def get_llm_by_name(self, name, type=None):
-        llm = None
-        if (type is None):
-            for l in self.__llms:
-                if l['name'] == name:
-                    llm = l
-            if not llm:
+        llm = self.__table.get_llm_by_name(name, type)
+        if not llm:
+            if type is None:
                 raise Exception(f"No LLM available for name {name}")
-        else:
-            for l in self.get_all_llms_and_types():
-                if l['type'] == type and l['name'] == name:
-                    llm = l
-            if not llm:
-                raise Exception(f"No LLM available for name {name} and type {type}")
+            raise Exception(f"No LLM available for name {name} and type {type}")
         return llm
-    
+
     def delete_llm_type(self, name, type):
         raise NotImplementedError("LLM creation is not available through YAMLEndpointManager. Use the config files!")
 
     def get_all_llms_and_types(self):
-        all_llms_list = []
-        for type_list in self.__types:
-            for llm_type_list in type_list['llms']:
-                for llm_list in self.__llms:
-                    if llm_list['name'] == llm_type_list['name']:
-                        llm_info_dict = {**llm_type_list, **llm_list}
-                        llm_info_dict['type'] = type_list['type']
-                        all_llms_list.append(llm_info_dict)
-        return all_llms_list
+        return self.__table.get_all_llms_and_types()
 
     def get_all_llms(self):
-        return self.__endpoints['llms']
+        return self.__table.get_all_llms()
 
     def delete_llm(self, name):
         raise NotImplementedError("LLM deletion is not available through YAMLEndpointManager. Use the config files!")
 
 
     def get_llm_by_priority(self, type='text', priority = 0):
-        llm = None
-        for l in self.get_all_llms_and_types():
-            if l['type'] == type and l['priority'] == priority:
-                llm = l
+        llm = self.__table.get_llm_by_priority(type, priority)
         if not llm:
             raise Exception(f"No LLM available for type {type}")
         return llm
-    
+
     def get_llms_by_type(self, type):
-        llms = []
-        for l in self.get_all_llms_and_types():
-            if l['type'] == type :
-                llms.append(l)
+        llms = self.__table.get_llms_by_type(type)
+        if len(llms) == 0:
+            raise Exception(f"No LLM available for type {type}")
+        return llms
+
+    def get_failover_chain(self, type):
+        llms = self.__table.get_failover_chain(type)
         if len(llms) == 0:
             raise Exception(f"No LLM available for type {type}")
-        return llms
\ No newline at end of file
+        return llms
@@ -1,12 +1,136 @@
-import etcd3
+from etcd3.events import DeleteEvent
 import json
 import logging
 import os
-from config.config import Config
+import threading
+import time
+from config.config import Config, get_etcd_client
 from liev_llm_manager.exception.exception import LLMMissingRequiredFieldException
 from liev_llm_manager.base_llm_manager import BaseLLMManager
+from liev_llm_manager.routing_table import RoutingTable
 
 name = 'EtcdEndpointManager'
+
+LLMS_PREFIX = '/llms/'
+ENDPOINTS_PREFIX = '/llms/endpoints/'
+TYPES_PREFIX = '/llms/types/'
+# Priority index. /llms/priorities/{type}/{priority} holds the name of the LLM with that priority
+PRIORITIES_PREFIX = '/llms/priorities/'
+
+
+def build_routing_table(kvs):
+    """
+    Builds a RoutingTable from (key, value) pairs read under the /llms/ prefix.
+
+    Args:
+        kvs (iterable): (key, value) pairs, both as bytes.
+
+    Returns:
+        tuple: The endpoint records by key, the type records by key and the RoutingTable.
+    """
+    endpoints = {}
+    types = {}
+    for key, value in kvs:
+        key = key.decode('utf-8') if isinstance(key, bytes) else key
+        if key.startswith(ENDPOINTS_PREFIX):
+            endpoints[key] = json.loads(value)
+        elif key.startswith(TYPES_PREFIX):
+            types[key] = json.loads(value)
+    return endpoints, types, RoutingTable(endpoints.values(), types.values())
+
+
+class EtcdEndpointReplica():
+    """
+    Local replica of the /llms/ keys, kept current by an etcd watch.
+
+    Both prefixes are loaded with a single range request, so the endpoint/type join is always
+    built from one revision. Every watch response is applied as a whole and a new RoutingTable is
+    swapped in, so readers never see a half-applied change. If the watch breaks, the replica keeps
+    serving the last snapshot and resynchronizes in background.
+    """
+
+    def __init__(self, etcd, resync_interval=5):
+        self.__etcd = etcd
+        self.__logger = logging.getLogger("EtcdEndpointReplica")
+        self.__resync_interval = resync_interval
+        self.__lock = threading.Lock()
+        self.__watch_id = None
+        self.__endpoints = {}
+        self.__types = {}
+        self.__table = RoutingTable([], [])
+        self.__revision = 0
+        self.__load()
+
+    @property
+    def table(self):
+        return self.__table
+
+    @property
+    def revision(self):
+        return self.__revision
+
+    def __load(self):
+        response = self.__etcd.get_prefix_response(LLMS_PREFIX)
+        endpoints, types, table = build_routing_table((kv.key, kv.value) for kv in response.kvs)
+        with self.__lock:
+            self.__endpoints = endpoints
+            self.__types = types
+            self.__revision = response.header.revision
+            self.__table = table
+            self.__watch_id = self.__etcd.add_watch_prefix_callback(LLMS_PREFIX,
+                                                                     self.__on_watch_response,
+                                                                     start_revision=self.__revision + 1)
+        self.__logger.info(f"Etcd replica loaded at revision {self.__revision}: {len(endpoints)} endpoints, {len(types)} types")
+
+    def __on_watch_response(self, watch_response):
+        if isinstance(watch_response, Exception):
+            self.__logger.error(f"Etcd replica watch failed: {watch_response}. Serving revision {self.__revision} until resync")
+            threading.Thread(target=self.__resync, daemon=True).start()
+            return
+
+        with self.__lock:
+            endpoints = dict(self.__endpoints)
+            types = dict(self.__types)
+            revision = self.__revision
+            for event in watch_response.events:
+                key = event.key.decode('utf-8')
+                if key.startswith(ENDPOINTS_PREFIX):
+                    records = endpoints
+                elif key.startswith(TYPES_PREFIX):
+                    records = types
+                else:
+                    continue
+                revision = max(revision, event.mod_revision)
+                if isinstance(event, DeleteEvent):
+                    records.pop(key, None)
+                    continue
+                try:
+                    record = json.loads(event.value)
+                    if not isinstance(record, dict):
+                        raise ValueError(f"expected a JSON object, got {type(record).__name__}")
+                except ValueError as e:
+                    # A bad value written by hand must not stop the watch. The previous record of the key is kept
+                    self.__logger.error(f"Etcd replica skipped {key} at revision {event.mod_revision}: {e}")
+                    continue
+                records[key] = record
+            self.__endpoints = endpoints
+            self.__types = types
+            self.__revision = max(revision, watch_response.header.revision)
+            self.__table = RoutingTable(endpoints.values(), types.values())
+
+    def __resync(self):
+        try:
+            self.__etcd.cancel_watch(self.__watch_id)
+        except Exception:
+            pass
+        while True:
+            try:
+                self.__load()
+                return
+            except Exception as e:
+                self.__logger.error(f"Etcd replica resync failed: {e}. Retrying in {self.__resync_interval}s")
+                time.sleep(self.__resync_interval)
+
 class EtcdEndpointManager(BaseLLMManager):
     def __init__(self):
         super().__init__()
@@ -15,14 +139,29 @@ class EtcdEndpointManager(BaseLLMManager):
         self.__etcd_host = self.__config.get('ETCD_HOST')
         self.__etcd_port = self.__config.get('ETCD_PORT')
 
+        # 'direct' reads etcd on every lookup. 'replica' serves every read from a watched local copy
+        self.__mode = self.__config.get('ETCD_MANAGER_MODE', 'direct')
+
         if None in (self.__etcd_host, self.__etcd_port):
             raise Exception("If using LLM_MANAGER_IMPL='etcd' you need to set ETCD_HOST and ETCD_PORT env vars!")
+        if self.__mode not in ['direct', 'replica']:
+            raise Exception("ETCD_MANAGER_MODE must be 'direct' or 'replica'")
 
+        self.__replica = None
         try:
-            self.__etcd = etcd3.client(host=self.__etcd_host, port=self.__etcd_port)
+            self.__etcd = get_etcd_client(self.__etcd_host, self.__etcd_port)
+            if self.__mode == 'replica':
+                self.__replica = EtcdEndpointReplica(self.__etcd)
         except Exception as e:
             self.__logger.error(f"Error initializing EtcdEndpointManager: {e}", exc_info=True)
 
+    def __get_table(self):
+        """Returns the routing table from the replica, or from a single range read in direct mode"""
+        if self.__replica is not None:
+            return self.__replica.table
+        endpoints, types, table = build_routing_table((metadata.key, value) for value, metadata in self.__etcd.get_prefix(LLMS_PREFIX))
+        return table
+
     def create_llm(self, 
                    name, 
                    model, 
@@ -35,7 +174,8 @@ class EtcdEndpointManager(BaseLLMManager):
                    is_external = False,
                    stream_url = None,
                    http_stream_url = None,
-                   fim_url = None):
+                   fim_url = None,
+                   replicas = None):
         try:
             # Create item in etcd
             endpoint_data = {
@@ -52,6 +192,8 @@ class EtcdEndpointManager(BaseLLMManager):
                 "http_stream_url": http_stream_url if http_stream_url is not None else '',
                 "fim_url": fim_url if fim_url else None,
             }
+            if replicas:
+                endpoint_data['replicas'] = replicas
             required_fields = ["name", "model", "url", "username", "password", "response_mime"]
             for field in required_fields:
                 if field not in endpoint_data:
@@ -62,7 +204,7 @@ class EtcdEndpointManager(BaseLLMManager):
         except Exception as e:
             self.__logger.error(f'Error creating LLM: {e}', exc_info=True)
     
-    def create_llm_type(self, name, type, priority):
+    def create_llm_type(self, name, type, priority, share_priority=False):
         try:
             # Fetch all items of the given type
             existing_items = self.get_llms_by_type(type)
@@ -76,11 +218,11 @@ class EtcdEndpointManager(BaseLLMManager):
             if priority > max_priority + 1:
                 priority = max_priority + 1
 
-            # Update priorities
+            # Update priorities. An LLM sharing the priority leaves the others in place
             for item in existing_items:
-                if item['priority'] >= priority:
+                if item['priority'] >= priority and not share_priority:
                     item['priority'] += 1
-                    self.__etcd.put(f"/llms/types/{type}/{item['name']}", json.dumps(item))
+                    self.__put_type({"type": type, "name": item['name'], "priority": item['priority']})
 
             # Create the new item with the desired priority
             type_data = {
@@ -88,24 +230,52 @@ class EtcdEndpointManager(BaseLLMManager):
                 "name": name,
                 "priority": priority
             }
-            self.__etcd.put(f"/llms/types/{type}/{name}", json.dumps(type_data))
+            self.__put_type(type_data)
         except Exception as e:
             self.__logger.error(f'Error creating LLM type: {e}', exc_info=True)
 
 
-    def update_llm_type(self, name, type, priority):
+    def update_llm_type(self, name, type, priority, share_priority=False):
         # In Etcd, create again will replace
-        self.create_llm_type(name, type, priority)
+        self.create_llm_type(name, type, priority, share_priority)
     
+    def __put_type(self, type_data):
+        """Writes the type record and its priority index entry in one transaction"""
+        type = type_data['type']
+        self.__etcd.transaction(
+            compare=[],
+            success=[
+                self.__etcd.transactions.put(f"/llms/types/{type}/{type_data['name']}", json.dumps(type_data)),
+                self.__etcd.transactions.put(f"{PRIORITIES_PREFIX}{type}/{type_data['priority']}", type_data['name']),
+            ],
+            failure=[]
+        )
+
     def delete_llm_type(self, name, type):
         try:
-            # Delete the item from etcd
-            self.__etcd.delete(f"/llms/types/{type}/{name}")
+            type_value, type_metadata = self.__etcd.get(f"/llms/types/{type}/{name}")
+            item_type = json.loads(type_value) if type_value else None
+
+            # Delete the item from etcd. The priority index entry goes too, unless another LLM already took it
+            if item_type is None:
+                self.__etcd.delete(f"/llms/types/{type}/{name}")
+            else:
+                index_key = f"{PRIORITIES_PREFIX}{type}/{item_type['priority']}"
+                self.__etcd.transaction(
+                    compare=[self.__etcd.transactions.value(index_key) == name],
+                    success=[
+                        self.__etcd.transactions.delete(f"/llms/types/{type}/{name}"),
+                        self.__etcd.transactions.delete(index_key),
+                    ],
+                    failure=[self.__etcd.transactions.delete(f"/llms/types/{type}/{name}")]
+                )
         except Exception as e:
             self.__logger.error(f"Error deleting LLM type: {e}", exc_info=True)
         
     def get_llm_by_name(self, name, type=None):
         try:
+            if self.__replica is not None:
+                return self.__replica.table.get_llm_by_name(name, type)
             if type is not None:
                 type_value, type_metadata = self.__etcd.get(f"/llms/types/{type}/{name}")
                 item_type = json.loads(type_value) if type_value else None
@@ -128,6 +298,8 @@ class EtcdEndpointManager(BaseLLMManager):
 
     def get_all_llms(self):
         try:
+            if self.__replica is not None:
+                return self.__replica.table.get_all_llms()
             all_llms = []
             for value, metadata in self.__etcd.get_prefix("/llms/endpoints/"):
                 item = json.loads(value)
@@ -139,16 +311,7 @@ class EtcdEndpointManager(BaseLLMManager):
             
     def get_all_llms_and_types(self):
         try:
-            all_llms_list = []
-            for type_value, type_metadata in self.__etcd.get_prefix("/llms/types/"):
-                item_type = json.loads(type_value)
-                endpoint_value, endpoint_metadata = self.__etcd.get(f"/llms/endpoints/{item_type['name']}")
-                item_endpoint = json.loads(endpoint_value) if endpoint_value else None
-
-                if item_endpoint:
-                    llm_info_dict = {**item_endpoint, **item_type}
-                    all_llms_list.append(llm_info_dict)
-            return all_llms_list
+            return self.__get_table().get_all_llms_and_types()
         except Exception as e:
             self.__logger.error(f"Error getting all LLMs: {e}", exc_info=True)
             raise
@@ -165,7 +328,8 @@ class EtcdEndpointManager(BaseLLMManager):
                    is_external = False,
                    stream_url = None,
                    http_stream_url = None,
-                   fim_url = None):
+                   fim_url = None,
+                   replicas = None):
         try:
             # Fetch the existing item
             value, metadata = self.__etcd.get(f"/llms/endpoints/{name}")
@@ -186,6 +350,7 @@ class EtcdEndpointManager(BaseLLMManager):
                 "stream_url": stream_url if stream_url is not None else '',
                 "http_stream_url": http_stream_url if http_stream_url is not None else '',
                 "fim_url": fim_url if fim_url else None,
+                "replicas": replicas,
             }
 
             # Filter out None values
@@ -217,11 +382,18 @@ class EtcdEndpointManager(BaseLLMManager):
 
     def get_llm_by_priority(self, type='text', priority=0):       
         try:
-            type_value, type_metadata = self.__etcd.get(f"/llms/types/{type}/{priority}")
-            item_type = json.loads(type_value) if type_value else None
+            if self.__replica is not None:
+                return self.__replica.table.get_llm_by_priority(type, priority)
+            # Resolve the name through the priority index, then read the type record it points to
+            name_value, name_metadata = self.__etcd.get(f"{PRIORITIES_PREFIX}{type}/{priority}")
+            item_type = None
+            if name_value:
+                type_value, type_metadata = self.__etcd.get(f"/llms/types/{type}/{name_value.decode('utf-8')}")
+                item_type = json.loads(type_value) if type_value else None
 
-            if not item_type:
-                return None
+            # Missing or stale index entry (e.g. types written before the index existed). Fall back to a full read
+            if not item_type or item_type['priority'] != priority:
+                return self.__get_table().get_llm_by_priority(type, priority)
 
             endpoint_value, endpoint_metadata = self.__etcd.get(f"/llms/endpoints/{item_type['name']}")
             item_endpoint = json.loads(endpoint_value) if endpoint_value else None
@@ -235,18 +407,15 @@ class EtcdEndpointManager(BaseLLMManager):
             raise
     
     def get_llms_by_type(self, type):
-        llms = []
         try:
-            for type_value, type_metadata in self.__etcd.get_prefix(f"/llms/types/{type}/"):
-                item_type = json.loads(type_value)
-                
-                endpoint_value, endpoint_metadata = self.__etcd.get(f"/llms/endpoints/{item_type['name']}")
-                item_endpoint = json.loads(endpoint_value) if endpoint_value else None
-
-                if item_type and item_endpoint:
-                    llm = {**item_type, **item_endpoint}
-                    llms.append(llm)
-            return llms
+            return self.__get_table().get_llms_by_type(type)
         except Exception as e:
             self.__logger.error(f"Error getting LLM for type {type}: {e}", exc_info=True)
             raise
+
+    def get_failover_chain(self, type):
+        try:
+            return self.__get_table().get_failover_chain(type)
+        except Exception as e:
+            self.__logger.error(f"Error getting failover chain for type {type}: {e}", exc_info=True)
+            raise
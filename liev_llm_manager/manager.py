@@ -1,10 +1,25 @@
 import importlib
 import os
+import threading
 
 from config.config import Config
 
 config = Config('dispatcher')
+
+# One manager per process, shared by the dispatcher, the controllers and every Socket.io message
+_manager = None
+_manager_lock = threading.Lock()
+
 def get_manager():
+    global _manager
+    if _manager is not None:
+        return _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = _create_manager()
+    return _manager
+
+def _create_manager():
     impl = config.get('LLM_MANAGER_IMPL', 'endpoints_yaml')
     module = importlib.import_module('liev_llm_manager.'+impl)
     class_name = getattr(module, "name", None)
@@ -12,4 +27,4 @@ def get_manager():
     if Manager is None:
         raise Exception(f"No manager found for {impl}")
     else:
-        return Manager()
\ No newline at end of file
+        return Manager()
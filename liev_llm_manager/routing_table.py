@@ -0,0 +1,66 @@
+"""In-memory routing table shared by the LLM managers.
+
+The table joins the endpoint records with the type/priority records once, when it is built,
+and keeps the merged records indexed so that every routing lookup is a dict access.
+A table is never mutated after construction: managers that need to refresh their view
+build a new table and swap the reference.
+"""
+
+class RoutingTable():
+
+    def __init__(self, endpoints, type_records):
+        """
+        Builds the indexes from the raw endpoint and type records.
+
+        Args:
+            endpoints (list): The endpoint records (name, model, url, ...).
+            type_records (list): The type records. Each one must have type, name and priority.
+        """
+        self.__endpoints = list(endpoints)
+        self.__by_name = {}
+        self.__by_name_and_type = {}
+        self.__by_type_and_priority = {}
+        self.__by_type = {}
+        self.__chain_by_type = {}
+        self.__records = []
+
+        for endpoint in self.__endpoints:
+            self.__by_name[endpoint['name']] = endpoint
+
+        for type_record in type_records:
+            endpoint = self.__by_name.get(type_record['name'])
+            if endpoint is None:
+                continue
+            llm = {**type_record, **endpoint}
+            llm['type'] = type_record['type']
+            self.__records.append(llm)
+            self.__by_name_and_type[(llm['name'], llm['type'])] = llm
+            # LLMs created with share_priority share one, see BaseLLMManager.create_llm_type
+            self.__by_type_and_priority.setdefault((llm['type'], llm['priority']), []).append(llm)
+            self.__by_type.setdefault(llm['type'], []).append(llm)
+
+        # The failover chain of a type is its LLMs ordered by priority. Gaps in the priorities are skipped
+        for type, llms in self.__by_type.items():
+            self.__chain_by_type[type] = sorted(llms, key=lambda llm: llm['priority'])
+
+    def get_llm_by_name(self, name, type=None):
+        if type is None:
+            return self.__by_name.get(name)
+        return self.__by_name_and_type.get((name, type))
+
+    def get_llm_by_priority(self, type, priority):
+        """The LLM of the type with the priority. Of several LLMs sharing it, the first record is returned"""
+        llms = self.__by_type_and_priority.get((type, priority))
+        return llms[0] if llms else None
+
+    def get_llms_by_type(self, type):
+        return list(self.__by_type.get(type, []))
+
+    def get_failover_chain(self, type):
+        return list(self.__chain_by_type.get(type, []))
+
+    def get_all_llms(self):
+        return list(self.__endpoints)
+
+    def get_all_llms_and_types(self):
+        return list(self.__records)
@@ -0,0 +1,2 @@
+#!/bin/bash
+uvicorn dispatcher_asgi:app --host 0.0.0.0 --port 5011 --log-level debug
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tests import the controllers from the repository root, with the configuration read from the environment
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'python')
+os.environ.setdefault('CONFIG_MODE', 'local')
@@ -0,0 +1,72 @@
+import time
+import pytest
+from controllers.circuit_breaker import CircuitBreaker
+
+LLM = {'name': 'a', 'model': 'm'}
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD', '2')
+    monkeypatch.setenv('CIRCUIT_COOLDOWN', '0.05')
+    return CircuitBreaker()
+
+
+@pytest.fixture
+def cooled_down(monkeypatch):
+    # Moves the clock of the breakers past the cooldown
+    now = time.monotonic
+    return lambda: monkeypatch.setattr('controllers.circuit_breaker.time.monotonic', lambda: now() + 1)
+
+
+def open_circuit(breakers):
+    breakers.record_failure(LLM)
+    breakers.record_failure(LLM)
+    assert breakers.state(LLM) == CircuitBreaker.OPEN
+
+
+def test_opens_after_consecutive_failures(breakers):
+    breakers.record_failure(LLM)
+    breakers.record(LLM, 200)
+    breakers.record_failure(LLM)
+    assert breakers.state(LLM) == CircuitBreaker.CLOSED
+    breakers.record(LLM, 503)
+    assert breakers.state(LLM) == CircuitBreaker.OPEN
+    assert breakers.is_open(LLM)
+    assert not breakers.allow(LLM)
+
+
+def test_half_open_allows_one_trial(breakers, cooled_down):
+    open_circuit(breakers)
+    cooled_down()
+    assert breakers.allow(LLM)
+    assert breakers.state(LLM) == CircuitBreaker.HALF_OPEN
+    assert not breakers.allow(LLM)
+    breakers.record(LLM, 200)
+    assert breakers.state(LLM) == CircuitBreaker.CLOSED
+
+
+def test_is_open_does_not_take_the_trial(breakers, cooled_down):
+    open_circuit(breakers)
+    cooled_down()
+    assert not breakers.is_open(LLM)
+    assert not breakers.is_open(LLM)
+    assert breakers.allow(LLM)
+
+
+def test_failed_trial_opens_again(breakers, cooled_down):
+    open_circuit(breakers)
+    cooled_down()
+    assert breakers.allow(LLM)
+    breakers.record(LLM, 429)
+    assert breakers.is_open(LLM)
+
+
+def test_released_trial_goes_to_the_next_call(breakers, cooled_down):
+    open_circuit(breakers)
+    cooled_down()
+    assert breakers.allow(LLM)
+    breakers.release_trial(LLM)
+    assert breakers.state(LLM) == CircuitBreaker.HALF_OPEN
+    assert breakers.allow(LLM)
+    assert not breakers.allow(LLM)
@@ -0,0 +1,64 @@
+import asyncio
+import time
+import pytest
+from controllers.concurrency_limiter import ConcurrencyLimiter
+from exception.exceptions import ConcurrencyLimitException
+
+LLM = {'name': 'a', 'model': 'm', 'max_concurrency': 1}
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setenv('CONCURRENCY_QUEUE_TIMEOUT_MS', '200')
+    monkeypatch.setenv('CONCURRENCY_MIN_LIMIT', '1')
+    return ConcurrencyLimiter()
+
+
+def test_refuses_beyond_the_limit_after_the_queue_timeout(limiter):
+    limiter.acquire(LLM)
+    started = time.monotonic()
+    with pytest.raises(ConcurrencyLimitException):
+        limiter.acquire(LLM)
+    assert time.monotonic() - started >= 0.2
+    limiter.release(LLM, 0.1)
+    limiter.acquire(LLM)
+
+
+def test_refuses_when_the_queue_is_full(monkeypatch):
+    monkeypatch.setenv('CONCURRENCY_QUEUE_SIZE', '0')
+    limiter = ConcurrencyLimiter()
+    limiter.acquire(LLM)
+    started = time.monotonic()
+    with pytest.raises(ConcurrencyLimitException):
+        limiter.acquire(LLM)
+    assert time.monotonic() - started < 0.1
+
+
+def test_async_waiter_gets_the_released_slot(limiter):
+    async def scenario():
+        await limiter.acquire_async(LLM)
+        # A waiter that timed out must not take the wake-up of the next one
+        with pytest.raises(ConcurrencyLimitException):
+            await limiter.acquire_async(LLM)
+        waiter = asyncio.ensure_future(limiter.acquire_async(LLM))
+        await asyncio.sleep(0.02)
+        released = time.monotonic()
+        limiter.release(LLM, 0.1)
+        await waiter
+        return time.monotonic() - released
+
+    assert asyncio.run(scenario()) < 0.1
+
+
+def test_failures_decrease_the_limit(monkeypatch):
+    monkeypatch.setenv('CONCURRENCY_INITIAL_LIMIT', '10')
+    monkeypatch.setenv('CONCURRENCY_MIN_LIMIT', '1')
+    monkeypatch.setenv('CONCURRENCY_BACKOFF', '0.5')
+    limiter = ConcurrencyLimiter()
+    llm = {'name': 'b', 'model': 'm'}
+    for _ in range(6):
+        limiter.acquire(llm)
+    limiter.release(llm, failed=True)
+    # The limit is now 5, with 5 calls in flight
+    with pytest.raises(ConcurrencyLimitException):
+        limiter.acquire(llm)
@@ -0,0 +1,75 @@
+import aiohttp
+import pytest
+import requests
+from controllers.deadline import Deadline, Timeouts, caused_by_deadline
+from exception.exceptions import DeadlineExceededException
+
+LLM = {'name': 'a', 'model': 'm', 'connect_timeout': 2, 'read_timeout': 30}
+
+
+def test_timeouts_without_deadline_are_the_llm_ones():
+    timeout = Deadline().timeouts(LLM)
+    assert timeout == (2.0, 30.0)
+    assert not timeout.connect_capped and not timeout.read_capped
+
+
+def test_timeouts_capped_by_the_remaining_budget():
+    timeout = Deadline(5000).timeouts(LLM)
+    assert timeout[0] == 2.0 and timeout[1] <= 5.0
+    assert not timeout.connect_capped and timeout.read_capped
+
+
+def test_attempt_timeouts_split_the_budget():
+    timeout = Deadline(4000).attempt_timeouts(LLM, 4)
+    assert timeout[0] <= 1.0 and timeout[1] <= 1.0
+    assert timeout.connect_capped and timeout.read_capped
+
+
+def test_expired_deadline_raises():
+    deadline = Deadline(0.001)
+    while not deadline.expired():
+        pass
+    with pytest.raises(DeadlineExceededException):
+        deadline.timeouts(LLM)
+
+
+def test_caused_by_deadline():
+    read_capped = Timeouts(2, 5, read_capped=True)
+    uncapped = Timeouts(2, 30)
+    assert caused_by_deadline(DeadlineExceededException(), None)
+    assert caused_by_deadline(requests.exceptions.ReadTimeout(), read_capped)
+    assert not caused_by_deadline(requests.exceptions.ConnectTimeout(), read_capped)
+    assert not caused_by_deadline(requests.exceptions.ReadTimeout(), uncapped)
+    assert caused_by_deadline(aiohttp.SocketTimeoutError(), read_capped)
+    assert not caused_by_deadline(aiohttp.ConnectionTimeoutError(), read_capped)
+    assert not caused_by_deadline(requests.exceptions.ConnectionError(), read_capped)
+    assert not caused_by_deadline(requests.exceptions.ReadTimeout(), (2, 5))
+
+
+def test_split_shares_the_budget_left():
+    timeout = Timeouts(2, 9, False, True, 9)
+    first = timeout.split(0, 3)
+    assert first == (2, 3) and first.read_capped and not first.connect_capped
+    last = timeout.split(8, 1)
+    assert last == (1, 1) and last.connect_capped
+    with pytest.raises(DeadlineExceededException):
+        timeout.split(9, 1)
+
+
+def test_split_without_deadline_keeps_the_timeouts():
+    timeout = Deadline().timeouts(LLM)
+    assert timeout.split(5, 3) is timeout
+
+
+def test_timeouts_carry_the_request_deadline():
+    assert Deadline().timeouts(LLM).remaining() is None
+    timeout = Deadline(5000).attempt_timeouts(LLM, 2)
+    assert 4.5 < timeout.remaining() <= 5.0
+    assert timeout.split(1, 2).expires == timeout.expires
+
+
+def test_timeout_after_the_deadline_is_caused_by_it():
+    expired = Timeouts(2, 30, expires=0)
+    assert caused_by_deadline(requests.exceptions.ReadTimeout(), expired)
+    assert caused_by_deadline(aiohttp.ServerTimeoutError(), expired)
+    assert not caused_by_deadline(requests.exceptions.ConnectionError(), expired)
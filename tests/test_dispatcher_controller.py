@@ -0,0 +1,94 @@
+import http.server
+import threading
+import time
+import flask
+import pytest
+import controllers.dispatcher_controller as dispatcher_controller
+import controllers.health_checker as health_checker
+
+
+class Upstream(http.server.BaseHTTPRequestHandler):
+    """A model server sending its answer over the seconds of its path, one byte at a time"""
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'"' + b'o' * 48 + b'"'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # A stalled server keeps the connection busy, so the read timeouts never fire
+        for byte in body:
+            time.sleep(float(self.path.strip('/')) / len(body))
+            self.wfile.write(bytes([byte]))
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+class FakeAuth:
+    def current_user(self):
+        return {'application': 'tests', 'username': 'tests'}
+
+
+@pytest.fixture
+def controller(monkeypatch, upstream):
+    llms = [
+        {'name': 'fast', 'model': 'm', 'url': f'{upstream}/0', 'response_mime': 'application/json', 'username': '', 'password': '', 'health_check': 'off'},
+        {'name': 'stalled', 'model': 'm', 'url': f'{upstream}/5', 'response_mime': 'application/json', 'username': '', 'password': '', 'health_check': 'off'},
+    ]
+
+    class FakeManager:
+        def get_all_llms(self):
+            return llms
+
+        def get_llms_by_type(self, type_str):
+            return llms
+
+        def get_llm_by_name(self, name, type=None):
+            return next((llm for llm in llms if llm['name'] == name), None)
+
+    monkeypatch.setenv('HEALTH_CHECK_INTERVAL', '0')
+    monkeypatch.setattr(health_checker, '_health_checker', None)
+    monkeypatch.setattr(health_checker, 'get_manager', FakeManager)
+    monkeypatch.setattr(dispatcher_controller, 'get_manager', FakeManager)
+    return dispatcher_controller.DispatcherController()
+
+
+def test_multi_llm_returns_partial_answers_at_the_deadline(controller):
+    data = {'instruction': 'hello', 'type': 'text', 'llm_name': 'all'}
+    app = flask.Flask(__name__)
+    with app.test_request_context('/response', method='GET', json=data, headers={'Liev-Deadline-Ms': '500'}):
+        started = time.monotonic()
+        body, status, headers = controller.get_response(data, FakeAuth())
+        elapsed = time.monotonic() - started
+
+    assert elapsed < 1.5
+    assert status == 200
+    assert headers['Liev-Response-Model'] == 'fast(m)'
+    assert headers['Liev-Response-Cancelled-Models'] == 'stalled(m)'
+    assert headers['Liev-Response-Partial'] is True
+
+
+def test_slow_answer_is_cut_at_the_deadline(controller):
+    data = {'instruction': 'hello', 'llm_name': 'stalled'}
+    app = flask.Flask(__name__)
+    with app.test_request_context('/response', method='GET', json=data, headers={'Liev-Deadline-Ms': '500'}):
+        started = time.monotonic()
+        body, status, headers = controller.get_response(data, FakeAuth())
+        elapsed = time.monotonic() - started
+
+    assert elapsed < 1.5
+    assert status == 504
+    assert headers['Liev-Response-Failed-Models'] == 'stalled(m)'
@@ -0,0 +1,27 @@
+import asyncio
+import pytest
+from controllers.dispatcher_controller_async import _ClosingStreamingResponse
+
+
+@pytest.mark.parametrize('spec_version', ['2.0', '2.4'])
+def test_stream_is_closed_when_the_client_disconnects_first(spec_version):
+    closed = []
+    started = []
+
+    async def body():
+        started.append(True)
+        yield b'"ok"'
+
+    async def on_close():
+        closed.append(True)
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        raise OSError('Connection reset by peer')
+
+    response = _ClosingStreamingResponse(body(), on_close)
+    with pytest.raises(Exception):
+        asyncio.run(response({'type': 'http', 'asgi': {'spec_version': spec_version}}, receive, send))
+    assert started == [] and closed == [True]
@@ -0,0 +1,37 @@
+import json
+from types import SimpleNamespace
+from liev_llm_manager.etcd import EtcdEndpointReplica
+
+
+class FakeEtcd:
+    def __init__(self, kvs):
+        self.kvs = [SimpleNamespace(key=key.encode(), value=json.dumps(value).encode()) for key, value in kvs.items()]
+        self.callback = None
+
+    def get_prefix_response(self, prefix):
+        return SimpleNamespace(kvs=self.kvs, header=SimpleNamespace(revision=1))
+
+    def add_watch_prefix_callback(self, prefix, callback, start_revision):
+        self.callback = callback
+        return 1
+
+
+def put(key, value, revision):
+    return SimpleNamespace(key=key.encode(), value=value, mod_revision=revision)
+
+
+def test_bad_watch_values_are_skipped():
+    etcd = FakeEtcd({
+        '/llms/endpoints/a': {'name': 'a', 'model': 'm', 'url': 'http://a'},
+        '/llms/types/text/a': {'type': 'text', 'name': 'a', 'priority': 1},
+    })
+    replica = EtcdEndpointReplica(etcd)
+    etcd.callback(SimpleNamespace(header=SimpleNamespace(revision=4), events=[
+        put('/llms/endpoints/a', b'{"name": "a", "model": "m", "url": "http://a2"}', 2),
+        put('/llms/endpoints/b', b'{not json', 3),
+        put('/llms/types/text/a', b'[1]', 4),
+    ]))
+    assert replica.revision == 4
+    assert replica.table.get_llm_by_name('a')['url'] == 'http://a2'
+    assert replica.table.get_llm_by_name('b') is None
+    assert [llm['name'] for llm in replica.table.get_failover_chain('text')] == ['a']
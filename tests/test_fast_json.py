@@ -0,0 +1,44 @@
+import json
+import pytest
+import controllers.fast_json as fast_json
+
+
+@pytest.fixture(autouse=True, params=['orjson', 'json'])
+def backend(request, monkeypatch):
+    # Both backends give the same documents
+    if request.param == 'json':
+        monkeypatch.setattr(fast_json, 'orjson', None)
+    elif fast_json.orjson is None:
+        pytest.skip('orjson is not installed')
+
+
+def test_dumps_sorted_keys_give_equal_bytes():
+    assert fast_json.dumps({'b': 1, 'a': 'ã'}, sort_keys=True) == fast_json.dumps({'a': 'ã', 'b': 1}, sort_keys=True)
+    assert json.loads(fast_json.dumps({'a': 2 ** 70})) == {'a': 2 ** 70}
+
+
+def test_dumps_non_finite_floats_as_null():
+    assert json.loads(fast_json.dumps({'a': float('nan'), 'b': [float('inf'), -float('inf'), 1.5]})) == {'a': None, 'b': [None, None, 1.5]}
+    # The json fallback of orjson too
+    assert json.loads(fast_json.dumps([2 ** 70, float('nan')])) == [2 ** 70, None]
+
+
+def test_raw_value_keeps_json_and_quotes_text():
+    assert fast_json.raw_value(b'{"answer": 1}') == b'{"answer": 1}'
+    assert json.loads(fast_json.raw_value(b'plain "text" answer')) == 'plain "text" answer'
+    assert json.loads(fast_json.raw_value(b'')) == ''
+    assert json.loads(fast_json.raw_value(b'\xff')) == '�'
+
+
+def test_is_json():
+    assert fast_json.is_json(b'[1, 2]')
+    assert fast_json.is_json(b'"text"')
+    assert not fast_json.is_json(b'{"a": ')
+    assert not fast_json.is_json('"a"'.encode('utf-16'))
+
+
+def test_splice():
+    spliced = fast_json.splice_object([('a', b'{"x": [1]}'), ('b', fast_json.raw_value(b'text'))])
+    assert json.loads(spliced) == {'a': {'x': [1]}, 'b': 'text'}
+    assert json.loads(fast_json.splice_array([spliced, b'2'])) == [{'a': {'x': [1]}, 'b': 'text'}, 2]
+    assert fast_json.splice_array([]) == b'[]'
@@ -0,0 +1,54 @@
+import concurrent.futures
+import contextlib
+import pytest
+import controllers.health_checker as health_checker
+
+LLMS = [
+    {'name': 'internal', 'url': 'http://internal/response', 'stream_url': 'ws://internal:8080'},
+    {'name': 'external', 'url': 'https://paid/response', 'is_external': True},
+    {'name': 'external_tcp', 'url': 'https://paid-tcp/response', 'is_external': 'true', 'health_check': 'tcp'},
+    {'name': 'internal_off', 'url': 'http://off/response', 'health_check': 'off'},
+]
+
+
+class FakeManager:
+    def get_all_llms(self):
+        return LLMS
+
+    def get_llms_by_type(self, type_str):
+        return LLMS
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+@pytest.fixture
+def probed(monkeypatch):
+    monkeypatch.setenv('HEALTH_CHECK_INTERVAL', '0')
+    monkeypatch.setattr(health_checker, 'get_manager', FakeManager)
+    probed = []
+    monkeypatch.setattr(health_checker.SessionPool, 'request', lambda self, method, llm, url, **kwargs: probed.append(('request', url)) or FakeResponse())
+    monkeypatch.setattr(health_checker.socket, 'create_connection', lambda address, timeout: probed.append(('tcp', address)) or contextlib.nullcontext())
+
+    def check():
+        checker = health_checker.HealthChecker()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            checker._HealthChecker__check(executor)
+        return sorted(probed)
+    return check
+
+
+def test_external_llms_are_not_sent_requests(probed):
+    assert probed() == [('request', 'http://internal/response'), ('tcp', ('internal', 8080)), ('tcp', ('paid-tcp', 443))]
+
+
+def test_external_probe_is_configurable(probed, monkeypatch):
+    monkeypatch.setenv('HEALTH_CHECK_EXTERNAL', 'request')
+    assert ('request', 'https://paid/response') in probed()
@@ -0,0 +1,47 @@
+import pytest
+from controllers.load_balancer import LoadBalancer
+
+
+def chain(*names, priority=1):
+    return [{'name': name, 'model': 'm', 'priority': priority} for name in names]
+
+
+def call(balancer, llm, seconds=None, failed=False):
+    balancer.start(llm)
+    balancer.finish(llm, seconds, failed)
+
+
+def test_priorities_keep_their_order():
+    llms = chain('a', 'b') + chain('c', priority=2)
+    for _ in range(20):
+        assert LoadBalancer().order(llms)[-1]['name'] == 'c'
+
+
+def test_prefers_the_faster_llm():
+    balancer = LoadBalancer()
+    fast, slow = chain('fast', 'slow')
+    call(balancer, fast, 0.1)
+    call(balancer, slow, 2)
+    for _ in range(20):
+        assert balancer.order([fast, slow])[0] is fast
+
+
+def test_prefers_the_idler_llm():
+    balancer = LoadBalancer()
+    busy, idle = chain('busy', 'idle')
+    call(balancer, busy, 1)
+    call(balancer, idle, 1)
+    balancer.start(busy)
+    balancer.start(busy)
+    assert balancer.order([busy, idle])[0] is idle
+
+
+@pytest.mark.parametrize('calls', [1, 5])
+def test_failing_llm_loses(calls):
+    balancer = LoadBalancer()
+    failing, working = chain('failing', 'working')
+    call(balancer, working, 1.5)
+    for _ in range(calls):
+        call(balancer, failing, failed=True)
+    for _ in range(20):
+        assert balancer.order([failing, working])[0] is working
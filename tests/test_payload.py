@@ -0,0 +1,32 @@
+import json
+from controllers.payload import Payload
+
+RAW = b'{"instruction": "sort a list",  "temperature": 0, "type": "code"}'
+PLAIN = {'name': 'a', 'model': 'm'}
+MASKED = {'name': 'b', 'model': 'm', 'prompt_mask': 'Answer in Python: %PROMPT%', 'system_message': 'Be brief'}
+
+
+def payload():
+    return Payload(json.loads(RAW), RAW)
+
+
+def test_raw_body_forwarded_without_overlay():
+    assert payload().body(PLAIN) is RAW
+    assert json.loads(Payload(json.loads(RAW)).body(PLAIN)) == json.loads(RAW)
+
+
+def test_overlay_applied_without_changing_the_request():
+    data = json.loads(RAW)
+    masked = Payload(data, RAW).body(MASKED)
+    assert json.loads(masked) == {**data, 'instruction': 'Answer in Python: sort a list', 'system_msg': 'Be brief'}
+    assert data == json.loads(RAW)
+
+
+def test_fim_ignores_the_overlay():
+    assert payload().body(MASKED, is_fim=True) is RAW
+
+
+def test_digest_ignores_key_order_spacing_and_dispatcher_fields():
+    reordered = b'{"temperature":0,"instruction":"sort a list","try_next_on_failure":false}'
+    assert payload().digest(PLAIN) == Payload(json.loads(reordered), reordered).digest(PLAIN)
+    assert payload().digest(PLAIN) != payload().digest(MASKED)
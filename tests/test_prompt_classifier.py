@@ -0,0 +1,57 @@
+import json
+import pytest
+from controllers.prompt_classifier import PromptClassifier
+
+CODE = ['write a python function that sorts a list', 'fix this java class that throws an exception',
+        'write a sql query that joins two tables', 'refactor this python function to use a loop']
+TEXT = ['summarize this article about the economy', 'write a poem about the sea',
+        'translate this sentence to spanish', 'tell me a story about a dragon']
+
+
+@pytest.fixture
+def classifier_env(monkeypatch):
+    monkeypatch.setenv('DETECT_CLASSIFIER', 'true')
+    monkeypatch.setenv('DETECT_CLASSIFIER_MIN_SAMPLES', '8')
+    monkeypatch.setenv('DETECT_CLASSIFIER_CONFIDENCE', '0.9')
+
+
+def train(classifier):
+    for code, text in zip(CODE, TEXT):
+        classifier.learn(code, 'code')
+        classifier.learn(text, 'text')
+
+
+def test_cache_answers_a_repeated_prompt():
+    classifier = PromptClassifier()
+    assert classifier.classify('What is 2 + 2?') == (None, None)
+    classifier.learn('What is 2 + 2?', 'text')
+    assert classifier.classify('  what IS 2 + 2?') == ('text', 'cache')
+
+
+def test_classifier_answers_after_enough_samples(classifier_env):
+    classifier = PromptClassifier()
+    classifier.learn(CODE[0], 'code')
+    assert classifier.classify('write a python function that reverses a list') == (None, None)
+    train(classifier)
+    assert classifier.classify('write a python function that reverses a list') == ('code', 'classifier')
+
+
+def test_trained_from_the_log_at_startup(classifier_env, monkeypatch, tmp_path):
+    log = tmp_path / 'detections.jsonl'
+    monkeypatch.setenv('DETECT_CLASSIFIER_LOG', str(log))
+    train(PromptClassifier())
+    assert len(log.read_text(encoding='utf-8').splitlines()) == 8
+    assert PromptClassifier().classify('write a python function that reverses a list') == ('code', 'classifier')
+
+
+def test_log_is_rotated(classifier_env, monkeypatch, tmp_path):
+    log = tmp_path / 'detections.jsonl'
+    monkeypatch.setenv('DETECT_CLASSIFIER_LOG', str(log))
+    monkeypatch.setenv('DETECT_CLASSIFIER_LOG_MAX_BYTES', '300')
+    classifier = PromptClassifier()
+    for _ in range(20):
+        train(classifier)
+    rotated = tmp_path / 'detections.jsonl.1'
+    assert rotated.stat().st_size < 400 and (not log.exists() or log.stat().st_size < 300)
+    samples = [json.loads(line) for path in (rotated, log) if path.exists() for line in path.read_text(encoding='utf-8').splitlines()]
+    assert samples[-1] == {'instruction': TEXT[-1], 'type': 'text'}
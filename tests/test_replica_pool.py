@@ -0,0 +1,40 @@
+from collections import Counter
+from controllers.replica_pool import ReplicaPool
+
+LLM = {'name': 'a', 'model': 'm', 'url': 'http://a/response', 'fim_url': 'http://a/fim', 'replicas': [
+    {'url': 'http://r1/response', 'weight': 2},
+    {'url': 'http://r2/response'},
+]}
+
+
+def test_without_replicas_the_record_is_called():
+    llm = {'name': 'b', 'model': 'm', 'url': 'http://b/response'}
+    assert ReplicaPool().order(llm) == [llm]
+
+
+def test_weighted_round_robin():
+    pool = ReplicaPool()
+    firsts = Counter(pool.order(LLM)[0]['replica'] for _ in range(30))
+    assert firsts == {'http://r1/response': 20, 'http://r2/response': 10}
+
+
+def test_replica_fields_override_the_record():
+    replica = ReplicaPool().order(LLM)[0]
+    assert replica['url'] == replica['replica']
+    assert replica['fim_url'] == 'http://a/fim'
+    assert replica['name'] == 'a'
+
+
+def test_ejected_replica_is_left_out():
+    pool = ReplicaPool()
+    first = pool.order(LLM)[0]
+    pool.eject(first, 'timeout')
+    for _ in range(5):
+        assert [replica['replica'] for replica in pool.order(LLM)] == [r['url'] for r in LLM['replicas'] if r['url'] != first['replica']]
+
+
+def test_all_ejected_are_all_tried():
+    pool = ReplicaPool()
+    for replica in pool.order(LLM):
+        pool.eject(replica, 'timeout')
+    assert len(pool.order(LLM)) == 2
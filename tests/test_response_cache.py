@@ -0,0 +1,60 @@
+import json
+import pytest
+from controllers.payload import Payload
+from controllers.response_cache import ResponseCache
+
+LLM = {'name': 'a', 'model': 'm'}
+
+
+@pytest.fixture
+def cache_env(monkeypatch):
+    monkeypatch.setenv('RESPONSE_CACHE', 'true')
+    monkeypatch.setenv('RESPONSE_CACHE_MAX_BYTES', '10')
+    monkeypatch.setenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', '6')
+
+
+def key(cache, instruction):
+    data = {'instruction': instruction, 'temperature': 0}
+    return cache.key(LLM, Payload(data, json.dumps(data).encode()))
+
+
+def test_applies(cache_env, monkeypatch):
+    monkeypatch.setenv('RESPONSE_CACHE_TYPES', 'code')
+    cache = ResponseCache()
+    assert cache.applies('code', {'temperature': 0})
+    assert cache.applies('code', {'do_sample': False})
+    assert not cache.applies('code', {'temperature': 0.7})
+    assert not cache.applies('code', {'temperature': 0, 'cache': False})
+    assert not cache.applies('code', {'temperature': 0}, stream=True)
+    assert not cache.applies('text', {'temperature': 0})
+
+
+def test_disabled_by_default():
+    assert not ResponseCache().applies('code', {'temperature': 0})
+
+
+def test_get_and_put(cache_env):
+    cache = ResponseCache()
+    assert cache.get(key(cache, 'x')) is None
+    cache.put(key(cache, 'x'), b'abc')
+    assert cache.get(key(cache, 'x')) == b'abc'
+    assert cache.get(key(cache, 'y')) is None
+
+
+def test_least_recently_used_evicted_beyond_the_bound(cache_env):
+    cache = ResponseCache()
+    cache.put(key(cache, 'x'), b'1234')
+    cache.put(key(cache, 'y'), b'1234')
+    cache.get(key(cache, 'x'))
+    cache.put(key(cache, 'z'), b'1234')
+    assert cache.get(key(cache, 'y')) is None
+    assert cache.get(key(cache, 'x')) == b'1234'
+    cache.put(key(cache, 'big'), b'1234567')
+    assert cache.get(key(cache, 'big')) is None
+
+
+def test_expired_answers_are_not_served(cache_env, monkeypatch):
+    monkeypatch.setenv('RESPONSE_CACHE_TTL', '0')
+    cache = ResponseCache()
+    cache.put(key(cache, 'x'), b'abc')
+    assert cache.get(key(cache, 'x')) is None
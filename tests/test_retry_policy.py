@@ -0,0 +1,49 @@
+import aiohttp
+import pytest
+import requests
+from controllers.deadline import Deadline
+from controllers.retry_policy import RetryPolicy
+
+LLM = {'name': 'a', 'model': 'm'}
+
+
+@pytest.mark.parametrize('exception, retried', [
+    (requests.exceptions.ConnectionError(), True),
+    (requests.exceptions.ConnectTimeout(), True),
+    (requests.exceptions.ReadTimeout(), False),
+    (aiohttp.ClientConnectionError(), True),
+    (aiohttp.ConnectionTimeoutError(), True),
+    (aiohttp.SocketTimeoutError(), False),
+    (ValueError(), False),
+])
+def test_retried_errors(exception, retried):
+    assert (RetryPolicy().delay(LLM, 1, Deadline(), exception=exception) is not None) == retried
+
+
+def test_retried_status_codes():
+    policy = RetryPolicy()
+    assert policy.delay(LLM, 1, Deadline(), status_code=503) is not None
+    assert policy.delay(LLM, 1, Deadline(), status_code=400) is None
+    assert policy.delay({**LLM, 'retry_status_codes': '429'}, 1, Deadline(), status_code=429) is not None
+
+
+def test_attempts_are_bounded(monkeypatch):
+    monkeypatch.setenv('RETRY_MAX_ATTEMPTS', '3')
+    policy = RetryPolicy()
+    assert policy.delay(LLM, 2, Deadline(), status_code=503) is not None
+    assert policy.delay(LLM, 3, Deadline(), status_code=503) is None
+    assert policy.delay({**LLM, 'retry_max_attempts': 1}, 1, Deadline(), status_code=503) is None
+
+
+def test_backoff_is_jittered_and_capped(monkeypatch):
+    monkeypatch.setenv('RETRY_MAX_ATTEMPTS', '10')
+    monkeypatch.setenv('RETRY_BACKOFF_MAX_MS', '300')
+    policy = RetryPolicy()
+    assert all(0 <= policy.delay(LLM, 9, Deadline(), status_code=503) <= 0.3 for _ in range(50))
+
+
+def test_no_retry_past_the_deadline(monkeypatch):
+    monkeypatch.setenv('RETRY_BACKOFF_MS', '1000')
+    monkeypatch.setenv('RETRY_BACKOFF_MAX_MS', '1000')
+    monkeypatch.setattr('controllers.retry_policy.random.uniform', lambda low, high: high)
+    assert RetryPolicy().delay(LLM, 1, Deadline(500), status_code=503) is None
@@ -0,0 +1,50 @@
+from liev_llm_manager.routing_table import RoutingTable
+
+ENDPOINTS = [
+    {'name': 'a', 'model': 'm1', 'url': 'http://a'},
+    {'name': 'b', 'model': 'm2', 'url': 'http://b'},
+    {'name': 'c', 'model': 'm3', 'url': 'http://c'},
+]
+TYPES = [
+    {'type': 'text', 'name': 'b', 'priority': 3},
+    {'type': 'text', 'name': 'a', 'priority': 1},
+    {'type': 'code', 'name': 'a', 'priority': 1},
+    {'type': 'code', 'name': 'missing', 'priority': 2},
+]
+
+
+def test_lookups():
+    table = RoutingTable(ENDPOINTS, TYPES)
+    assert table.get_llm_by_name('c')['url'] == 'http://c'
+    assert table.get_llm_by_name('a', 'code')['type'] == 'code'
+    assert table.get_llm_by_name('c', 'code') is None
+    assert table.get_llm_by_priority('text', 3)['name'] == 'b'
+    assert table.get_llm_by_priority('text', 2) is None
+    assert [llm['name'] for llm in table.get_llms_by_type('code')] == ['a']
+    assert table.get_llms_by_type('unknown') == []
+
+
+def test_failover_chain_sorted_by_priority_with_gaps():
+    chain = RoutingTable(ENDPOINTS, TYPES).get_failover_chain('text')
+    assert [(llm['name'], llm['priority']) for llm in chain] == [('a', 1), ('b', 3)]
+
+
+def test_type_records_without_endpoint_are_skipped():
+    table = RoutingTable(ENDPOINTS, TYPES)
+    assert len(table.get_all_llms_and_types()) == 3
+    assert len(table.get_all_llms()) == 3
+
+
+def test_lookups_return_copies():
+    table = RoutingTable(ENDPOINTS, TYPES)
+    table.get_failover_chain('text').clear()
+    table.get_llms_by_type('text').clear()
+    assert len(table.get_failover_chain('text')) == 2
+    assert len(table.get_llms_by_type('text')) == 2
+
+
+def test_shared_priority_keeps_every_llm():
+    types = [{'type': 'text', 'name': name, 'priority': 1} for name in ('a', 'b', 'c')]
+    table = RoutingTable(ENDPOINTS, types)
+    assert table.get_llm_by_priority('text', 1)['name'] == 'a'
+    assert [llm['name'] for llm in table.get_failover_chain('text')] == ['a', 'b', 'c']
@@ -0,0 +1,84 @@
+import asyncio
+import aiohttp
+import requests
+import pytest
+from controllers.session_pool import SessionPool, AsyncSessionPool
+
+LLM = {'name': 'a', 'username': 'u', 'password': 'p', 'pool_idle_timeout': 1e-9}
+
+
+@pytest.fixture
+def closed(monkeypatch):
+    closed = []
+    monkeypatch.setattr(requests.Session, 'close', lambda session: closed.append(session))
+    return closed
+
+
+def test_session_in_use_is_not_closed_when_idle(monkeypatch, closed):
+    pool = SessionPool()
+    sessions = []
+
+    def request(session, method, url, **kwargs):
+        sessions.append(session)
+        # A concurrent call while the first one is in flight
+        if url == 'http://a/outer':
+            pool.get(LLM, 'http://a/inner')
+        return session
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+    pool.get(LLM, 'http://a/outer')
+    assert sessions[0] is sessions[1]
+    assert closed == []
+    # Idle once its calls finished
+    pool.get(LLM, 'http://a/next')
+    assert closed == [sessions[0]]
+
+
+def test_replaced_session_is_closed_after_its_last_call(monkeypatch, closed):
+    pool = SessionPool()
+
+    def request(session, method, url, **kwargs):
+        if url == 'http://a/outer':
+            pool.get({**LLM, 'password': 'changed'}, 'http://a/inner')
+            assert closed == []
+        return session
+
+    monkeypatch.setattr(requests.Session, 'request', request)
+    outer = pool.get(LLM, 'http://a/outer')
+    assert closed == [outer]
+
+
+class FakeClientResponse:
+    status = 200
+
+    async def read(self):
+        return b'"ok"'
+
+    def release(self):
+        pass
+
+
+def test_replaced_async_session_is_closed_after_its_streams(monkeypatch):
+    closed = []
+
+    async def request(session, method, url, **kwargs):
+        return FakeClientResponse()
+
+    async def close(session):
+        closed.append(session)
+
+    monkeypatch.setattr(aiohttp.ClientSession, 'request', request)
+    monkeypatch.setattr(aiohttp.ClientSession, 'close', close)
+
+    async def scenario():
+        pool = AsyncSessionPool()
+        stream = await pool.request('POST', LLM, 'http://a/stream', b'{}', stream=True)
+        await pool.request('GET', {**LLM, 'password': 'changed'}, 'http://a/response', b'{}')
+        assert closed == []
+        await stream.aclose()
+        assert len(closed) == 1
+        # Without calls in flight, the replaced session is closed at once
+        await pool.request('GET', LLM, 'http://a/response', b'{}')
+        assert len(closed) == 2
+
+    asyncio.run(scenario())
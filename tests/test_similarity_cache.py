@@ -0,0 +1,55 @@
+import pytest
+from controllers.similarity_cache import SimilarityCache, normalized_words, VOLATILE_TOKEN
+
+LLM = {'name': 'a', 'model': 'm'}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setenv('SIMILAR_CACHE_TYPES', 'text:0.8')
+    monkeypatch.setenv('SIMILAR_CACHE_VERIFY_RATE', '0')
+    return SimilarityCache()
+
+
+def request(instruction, **fields):
+    return {'instruction': instruction, 'temperature': 0, **fields}
+
+
+def test_normalized_words_keep_numbers_and_mask_ids():
+    assert normalized_words('What is 2 + 2?') != normalized_words('What is 17 + 25?')
+    assert normalized_words('Convert 100 USD') != normalized_words('Convert 5000 USD')
+    assert normalized_words('Log 2024-05-01 12:00:00 id 9f8e7d6c5b4a') == normalized_words('log 2025-01-31 08:30:10 ID 0a1b2c3d4e5f')
+    assert normalized_words('uuid 123e4567-e89b-12d3-a456-426614174000') == ['uuid', VOLATILE_TOKEN]
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ('What is 2 + 2?', 'What is 17 + 25?'),
+    ('Convert 100 USD', 'Convert 5000 USD'),
+    ('Write a python function that sums the first 10 numbers of the list and prints the result',
+     'Write a python function that sums the first 20 numbers of the list and prints the result'),
+])
+def test_prompts_differing_in_numbers_miss(cache, cached, asked):
+    cache.put(LLM, request(cached), b'answer')
+    assert cache.get('text', LLM, request(asked)) is None
+
+
+def test_near_duplicate_hits(cache):
+    prompt = 'Summarize the incident report created at 2024-05-01 12:00:00 for request 9f8e7d6c5b4a in three sentences'
+    cache.put(LLM, request(prompt), b'answer')
+    answer, similarity, verify = cache.get('text', LLM, request(prompt.upper().replace('2024-05-01', '2025-02-02')))
+    assert answer == b'answer' and similarity == 1.0 and not verify
+
+
+def test_other_fields_and_llm_partition(cache):
+    prompt = 'Summarize the incident report in three sentences please'
+    cache.put(LLM, request(prompt), b'answer')
+    assert cache.get('text', LLM, request(prompt, max_new_tokens=5)) is None
+    assert cache.get('text', {'name': 'b', 'model': 'm'}, request(prompt)) is None
+
+
+def test_applies(cache):
+    assert cache.applies('text', request('x'))
+    assert not cache.applies('code', request('x'))
+    assert not cache.applies('text', {'instruction': 'x', 'temperature': 0.7})
+    assert not cache.applies('text', request('x', cache=False))
+    assert not cache.applies('text', request('x'), stream=True)
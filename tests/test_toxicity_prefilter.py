@@ -0,0 +1,48 @@
+import pytest
+from controllers.toxicity_prefilter import ToxicityPrefilter
+
+
+@pytest.fixture
+def prefilter(monkeypatch, tmp_path):
+    terms = tmp_path / 'terms.txt'
+    terms.write_text('# Test terms\nidiota\nshut up  # two words\n\n', encoding='utf-8')
+    monkeypatch.setenv('TOXICITY_TERMS_FILES', f'{terms},{tmp_path / "missing.txt"}')
+    return ToxicityPrefilter()
+
+
+def test_terms_match_whole_words_ignoring_case_and_accents(prefilter):
+    assert prefilter.check('Você é um IDIÓTA!') == (True, 'prefilter')
+    assert prefilter.check('please shut   up now') == (True, 'prefilter')
+    assert prefilter.check('the idiotas are fine') == (None, None)
+    assert prefilter.check('shut the door, up there') == (None, None)
+
+
+def test_llm_verdicts_are_cached(prefilter):
+    assert prefilter.check('tell me a joke') == (None, None)
+    prefilter.remember('tell me a joke', False)
+    assert prefilter.check('Tell me a  JOKE') == (False, 'cache')
+    prefilter.remember('something nasty', True)
+    assert prefilter.check('something nasty') == (True, 'cache')
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ('how do i kill a process', 'how do i kill a process!'),
+    ('meet me at 5', 'meet me at 6'),
+    ('voce e otimo', 'você é ótimo'),
+    ('order 2024-05-01 shipped', 'order 2025-01-31 shipped'),
+])
+def test_variants_do_not_share_a_verdict(prefilter, cached, asked):
+    prefilter.remember(cached, False)
+    assert prefilter.check(asked) == (None, None)
+
+
+def test_cached_verdicts_expire(monkeypatch):
+    monkeypatch.setenv('TOXICITY_CACHE_TTL', '0')
+    prefilter = ToxicityPrefilter()
+    prefilter.remember('tell me a joke', False)
+    assert prefilter.check('tell me a joke') == (None, None)
+
+
+def test_non_text_instructions_go_to_the_llm(prefilter):
+    assert prefilter.check(None) == (None, None)
+    prefilter.remember(['a list'], True)